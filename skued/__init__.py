@@ -8,18 +8,22 @@ from .affine import (affine_map, change_basis_mesh, change_of_basis, is_basis,
                      is_rotation_matrix, minimum_image_distance,
                      rotation_matrix, transform, translation_matrix,
                      translation_rotation_matrix)
-from .array_utils import (cart2polar, cart2spherical, complex_array, mirror,
-                          plane_mesh, polar2cart, repeated_array,
-                          spherical2cart)
+from .array_utils import (cart2polar, cart2spherical, complex_array,
+                          get_float_dtype, mirror, plane_mesh, polar2cart,
+                          repeated_array, set_float_dtype, spherical2cart)
 from .baseline import (available_dt_filters, available_first_stage_filters,
                        baseline_dt, baseline_dwt, dt_max_level, dtcwt, idtcwt)
 from .eproperties import (electron_velocity, electron_wavelength,
                           interaction_parameter, lorentz)
-from .image import (align, azimuthal_average, combine_masks, diff_register,
-                    ialign, isnr, itrack_peak, mask_from_collection,
+from .fft_utils import get_fft_backend, set_fft_backend
+from .image import (AzimuthalIntegrator, MaskedRegistration, PixelStatistics,
+                    Symmetrizer, align, average_from_collection,
+                    azimuthal_average, azimuthal_cake, azimuthal_statistics,
+                    combine_masks, diff_register, ialign, iazimuthal_average,
+                    ireject_outliers, isnr, itrack_peak, mask_from_collection,
                     mask_image, mnxc2, nfold, powder_calq, powder_center,
-                    reflection, shift_image, snr_from_collection, triml, trimr,
-                    xcorr)
+                    reflection, shift_image, snr_from_collection, triml,
+                    trimr, xcorr)
 from .io import diffread, diffshow, dmread, imibread, mibheader, mibread
 from .plot_utils import rgb_sweep, spectrum_colors
 from .potential_map import potential_map, potential_synthesis
@@ -8,6 +8,65 @@ from warnings import warn
 import numpy as np
 from numpy.linalg import norm
 
+# Floating-point types in which computations can be carried out
+FLOAT_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+
+_FLOAT_DTYPE = {'dtype': np.dtype(np.float64)}
+
+def set_float_dtype(dtype):
+    """
+    Set the default floating-point type of computations in the image-processing routines
+    of scikit-ued, e.g. :func:`mnxc`, :func:`shift_image`, :func:`nfold`, :func:`reflection`,
+    :func:`baseline_dt` and :func:`baseline_dwt`. 
+    
+    Single-precision computations use half the memory of double-precision computations, which is 
+    sufficient for most detector data (e.g. 16-bit integer images).
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    dtype : numpy.dtype or str {'float32', 'float64'}
+        Default floating-point type. The default is double precision (``numpy.float64``). Routines that support this
+        setting also accept a ``dtype`` parameter which takes precedence over it.
+    
+    Raises
+    ------
+    ValueError : if ``dtype`` is not a supported floating-point type.
+
+    See Also
+    --------
+    get_float_dtype : current default floating-point type.
+    """
+    _FLOAT_DTYPE['dtype'] = _float_dtype(dtype)
+
+def get_float_dtype():
+    """
+    Default floating-point type of computations in the image-processing routines of scikit-ued.
+
+    .. versionadded:: 1.0.2
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        Either ``numpy.float32`` or ``numpy.float64``.
+
+    See Also
+    --------
+    set_float_dtype : change the default floating-point type.
+    """
+    return _FLOAT_DTYPE['dtype']
+
+def _float_dtype(dtype = None):
+    """ Floating-point type of computations: `dtype` if provided, otherwise the default type. """
+    if dtype is None:
+        return _FLOAT_DTYPE['dtype']
+    
+    dtype = np.dtype(dtype)
+    if dtype not in FLOAT_DTYPES:
+        raise ValueError('Floating-point type {} is not supported. Supported types are {}'.format(dtype, FLOAT_DTYPES))
+    return dtype
+
 
 def repeated_array(arr, num, axes = -1):
     """
@@ -95,7 +154,7 @@ def mirror(arr, axes = None):
         for axis in axes:
             reverse[axis] = slice(None, None, -1)
     
-    return arr[reverse]
+    return arr[tuple(reverse)]
 
 def cart2polar(x, y):
     """ 
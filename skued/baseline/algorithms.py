@@ -10,11 +10,12 @@ from warnings import warn
 import numpy as np
 import pywt
 
+from ..array_utils import _float_dtype
 from .dtcwt import dtcwt, idtcwt
 
 
 def baseline_dt(array, max_iter, level = None, first_stage = 'sym6', wavelet = 'qshift1', 
-				background_regions = None, mask = None, mode = 'constant', axis = -1):
+				background_regions = None, mask = None, mode = 'constant', axis = -1, dtype = None):
 	"""
 	Iterative method of baseline-determination based on the dual-tree complex wavelet transform.
 	This function only works in 1D, along an axis. For baseline of 2D arrays, see :func:`baseline_dwt`.
@@ -49,6 +50,9 @@ def baseline_dt(array, max_iter, level = None, first_stage = 'sym6', wavelet = '
 		Signal extension mode, see pywt.Modes.
 	axis : int, optional
 		Axis over which to compute the wavelet transform. Default is -1
+	dtype : numpy.dtype or None, optional
+		Floating-point type of the computation and of the baseline, either ``numpy.float32`` or ``numpy.float64``.
+		If None (default), the type set by :func:`set_float_dtype` is used.
 
 	Returns
 	-------
@@ -61,12 +65,12 @@ def baseline_dt(array, max_iter, level = None, first_stage = 'sym6', wavelet = '
 			electron powder diffraction data using the dual-tree complex wavelet transform, Struct. Dyn. 4 (2017)
 	"""
 	return _iterative_baseline(array = array, max_iter = max_iter, background_regions = background_regions,
-									mask = mask, axes = (axis,), approx_rec_func = _dt_approx_rec,
+									mask = mask, axes = (axis,), approx_rec_func = _dt_approx_rec, dtype = dtype,
 									func_kwargs = {'level': level, 'wavelet': wavelet, 'mode': mode,
 													'first_stage': first_stage, 'axis': axis})
 
 def baseline_dwt(array, max_iter, level = None, wavelet = 'sym6', background_regions = None, 
-				 mask = None, mode = 'constant', axis = -1):
+				 mask = None, mode = 'constant', axis = -1, dtype = None):
 	"""
 	Iterative method of baseline determination, based on the discrete wavelet transform. 
 
@@ -99,6 +103,9 @@ def baseline_dwt(array, max_iter, level = None, wavelet = 'sym6', background_reg
 		Signal extension mode, see pywt.Modes.
 	axis : int or tuple, optional
 		Axis over which to compute the wavelet transform. Can also be a 2-tuple of ints for 2D baseline
+	dtype : numpy.dtype or None, optional
+		Floating-point type of the computation and of the baseline, either ``numpy.float32`` or ``numpy.float64``.
+		If None (default), the type set by :func:`set_float_dtype` is used.
 
 	Returns
 	-------
@@ -116,10 +123,10 @@ def baseline_dwt(array, max_iter, level = None, wavelet = 'sym6', background_reg
 	approx_rec_func = {1: _dwt_approx_rec, 2: _dwt_approx_rec2}
 
 	return _iterative_baseline(array, max_iter = max_iter, background_regions = background_regions, 
-							   mask = mask, axes = axis, approx_rec_func = approx_rec_func[len(axis)], 
+							   mask = mask, axes = axis, approx_rec_func = approx_rec_func[len(axis)], dtype = dtype,
 							   func_kwargs = {'level': level, 'wavelet': wavelet, 'axis': axis, 'mode':mode})
 
-def _iterative_baseline(array, max_iter, mask, background_regions, axes, approx_rec_func, func_kwargs):
+def _iterative_baseline(array, max_iter, mask, background_regions, axes, approx_rec_func, func_kwargs, dtype = None):
 	""" 
 	Base function for iterative baseline determination. This function is not meant to be called directly.
 	See `baseline_dt` or `baseline_dwt`.
@@ -144,13 +151,16 @@ def _iterative_baseline(array, max_iter, mask, background_regions, axes, approx_
 		The detail coefficients will be set to zero.
 	func_kwargs : dict
 		Keyword arguments to `approx_rec_func`.
+	dtype : numpy.dtype or None, optional
+		Floating-point type of the computation. If None (default), the type set by 
+		:func:`set_float_dtype` is used.
 	
 	Returns
 	-------
 	baseline : `~numpy.ndarray`
 		Iterative baseline
 	"""
-	array = np.asarray(array, dtype = np.float)
+	array = np.asarray(array, dtype = _float_dtype(dtype))
 
 	if background_regions is None:
 		background_regions = []
@@ -175,7 +185,7 @@ def _iterative_baseline(array, max_iter, mask, background_regions, axes, approx_
 	# Preparation for loop
 	original_signal 	 = np.array(array, copy = True)
 	signal 				 = np.array(original_signal, copy = True)
-	background 			 = np.zeros_like(signal, dtype = np.float)
+	background 			 = np.zeros_like(signal)
 	background_too_large = np.empty_like(background, dtype = np.bool)
 	signal_too_large     = np.empty_like(background, dtype = np.bool)
 
@@ -14,6 +14,12 @@ class TestBaselineDWT(unittest.TestCase):
 		""" baseline computed at the zero-th level should not affect the array """
 		self.assertTrue(np.allclose(self.arr, baseline_dwt(self.arr, max_iter = 5, level = 0)))
 
+	def test_dtype(self):
+		""" Test that the baseline can be computed in single precision """
+		baseline = baseline_dwt(self.arr, max_iter = 5, level = 2, dtype = np.float32)
+		self.assertEqual(baseline.dtype, np.float32)
+		self.assertTrue(np.allclose(baseline, baseline_dwt(self.arr, max_iter = 5, level = 2), atol = 1e-5))
+
 	def test_approx_rec(self):
 		""" Test that the underlying _dwt_approx_rec function is working properly """
 
@@ -0,0 +1,116 @@
+"""
+Fast Fourier transform backends
+"""
+
+import os
+
+import numpy as np
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    # scipy.fft requires scipy >= 1.4
+    scipy_fft = None
+
+try:
+    import pyfftw
+    from pyfftw.interfaces import numpy_fft as pyfftw_fft
+except ImportError:
+    pyfftw = None
+else:
+    # Plans (FFTW objects) are kept alive between calls, so that
+    # repeated transforms of the same shape are not re-planned.
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+
+BACKENDS = ('numpy', 'scipy', 'pyfftw')
+
+def _available():
+    """ Names of the backends that can be used in the current environment. """
+    modules = {'numpy': np.fft, 'scipy': scipy_fft, 'pyfftw': pyfftw}
+    return tuple(name for name in BACKENDS if modules[name] is not None)
+
+# Current backend. The fastest available backend is used by default.
+_BACKEND = {'name': _available()[-1], 'workers': os.cpu_count() or 1}
+
+def set_fft_backend(backend, workers = None):
+    """
+    Set the implementation of Fourier transforms used by correlation routines in scikit-ued,
+    e.g. :func:`xcorr`, :func:`mnxc`, :func:`masked_register_translation`, :func:`nfft`,
+    and :func:`register_time_shift`.
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    backend : str {'numpy', 'scipy', 'pyfftw'}
+        Fourier transform implementation. 'scipy' requires SciPy 1.4 or later, and 'pyfftw' requires
+        ``pyfftw`` to be installed. The SciPy and NumPy implementations cache the twiddle factors
+        of recent transform shapes; with ``pyfftw``, FFTW plans of recent transforms are cached.
+    workers : int or None, optional
+        Number of threads used for each Fourier transform. If None (default), all CPUs are used.
+        Multithreading is not supported by the 'numpy' backend, which ignores this parameter.
+
+    Raises
+    ------
+    ValueError : if ``backend`` is not a valid backend, or if ``workers`` is not a positive integer.
+    ImportError : if ``backend`` is not installed.
+
+    See Also
+    --------
+    get_fft_backend : current backend.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('FFT backend {} is not valid. Available backends are {}'.format(backend, BACKENDS))
+    if backend not in _available():
+        raise ImportError('FFT backend {} is not installed.'.format(backend))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if int(workers) < 1:
+        raise ValueError('Number of workers should be a positive integer, not {}'.format(workers))
+
+    _BACKEND.update(name = backend, workers = int(workers))
+
+def get_fft_backend():
+    """
+    Current implementation of Fourier transforms used by correlation routines in scikit-ued.
+
+    .. versionadded:: 1.0.2
+
+    Returns
+    -------
+    backend : str {'numpy', 'scipy', 'pyfftw'}
+        Fourier transform implementation.
+    workers : int
+        Number of threads used for each Fourier transform.
+
+    See Also
+    --------
+    set_fft_backend : change the current backend.
+    """
+    return _BACKEND['name'], _BACKEND['workers']
+
+def _transform(name):
+    """ Build a function equivalent to ``numpy.fft.<name>`` which dispatches to the current backend. """
+    def transform(a, *args, **kwargs):
+        backend, workers = _BACKEND['name'], _BACKEND['workers']
+        if backend == 'scipy':
+            return getattr(scipy_fft, name)(a, *args, workers = workers, **kwargs)
+        elif backend == 'pyfftw':
+            return getattr(pyfftw_fft, name)(a, *args, threads = workers, **kwargs)
+        return getattr(np.fft, name)(a, *args, **kwargs)
+
+    # Functions must be found by name for pickling
+    transform.__name__ = transform.__qualname__ = name
+    transform.__doc__ = """ Equivalent to ``numpy.fft.{}``, computed with the current FFT backend. """.format(name)
+    return transform
+
+fft     = _transform('fft')
+ifft    = _transform('ifft')
+rfft    = _transform('rfft')
+irfft   = _transform('irfft')
+fftn    = _transform('fftn')
+ifftn   = _transform('ifftn')
+rfftn   = _transform('rfftn')
+irfftn  = _transform('irfftn')
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 """ Diffraction image analysis """
 
-from .alignment import align, diff_register, ialign, shift_image, itrack_peak, masked_register_translation
+from .alignment import (MaskedRegistration, align, diff_register, ialign, shift_image, itrack_peak, 
+                        masked_register_translation)
 from .calibration import powder_calq
-from .correlation import mnxc2, mnxc, xcorr
-from .metrics import snr_from_collection, isnr, mask_from_collection, combine_masks, mask_image, trimr, triml
-from .powder import azimuthal_average, powder_center
-from .symmetry import nfold, reflection
+from .correlation import MaskedCorrelator, mnxc2, mnxc, xcorr
+from .metrics import (PixelStatistics, average_from_collection, snr_from_collection, isnr, ireject_outliers, mask_from_collection, 
+                      combine_masks, mask_image, trimr, triml)
+from .powder import (AzimuthalIntegrator, azimuthal_average, azimuthal_cake, azimuthal_statistics,
+                     iazimuthal_average, powder_center)
+from .symmetry import Symmetrizer, nfold, reflection
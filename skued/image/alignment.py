@@ -4,6 +4,7 @@ Module concerned with alignment of diffraction images
 =====================================================
 """
 from functools import partial
+from itertools import product
 
 import numpy as np
 from scipy.ndimage import shift as subpixel_shift
@@ -12,46 +13,91 @@ from skimage.filters import gaussian
 
 from npstreams import array_stream, peek
 
-from .correlation import mnxc2, mnxc
+from ..array_utils import _float_dtype
+from ..fft_utils import get_fft_backend, irfftn, rfftn, set_fft_backend
+from ..utils import bounded_pmap
+from .correlation import MaskedCorrelator, _upsampled_irfft, mnxc2, mnxc
+from .powder import _block_sum
 
 non = lambda s: s if s < 0 else None
 mom = lambda s: max(0, s)
-def shift_image(arr, shift, fill_value = 0):
+def shift_image(arr, shift, fill_value = 0, dtype = None, out = None):
     """ 
-    Shift an image. Subpixel resolution shifts are also possible.
+    Shift an image, or every image in a stack of images. Subpixel resolution shifts are also possible.
 
     Parameters
     ----------
     arr : `~numpy.ndarray`
-        Array to be shifted.
-    shift : array_like, shape (2,)
+        Array to be shifted. If `shift` is of shape (N, 2), `arr` is a stack of N images, 
+        of shape (N, rows, cols).
+    shift : array_like, shape (2,) or (N, 2)
         Shifts in the x and y directions, respectively. Shifts can be of sub-pixel value,
-        in which case interpolation is used.
+        in which case interpolation is used. For stacks of images, every image is shifted
+        by the corresponding row of `shift`.
+
+        .. versionchanged:: 1.0.2
+            Stacks of images can be shifted at once.
     fill_value : numerical, optional
         Edges will be filled with `fill_value` after shifting. 
+    dtype : numpy.dtype or None, optional
+        Floating-point type, either ``numpy.float32`` or ``numpy.float64``, of the interpolation
+        for sub-pixel shifts. Python floats, e.g. ``fill_value = np.nan``, are also considered to
+        be of this type. If None (default), the type set by :func:`set_float_dtype` is used.
+    out : `~numpy.ndarray` or None, optional
+        Array of the same shape as `arr` in which to store the shifted array. `out` can be `arr` itself,
+        in which case `arr` is shifted in-place. If None (default), a new array is allocated.
+
+        .. versionadded:: 1.0.2
 
     Returns
     -------
     out : `~numpy.ndarray`
         Shifted array. The type of the shifted array will be the smallest size
-        that accomodates the types of `arr` and `fill_value`.
+        that accomodates the types of `arr` and `fill_value`, unless `out` is provided.
     
+    Raises
+    ------
+    ValueError : if the number of shifts does not match the number of images in a stack.
+    ValueError : if `out` is not of the same shape as `arr`.
+
     See Also
     --------
     scipy.ndimage.shift : shift an image via interpolation
     """
     # Since the fill value is often NaN, but arrays may be integers
     # We need to promote the final type to smallest coherent type
-    final_type = np.promote_types(arr.dtype, np.dtype(type(fill_value)))
-    output = np.full_like(arr, fill_value = fill_value, dtype = final_type)
+    dtype = _float_dtype(dtype)
+    fill_type = dtype if type(fill_value) is float else np.dtype(type(fill_value))
+    final_type = np.promote_types(arr.dtype, fill_type)
+
+    if out is None:
+        out = np.empty_like(arr, dtype = final_type)
+    elif out.shape != arr.shape:
+        raise ValueError('Output array of shape {} cannot hold a shifted array of shape {}'.format(out.shape, arr.shape))
+
+    shift = np.asarray(shift)
+    if shift.ndim == 1:
+        _shift_frame(arr, shift, fill_value, out, dtype)
+        return out
+    
+    if shift.shape != (arr.shape[0], 2):
+        raise ValueError('{} shifts cannot be applied to a stack of {} images'.format(shift.shape[0], arr.shape[0]))
 
+    # Images are shifted one at a time, directly into the output array, so that
+    # temporary arrays are only ever the size of one image
+    for image, image_shift, image_out in zip(arr, shift, out):
+        _shift_frame(image, image_shift, fill_value, image_out, dtype)
+    return out
+
+def _shift_frame(arr, shift, fill_value, out, dtype):
+    """ Shift a single image into `out`, which may be `arr` itself. See `shift_image`. """
     # Floating point shifts are much slower
     j, i = tuple(shift)
     if (int(i) != i) or (int(j) != j):	# shift is float
         # Image must not be float16
         # because subpixel shifting involves interpolation
-        subpixel_shift(arr.astype(np.float), (i, j), output = output, cval = fill_value)
-        return output
+        subpixel_shift(arr.astype(dtype), (i, j), output = out, cval = fill_value)
+        return
     
     i, j = int(i), int(j)
 
@@ -62,13 +108,19 @@ def shift_image(arr, shift, fill_value = 0):
         dst_slices[ax] = slice(mom(s), non(s))
         src_slices[ax] = slice(mom(-s), non(-s))
 
-    output[dst_slices] = arr[src_slices]
-    return output
+    out[tuple(dst_slices)] = arr[tuple(src_slices)]
+
+    # Only the edges that were not written to need to be filled
+    for s, ax in zip((i, j), (0, 1)):
+        edge = [slice(None, None)] * arr.ndim
+        edge[ax] = slice(None, s) if s > 0 else slice(s, None)
+        if s != 0:
+            out[tuple(edge)] = fill_value
 
 @array_stream
-def itrack_peak(images, row_slice = None, col_slice = None, precision = 1/10):
+def itrack_peak(images, row_slice = None, col_slice = None, precision = 1/10, processes = 1, rois = None):
     """
-    Generator function that tracks a diffraction peak in a stream of images.
+    Generator function that tracks a diffraction peak, or many diffraction peaks, in a stream of images.
     
     Parameters
     ----------
@@ -81,13 +133,29 @@ def itrack_peak(images, row_slice = None, col_slice = None, precision = 1/10):
     precision : float, optional
         Precision of the tracking in pixels. A precision of 1/10 (default) means that
         the tracking will be precise up to 1/10 of a pixel.
+    processes : int or None, optional
+        Number of processes to use. If `None`, all available CPUs are used. Default is one,
+        i.e. no parallelism. Shifts are yielded in order, and only a few images are 
+        in flight at any time.
+
+        .. versionadded:: 1.0.2
+    rois : iterable of 2-tuples of slices, or None, optional
+        Regions of interest, as ``(row_slice, col_slice)`` pairs, around every peak to track. All peaks
+        are tracked in a single pass over `images`, and regions of the same shape are registered together.
+        If provided, `row_slice` and `col_slice` are ignored.
+
+        .. versionadded:: 1.0.2
     
     Yields
     ------
-    shift : `~numpy.ndarray`, shape (2,)
+    shift : `~numpy.ndarray`, shape (2,) or (N, 2)
         [row, col] shifts of the peak with respect to the position of this peak
-        in the first image.
+        in the first image. If `rois` is provided, the shifts of the N peaks are stacked.
     """
+    if rois is not None:
+        yield from _itrack_peaks(images, rois = rois, precision = precision, processes = processes)
+        return
+
     if row_slice is None:
         row_slice = np.s_[:]
     
@@ -101,6 +169,14 @@ def itrack_peak(images, row_slice = None, col_slice = None, precision = 1/10):
     yield np.array((0.0, 0.0))
 
     ref = np.array(first[row_slice, col_slice], copy = True)
+
+    if processes != 1:
+        # Only the regions of interest are sent to worker processes
+        subimages = (np.array(image[row_slice, col_slice], copy = True) for image in images)
+        yield from bounded_pmap(_track_in_worker, subimages, processes = processes, initializer = _init_worker, 
+                                initargs = (dict(reference = ref, upsample_factor = int(1/precision)), get_fft_backend()[0]))
+        return
+
     sub = np.empty_like(ref)
 
     for image in images:
@@ -139,7 +215,7 @@ def align(image, reference, mask = None, fill_value = 0.0, fast = True):
     return shift_image(image, shift, fill_value = fill_value)
 
 @array_stream
-def ialign(images, reference = None, mask = None, fill_value = 0.0, fast = True):
+def ialign(images, reference = None, mask = None, fill_value = 0.0, fast = True, processes = 1, max_shift = None):
     """
     Generator of aligned diffraction images.
 
@@ -158,6 +234,18 @@ def ialign(images, reference = None, mask = None, fill_value = 0.0, fast = True)
     fast : bool, optional
         If True (default), alignment is done on images cropped to half
         (one quarter area). Disable for small images, e.g. 256x256.
+    processes : int or None, optional
+        Number of processes to use. If `None`, all available CPUs are used. Default is one,
+        i.e. no parallelism. Aligned images are yielded in order, and only a few images are 
+        in flight at any time.
+
+        .. versionadded:: 1.0.2
+    max_shift : int or None, optional
+        If not None, only shifts of at most `max_shift` pixels along each axis are considered. 
+        This is much faster than considering all possible shifts when `max_shift` is small, e.g. 
+        for images that drift by a few pixels.
+
+        .. versionadded:: 1.0.2
 
     Yields
     ------
@@ -174,17 +262,147 @@ def ialign(images, reference = None, mask = None, fill_value = 0.0, fast = True)
         reference = next(images)
         yield reference
 
-    yield from map(partial(align, reference = reference, mask = mask, fill_value =  fill_value, fast = fast), images)
+    # Reference-side quantities are computed only once for the whole stream
+    register = MaskedRegistration(reference, mask = mask, crop = fast, max_shift = max_shift)
+
+    if processes != 1:
+        yield from bounded_pmap(_align_in_worker, images, processes = processes, initializer = _init_worker, 
+                                initargs = (dict(register = register, fill_value = fill_value), get_fft_backend()[0]))
+        return
+
+    for image in images:
+        yield shift_image(image, register(image), fill_value = fill_value)
+
+# State shared by all images processed by a worker process, e.g. the 
+# reference image. It is transferred once per process, rather than once per image.
+_worker_state = dict()
+
+def _init_worker(state, fft_backend):
+    _worker_state.update(state)
+    # Images are already processed in parallel; multithreaded
+    # Fourier transforms would oversubscribe the CPUs.
+    set_fft_backend(fft_backend, workers = 1)
+
+def _align_in_worker(image):
+    register = _worker_state['register']
+    return shift_image(image, register(image), fill_value = _worker_state['fill_value'])
+
+def _track_in_worker(sub):
+    shift, *_ = register_translation(_worker_state['reference'], sub, 
+                                     upsample_factor = _worker_state['upsample_factor'])
+    return np.asarray(shift)
 
+def _track_peaks_in_worker(image):
+    return _worker_state['tracker'](image)
+
+def _itrack_peaks(images, rois, precision, processes):
+    """ Track many peaks in a stream of images in a single pass. See `itrack_peak`. """
+    rois = [tuple(roi) for roi in rois]
+
+    first = next(images)
+    yield np.zeros(shape = (len(rois), 2), dtype = np.float)
+
+    tracker = _PeakTracker(first, rois = rois, upsample_factor = int(1/precision))
+
+    if processes != 1:
+        # Only the regions of interest are sent to worker processes
+        yield from bounded_pmap(_track_peaks_in_worker, map(tracker.crop, images), processes = processes, 
+                                initializer = _init_worker, initargs = (dict(tracker = tracker), get_fft_backend()[0]))
+        return
+
+    for image in images:
+        yield tracker(tracker.crop(image))
+
+class _PeakTracker:
+    """
+    Registration of many regions of interest onto the same regions of a reference image, 
+    by cross-correlation. Regions of the same shape are registered together, and the spectra 
+    of the reference regions are computed once.
+
+    Parameters
+    ----------
+    reference : `~numpy.ndarray`, ndim 2
+        Reference image.
+    rois : list of 2-tuples of slices
+        Regions of interest as ``(row_slice, col_slice)`` pairs.
+    upsample_factor : int
+        Shifts are determined to 1/`upsample_factor` of a pixel.
+    """
+
+    def __init__(self, reference, rois, upsample_factor = 1):
+        self.rois = rois
+        self.upsample_factor = upsample_factor
+
+        # Regions of interest are grouped by shape, as (indices, shape, conjugated spectra of the reference)
+        reference_regions = self.crop(reference)
+        groups = dict()
+        for index, region in enumerate(reference_regions):
+            groups.setdefault(region.shape, list()).append(index)
+
+        self._groups = list()
+        for shape, indices in groups.items():
+            stack = np.stack([reference_regions[index] for index in indices])
+            self._groups.append((indices, shape, np.conj(rfftn(stack, shape, (1, 2)))))
+
+    def crop(self, image):
+        """ Copy of the regions of interest of an image. """
+        return [np.array(image[roi], dtype = np.float) for roi in self.rois]
+    
+    def __call__(self, regions):
+        """ 
+        Shifts of regions of interest with respect to the reference regions.
+        
+        Parameters
+        ----------
+        regions : list of `~numpy.ndarray`
+            Regions of interest, as returned by ``crop``.
+        
+        Returns
+        -------
+        shifts : `~numpy.ndarray`, shape (N, 2)
+            [row, col] shifts of each region of interest.
+        """
+        shifts = np.empty(shape = (len(self.rois), 2), dtype = np.float)
+
+        for indices, shape, conj_reference_spectra in self._groups:
+            # Cross-power spectra of all regions of the same shape are computed at once
+            spectra = rfftn(np.stack([regions[index] for index in indices]), shape, (1, 2))
+            spectra *= conj_reference_spectra
+            np.conj(spectra, out = spectra)
+            xcorr = irfftn(spectra, shape, (1, 2))
+
+            # Peaks beyond the middle of the regions are negative shifts
+            maxima = np.argmax(xcorr.reshape((len(indices), -1)), axis = 1)
+            locations = np.transpose(np.unravel_index(maxima, shape)).astype(np.float)
+            midpoints = np.fix(np.array(shape) / 2)
+            locations = np.where(locations > midpoints, locations - np.array(shape), locations)
+
+            if self.upsample_factor > 1:
+                locations = np.stack([self._refine(spectrum, location, shape) 
+                                      for spectrum, location in zip(spectra, locations)])
+            shifts[indices] = locations
+
+        return shifts
+    
+    def _refine(self, spectrum, location, shape):
+        """ 
+        Refine the location of the cross-correlation maximum in a neighborhood of 
+        1.5 pixels, by upsampling with matrix-multiply discrete Fourier transforms.
+        """
+        factor = self.upsample_factor
+        region_size = 2 * int(np.ceil(1.5 * factor / 2)) + 1
+        offsets = (np.arange(region_size) - region_size // 2) / factor
+        coordinates = [loc + offsets for loc in location]
+
+        upsampled = _upsampled_irfft(spectrum, coordinates, (-2, -1), shape)
+        maximum = np.unravel_index(np.argmax(upsampled), upsampled.shape)
+        return location + offsets[np.array(maximum)]
 
 def _crop_to_half(image, copy = False):
     nrows, ncols = np.array(image.shape)/4
     return np.array(image[int(nrows):-int(nrows), int(ncols):-int(ncols)], copy = copy)
 
-# TODO: add option to upsample, akin to skimage.feature.register_translation
-#		Could this be done initially by zero-padding?
-#		See https://github.com/scikit-image/scikit-image/blob/master/skimage/feature/register_translation.py#L109
-def diff_register(image, reference, mask = None, crop = True, sigma = 5):
+def diff_register(image, reference, mask = None, crop = True, sigma = 5, upsample_factor = 1, max_shift = None, levels = 0):
     """
     Register translation of diffraction patterns by masked 
     normalized cross-correlation.
@@ -204,36 +422,166 @@ def diff_register(image, reference, mask = None, crop = True, sigma = 5):
     sigma : float or None, optional
         Standard deviation for Gaussian kernel with which to smooth 
         ``image`` and ``reference``. If None, no smoothing is performed.
+    upsample_factor : int, optional
+        Images will be registered to within ``1 / upsample_factor`` of a pixel. 
+        Default is 1, i.e. no upsampling.
+
+        .. versionadded:: 1.0.2
+    max_shift : int or None, optional
+        If not None, only shifts of at most `max_shift` pixels along each axis are considered. 
+        This is much faster than considering all possible shifts when `max_shift` is small, e.g. 
+        for images that drift by a few pixels. Cannot be combined with upsampling.
+
+        .. versionadded:: 1.0.2
+    levels : int, optional
+        Number of levels of coarse-to-fine registration. If larger than zero, the shift is first
+        determined on images downsampled by a factor of ``2**levels``, and then refined at every finer
+        level by only considering shifts within one pixel of the previous estimate. This is much faster
+        than full-resolution registration of large images, without cropping. Cannot be combined with upsampling.
+        Default is 0, i.e. images are registered at full resolution.
+
+        .. versionadded:: 1.0.2
     
     Returns
     -------
     shift : `~numpy.ndarray`, shape (2,), dtype float
         Shift in rows and columns. The ordering is compatible with :func:`shift_image`
     
+    See Also
+    --------
+    MaskedRegistration : registration of many images onto the same reference.
+
     References
     ----------
     .. [PADF] Dirk Padfield. Masked Object Registration in the Fourier Domain. 
         IEEE Transactions on Image Processing, vol.21(5), pp. 2706-2718, 2012. 
     """
-    if mask is None:
-        mask = np.zeros_like(image, dtype = np.bool)
+    return MaskedRegistration(reference, mask = mask, crop = crop, sigma = sigma, 
+                              upsample_factor = upsample_factor, max_shift = max_shift, levels = levels)(image)
+
+class MaskedRegistration:
+    """
+    Registration of diffraction patterns onto a fixed reference by masked 
+    normalized cross-correlation. 
+    
+    The filtered and cropped reference, as well as its Fourier transforms, are computed once. 
+    Registering an image then requires about half as many Fourier transforms as :func:`diff_register`. 
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    reference : `~numpy.ndarray`
+        This is the reference image to which images will be aligned. 
+    mask : `~numpy.ndarray` or None, optional
+        Mask that evaluates to True on invalid pixels of the images.
+    crop : bool, optional
+        If True (default), images and ``reference`` are cropped to one
+        quarter of their areas; this results in faster execution at the expense of 
+        precision. Disable for small images.
+    sigma : float or None, optional
+        Standard deviation for Gaussian kernel with which to smooth 
+        images and ``reference``. If None, no smoothing is performed.
+    upsample_factor : int, optional
+        Images will be registered to within ``1 / upsample_factor`` of a pixel. 
+        Default is 1, i.e. no upsampling.
+    max_shift : int or None, optional
+        If not None, only shifts of at most `max_shift` pixels along each axis are considered. 
+        This is much faster than considering all possible shifts when `max_shift` is small, e.g. 
+        for images that drift by a few pixels. Cannot be combined with upsampling.
+    levels : int, optional
+        Number of levels of coarse-to-fine registration. See :func:`diff_register` for details.
+        Default is 0, i.e. images are registered at full resolution.
+    
+    See Also
+    --------
+    diff_register : register translation of a single diffraction pattern.
     
-    if crop:
-        image = _crop_to_half(image, copy = True)
-        reference = _crop_to_half(reference, copy = True)
-        mask = _crop_to_half(mask, copy = True)
+    Examples
+    --------
+    Registering an image is equivalent to :func:`diff_register`:
 
-    # Diffraction images register better with some filtering
-    if sigma:
-        image = gaussian(image, sigma, preserve_range = True)
-        reference = gaussian(reference, sigma, preserve_range = True)
+    >>> register = MaskedRegistration(reference, mask = mask) # doctest: +SKIP
+    >>> shifts = [register(image) for image in images]        # doctest: +SKIP
+    """
 
-    # Note the reverse order between the image and reference
-    # This is to mirror functionality from scikit-image's register_translation
-    return masked_register_translation(reference, image, mask, mode = 'full')[::-1]
+    def __init__(self, reference, mask = None, crop = True, sigma = 5, upsample_factor = 1, max_shift = None, levels = 0):
+        _check_upsampling(upsample_factor, max_shift, levels)
+
+        if mask is None:
+            mask = np.zeros_like(reference, dtype = np.bool)
+        valid = np.logical_not(mask)
+
+        self.crop = crop
+        self.sigma = sigma
+        self.upsample_factor = upsample_factor
+        self.max_shift = max_shift
+        self.levels = levels
+
+        reference = self._prepare(reference)
+        if crop:
+            valid = _crop_to_half(valid)
+        
+        # For coarse-to-fine registration, the full correlation is only computed
+        # at the coarsest level of the pyramid
+        if levels:
+            self._pyramid = _pyramid(reference, valid, levels)
+            reference, valid = self._pyramid[-1]
+            if max_shift is not None:
+                max_shift = int(np.ceil(max_shift / 2**levels))
+        self._coarse_max_shift = max_shift
+        
+        # Note the reverse order between the image and reference
+        # This is to mirror functionality from scikit-image's register_translation
+        self._correlator = MaskedCorrelator(reference, valid, valid, mode = 'full', axes = (0, 1), 
+                                            max_shift = max_shift)
+        self._shape = reference.shape
+
+    def _prepare(self, image):
+        """ Crop and filter an image """
+        if self.crop:
+            image = _crop_to_half(image)
+        
+        # Diffraction images register better with some filtering
+        if self.sigma:
+            image = gaussian(image, self.sigma, preserve_range = True)
+        return image
+
+    def __call__(self, image):
+        """
+        Register the translation of an image with respect to the reference.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`
+            Image to be registered. It should have the same shape as the reference.
+
+        Returns
+        -------
+        shift : `~numpy.ndarray`, shape (2,), dtype float
+            Shift in rows and columns. The ordering is compatible with :func:`shift_image`
+        """
+        image = self._prepare(image)
+        if self.levels:
+            pyramid = _pyramid(image, self._pyramid[0][1], self.levels)
+            image = pyramid[-1][0]
+
+        center = _xcorr_maximum(self._correlator, image, 
+                                ndim = 2, upsample_factor = self.upsample_factor)
+        shift = _masked_shift(center, self._shape, self._shape, mode = 'full', max_shift = self._coarse_max_shift)
+
+        if self.levels:
+            # The displacement of the image with respect to the reference doubles at every finer level,
+            # where it is refined in a small window.
+            displacement = -np.rint(shift)
+            for (image, valid), (reference, _) in zip(pyramid[-2::-1], self._pyramid[-2::-1]):
+                displacement = _window_displacement(image, reference, valid, center = 2 * displacement, radius = 1)
+            shift = -displacement
+        return shift[::-1]
 
 def masked_register_translation(src_image, target_image, src_mask, target_mask = None, 
-                                mode = 'same', overlap_ratio = 3/10):
+                                mode = 'same', overlap_ratio = 3/10, upsample_factor = 1, 
+                                max_shift = None, max_memory = 2**28):
     """
     Efficient image translation registration by masked normalized cross-correlation.
 
@@ -244,24 +592,42 @@ def masked_register_translation(src_image, target_image, src_mask, target_mask =
     src_image : `~numpy.ndarray`
         Reference image.
     target_image : `~numpy.ndarray`
-        Image to register.  Must be same dimensionality as ``src_image``.
+        Image to register.  Must be same dimensionality as ``src_image``. 
+        A stack of images, with one more dimension than ``src_image``, 
+        can also be registered in a single call; the stack is
+        processed in chunks along its first axis.
     src_mask : `~numpy.ndarray`, dtype bool
         Mask that evaluates to True on valid pixels of `src_image`.
     target_mask : `~numpy.ndarray`, dtype bool or None, optional
         Mask that evaluates to True on valid pixels of `target_image`. If None,
-        `src_mask` is used instead.
+        `src_mask` is used instead. For stacks of images, the same mask applies
+        to all images.
     mode : {'full', 'same'}, optional
         Convolution mode. See `skued.mnxc2` for a detailed description. In general,
         `'same'` mode has less edge effects, and therefore should be preferred.
     overlap_ratio : float, optional
         Maximum allowed overlap ratio between masks. The correlation at pixels with overlap ratio higher
         than this threshold will be zeroed.
+    upsample_factor : int, optional
+        Images will be registered to within ``1 / upsample_factor`` of a pixel. 
+        Only a small neighborhood of the integer-pixel correlation maximum is upsampled,
+        using matrix-multiply discrete Fourier transforms. Default is 1, i.e. no upsampling.
+    max_shift : int or None, optional
+        If not None, only shifts of at most `max_shift` pixels along each axis are considered,
+        and the correlation is computed by direct summation. This is much faster than 
+        considering all possible shifts when `max_shift` is small. In this case, `mode` is ignored. 
+        Cannot be combined with upsampling.
+    max_memory : int, optional
+        Approximate amount of memory [bytes] used to register a stack of images at once.
+        Stacks of images, including memory-mapped arrays, are registered in chunks 
+        that fit in this amount of memory. 
 
     Returns
     -------
     shifts : ndarray
         Shift vector (in pixels) required to register ``target_image`` with
-        ``src_image``.  Axis ordering is consistent with numpy (e.g. Z, Y, X)
+        ``src_image``.  Axis ordering is consistent with numpy (e.g. Z, Y, X).
+        For a stack of images, shifts are stacked along the first axis.
     
     See Also
     --------
@@ -274,27 +640,137 @@ def masked_register_translation(src_image, target_image, src_mask, target_mask =
     """
     if target_mask is None:
         target_mask = np.array(src_mask, dtype=np.bool, copy=True)
+    
+    src_image = np.asarray(src_image)
+    is_stack = np.ndim(target_image) == src_image.ndim + 1
+    frame_shape = target_image.shape[1:] if is_stack else target_image.shape
 
     # We need masks to be of the same size as their respective images
-    for (im, mask) in [(src_image, src_mask), (target_image, target_mask)]:
-        if im.shape != mask.shape:
+    for (shape, mask) in [(src_image.shape, src_mask), (frame_shape, target_mask)]:
+        if shape != mask.shape:
             raise ValueError(
                 "Error: image sizes must match their respective mask sizes.")
 
-    # The mismatch in size will impact the center location of the
-    # cross-correlation
-    size_mismatch = np.array(target_image.shape) - np.array(src_image.shape)
-
-    xcorr = mnxc(target_image, src_image, target_mask, src_mask,
-                 axes=(0, 1), mode=mode, overlap_ratio=overlap_ratio).real
+    _check_upsampling(upsample_factor, max_shift)
+    correlator = MaskedCorrelator(src_image, src_mask, target_mask, mode=mode, axes=tuple(range(src_image.ndim)), 
+                                  overlap_ratio=overlap_ratio, max_shift=max_shift)
+    
+    register = partial(_xcorr_maximum, correlator, ndim = src_image.ndim, upsample_factor = upsample_factor)
+    if not is_stack:
+        return _masked_shift(register(target_image), src_image.shape, frame_shape, mode = mode, max_shift = max_shift)
+
+    # Images are correlated all at once within chunks, so that 
+    # transforms are batched by the FFT library.
+    chunksize = max(1, max_memory // correlator._nbytes)
+    shifts = np.empty(shape = (len(target_image), src_image.ndim), dtype = np.float)
+    for start in range(0, len(target_image), chunksize):
+        center = register(np.array(target_image[start:start + chunksize]))
+        shifts[start:start + chunksize] = _masked_shift(center, src_image.shape, frame_shape, 
+                                                        mode = mode, max_shift = max_shift)
+    return shifts
+
+def _xcorr_maximum(correlator, images, ndim, upsample_factor = 1):
+    """ 
+    Location of the maximum of the masked normalized cross-correlation between 
+    images and the reference of a `MaskedCorrelator`. Images can be stacked along leading dimensions, 
+    in which case locations are stacked as well.
+    """
+    if upsample_factor > 1:
+        spectra = correlator._spectra(images)
+        xcorr = correlator._correlate(*spectra).real
+    else:
+        xcorr = correlator(images).real
 
     # Generalize to the average of multiple equal maxima
-    maxima = np.transpose(np.nonzero(xcorr == xcorr.max()))
-    center = np.mean(maxima, axis=0)
+    # The position of maxima along each axis is averaged from the 
+    # projection of the maxima onto this axis.
+    axes = tuple(range(-ndim, 0))
+    maxima = xcorr == np.max(xcorr, axis = axes, keepdims = True)
+    num_maxima = np.sum(maxima, axis = axes)
+    center = np.empty(shape = xcorr.shape[:-ndim] + (ndim,), dtype = np.float)
+    for index, axis in enumerate(axes):
+        projection = np.sum(maxima, axis = tuple(set(axes) - {axis}))
+        center[..., index] = projection @ np.arange(xcorr.shape[axis]) / num_maxima
+    
+    if upsample_factor > 1:
+        fixed_ffts, fixed_squared_ffts = (np.reshape(spectrum, (-1,) + spectrum.shape[-ndim:]) 
+                                          for spectrum in spectra)
+        locations = np.reshape(center, (-1, ndim))
+        for index, location in enumerate(locations):
+            locations[index] = correlator._refine(fixed_ffts[index], fixed_squared_ffts[index], 
+                                                  location, upsample_factor)
+    return center
+
+def _check_upsampling(upsample_factor, max_shift, levels = 0):
+    if (upsample_factor > 1) and (max_shift is not None):
+        raise ValueError('Upsampling is not supported for correlations restricted to small shifts.')
+    if (upsample_factor > 1) and levels:
+        raise ValueError('Upsampling is not supported for coarse-to-fine registration.')
+
+def _pyramid(image, valid, levels):
+    """ 
+    Images and masks downsampled by factors of 2, from the full-resolution image (first) 
+    to the coarsest image (last). Invalid pixels are set to zero, and downsampled pixels are 
+    only valid if all of the pixels they are made from are valid. 
+    """
+    pyramid = [(np.where(valid, image, 0.0), valid)]
+    for _ in range(levels):
+        image, valid = pyramid[-1]
+        count = _block_sum(valid.astype(np.float))
+        valid = count == 4
+        pyramid.append((np.where(valid, _block_sum(image) / 4, 0.0), valid))
+    return pyramid
+
+def _window_displacement(image, reference, valid, center, radius):
+    """ 
+    Displacement of an image with respect to a reference, among displacements within `radius` of `center`, 
+    which maximizes the masked normalized cross-correlation. Invalid pixels of `image` and `reference` should be zero. 
+    """
+    dot = partial(np.einsum, 'ij,ij->')
+    weights = valid.astype(image.dtype)
+    image_squared, reference_squared = np.square(image), np.square(reference)
+
+    best, displacement = -np.inf, np.array(center)
+    for offset in product(range(-radius, radius + 1), repeat = 2):
+        candidate = np.array(center, dtype = np.int) + offset
+        image_slice, reference_slice = list(), list()
+        for size, shift in zip(image.shape, candidate):
+            image_slice.append(slice(max(0, shift), min(size, size + shift)))
+            reference_slice.append(slice(max(0, -shift), min(size - shift, size)))
+        image_slice, reference_slice = tuple(image_slice), tuple(reference_slice)
+
+        image_weights, reference_weights = weights[image_slice], weights[reference_slice]
+        number_overlap_px = dot(image_weights, reference_weights)
+        if number_overlap_px < 1:
+            continue
+
+        image_sum = dot(image[image_slice], reference_weights)
+        reference_sum = dot(reference[reference_slice], image_weights)
+        numerator = dot(image[image_slice], reference[reference_slice]) - image_sum * reference_sum / number_overlap_px
+        image_denom = dot(image_squared[image_slice], reference_weights) - image_sum**2 / number_overlap_px
+        reference_denom = dot(reference_squared[reference_slice], image_weights) - reference_sum**2 / number_overlap_px
+        
+        denom = np.sqrt(max(image_denom, 0) * max(reference_denom, 0))
+        if denom > 0 and numerator / denom > best:
+            best, displacement = numerator / denom, candidate
+    return displacement.astype(np.float)
+
+def _masked_shift(center, src_shape, target_shape, mode, max_shift = None):
+    """ 
+    Shift vector from the location of the maximum of the masked normalized 
+    cross-correlation of a target image and a source image. Locations can be 
+    stacked along leading dimensions, in which case shift vectors are stacked as well.
+    """
+    # The mismatch in size will impact the center location of the
+    # cross-correlation
+    size_mismatch = np.array(target_shape) - np.array(src_shape)
 
-    if mode == 'same':
-        shifts = (center - np.array(xcorr.shape)/2 + 0.5)
+    if max_shift is not None:
+        # The correlation without shift is located at index `max_shift`
+        shifts = center - max_shift
+    elif mode == 'same':
+        shifts = (center - np.array(target_shape)/2 + 0.5)
     else:
-        shifts = center - np.array(src_image.shape) + 1
+        shifts = center - np.array(src_shape) + 1
 
     return -shifts + (size_mismatch / 2)
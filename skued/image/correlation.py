@@ -4,22 +4,17 @@ Image correlation and related functions
 =======================================
 """
 from functools import partial
+from itertools import product
+from string import ascii_letters
 
 import numpy as np
-from scipy.fftpack import next_fast_len, fftn, ifftn
+from scipy.fftpack import next_fast_len
 from scipy.signal import fftconvolve
 
-from ..array_utils import mirror
+from ..array_utils import _float_dtype
+from ..fft_utils import fftn, ifftn, irfftn, rfftn
 from ..utils import deprecated
 
-FFTOPS = {}
-try:
-    from pyfftw.interfaces.numpy_fft import rfft2, irfft2
-    FFTOPS['threads'] = 2
-except ImportError:
-    from numpy.fft import rfft2, irfft2
-
-
 EPS = np.finfo(np.float).eps
 
 def xcorr(arr1, arr2, mode = 'full', axes = None):
@@ -56,7 +51,7 @@ def xcorr(arr1, arr2, mode = 'full', axes = None):
 
     Notes
     -----
-    If ``pyfftw`` is installed, its routines will be preferred.
+    Fourier transforms are computed with the backend set by :func:`set_fft_backend`.
     
     Raises
     ------
@@ -78,15 +73,21 @@ def xcorr(arr1, arr2, mode = 'full', axes = None):
     # Determine final size along transformation axes
     # To speed up FFT, shape of Fourier transform might be slightly larger
     # then slice back before returning
-    s1 = tuple(arr1.shape[ax] for ax in axes)
-    s2 = tuple(arr2.shape[ax] for ax in axes)
-    final_shape = tuple( ax1 + ax2 - 1 for ax1, ax2 in zip(s1, s2))
-    fast_shape = tuple(map(next_fast_len, final_shape))
-    final_slice = tuple([slice(0, int(sz)) for sz in final_shape])
-
-    F1 = fftn(arr1, shape = fast_shape, axes = axes)
-    F2 = fftn(np.conj(mirror(arr2, axes = axes)), shape = fast_shape, axes = axes)
-    xc = ifftn(F1 * F2)[final_slice]
+    final_slice = [slice(None, None)] * arr1.ndim
+    for ax in axes:
+        final_slice[ax] = slice(0, arr1.shape[ax] + arr2.shape[ax] - 1)
+    final_slice = tuple(final_slice)
+    fast_shape = tuple(next_fast_len(arr1.shape[ax] + arr2.shape[ax] - 1) for ax in axes)
+
+    if np.iscomplexobj(arr1) or np.iscomplexobj(arr2):
+        F1 = fftn(arr1, fast_shape, axes)
+        F1 *= fftn(np.conj(_flip(arr2, axes = axes)), fast_shape, axes)
+        xc = ifftn(F1, fast_shape, axes)[final_slice]
+    else:
+        # Real-to-complex transforms of real arrays take half the time and memory
+        F1 = rfftn(arr1, fast_shape, axes)
+        F1 *= rfftn(_flip(arr2, axes = axes), fast_shape, axes)
+        xc = irfftn(F1, fast_shape, axes)[final_slice]
 
     if mode == 'same':
         return _centered(xc, arr1.shape, axes = axes)
@@ -159,7 +160,7 @@ def mnxc2(arr1, arr2, m1 = None, m2 = None, mode = 'full', axes = (0, 1), out =
 
     return np.real(mnxc(arr1, arr2, np.logical_not(m1), np.logical_not(m2), mode = mode, axes = axes, overlap_ratio = overlap_ratio))
 
-def mnxc(arr1, arr2, m1, m2, mode='full', axes=(-2, -1), overlap_ratio=3 / 10):
+def mnxc(arr1, arr2, m1, m2, mode='full', axes=(-2, -1), overlap_ratio=3 / 10, max_shift=None, dtype=None):
     """
     N-dimensional masked normalized cross-correlation (MNXC) between arrays.
 
@@ -191,129 +192,449 @@ def mnxc(arr1, arr2, m1, m2, mode='full', axes=(-2, -1), overlap_ratio=3 / 10):
     overlap_ratio : float, optional
         Maximum allowed overlap ratio between masks. The correlation at pixels
         with overlap ratio higher than this threshold will be zeroed.
+    max_shift : int or None, optional
+        If not None, the cross-correlation is only computed for relative shifts of at most 
+        `max_shift` pixels along every transformation axis, by direct summation rather than 
+        Fourier transforms. This is much faster and lighter on memory for small shifts. 
+        In this case, `mode` is ignored.
+    dtype : numpy.dtype or None, optional
+        Floating-point type of the computation, either ``numpy.float32`` or ``numpy.float64``.
+        If None (default), the type set by :func:`set_float_dtype` is used.
 
     Returns
     -------
     out : ndarray
-        Masked normalized cross-correlation.
+        Masked normalized cross-correlation. If `max_shift` is not None, the
+        size of `out` along transformation axes is ``2 * max_shift + 1``, and the
+        correlation of `arr1` and `arr2` without shift is located at index `max_shift`.
 
     Raises
     ------
     ValueError : if correlation `mode` is not valid, or array dimensions along
         non-transformation axes are not equal.
+    ValueError : if `dtype` is not a supported floating-point type.
 
     References
     ----------
     .. [1] Dirk Padfield. Masked Object Registration in the Fourier Domain.
         IEEE Transactions on Image Processing, vol.21(5), pp. 2706-2718 (2012).
     """
-    if mode not in {'full', 'same'}:
-        raise ValueError("Correlation mode {} is not valid.".format(mode))
-
-    fixed_image = np.array(arr1, dtype=np.float)
-    fixed_mask = np.array(m1, dtype=np.bool)
-    moving_image = np.array(arr2, dtype=np.float)
-    moving_mask = np.array(m2, dtype=np.bool)
-    eps = np.finfo(np.float).eps
-
-    # Array dimensions along non-transformation axes should be equal.
-    all_axes = set(range(fixed_image.ndim))
-    for axis in (all_axes - set(axes)):
-        if fixed_image.shape[axis] != moving_image.shape[axis]:
-            raise ValueError(
-                'Array shapes along non-transformation axes should be \
-                    equal, but dimensions along axis {a} not'.format(a=axis))
+    return MaskedCorrelator(arr2, m2, m1, mode = mode, axes = axes, 
+                            overlap_ratio = overlap_ratio, max_shift = max_shift, dtype = dtype)(arr1)
 
-    # Determine final size along transformation axes
-    # Note that it might be faster to conmpute Fourier transform in a slightly
-    # larger shape (`fast_shape`) Then, after all fourier transforms are done,
-    # we slice back to`final_shape` using `final_slice`.
-    final_shape = list(arr1.shape)
-    for axis in axes:
-        final_shape[axis] = fixed_image.shape[axis] + \
-            moving_image.shape[axis] - 1
-    final_shape = tuple(final_shape)
-    final_slice = tuple([slice(0, int(sz)) for sz in final_shape])
-
-    # Extent transform axes to the next fast length (i.e. multiple of 3, 5, or 7)
-    fast_shape = tuple([next_fast_len(final_shape[ax]) for ax in axes])
-
-    # We use numpy's fft because it allows to leave transform axes unchanged
-    # which is not possible with SciPy's fftn/ifftn
-    # E.g. arr shape (2,3,7), transform along axes (0, 1) with shape (4,4)
-    # results in arr_fft shape (4,4, 7)
-    fft = partial(np.fft.fftn, s=fast_shape, axes=axes)
-    ifft = partial(np.fft.ifftn, s=fast_shape, axes=axes)
-
-    fixed_image[np.logical_not(fixed_mask)] = 0.0
-    moving_image[np.logical_not(moving_mask)] = 0.0
-
-    # N-dimensional analog to rotation by 180deg is flip over all relevant axes
-    # See [1] for discussion.
-    rotated_moving_image = _flip(moving_image, axes=axes)
-    rotated_moving_mask = _flip(moving_mask, axes=axes)
-
-    fixed_fft = fft(fixed_image)
-    rotated_moving_fft = fft(rotated_moving_image)
-    fixed_mask_fft = fft(fixed_mask)
-    rotated_moving_mask_fft = fft(rotated_moving_mask)
-
-    # Calculate overlap of masks at every point in the convolution
-    # Locations with high overlap should not be taken into account.
-    number_overlap_masked_px = np.real(
-        ifft(rotated_moving_mask_fft * fixed_mask_fft))
-    number_overlap_masked_px[:] = np.round(number_overlap_masked_px)
-    number_overlap_masked_px[:] = np.fmax(number_overlap_masked_px, eps)
-    masked_correlated_fixed_fft = ifft(rotated_moving_mask_fft * fixed_fft)
-    masked_correlated_rotated_moving_fft = ifft(
-        fixed_mask_fft * rotated_moving_fft)
-
-    numerator = ifft(rotated_moving_fft * fixed_fft)
-    numerator -= masked_correlated_fixed_fft * \
-        masked_correlated_rotated_moving_fft / number_overlap_masked_px
-
-    fixed_squared_fft = fft(np.square(fixed_image))
-    fixed_denom = ifft(rotated_moving_mask_fft * fixed_squared_fft)
-    fixed_denom -= np.square(masked_correlated_fixed_fft) / \
-        number_overlap_masked_px
-    fixed_denom[:] = np.fmax(fixed_denom, 0.0)
-
-    rotated_moving_squared_fft = fft(np.square(rotated_moving_image))
-    moving_denom = ifft(fixed_mask_fft * rotated_moving_squared_fft)
-    moving_denom -= np.square(masked_correlated_rotated_moving_fft) / \
-        number_overlap_masked_px
-    moving_denom[:] = np.fmax(moving_denom, 0.0)
-
-    denom = np.sqrt(fixed_denom * moving_denom)
-
-    # Slice back to expected convolution shape
-    numerator = numerator[final_slice]
-    denom = denom[final_slice]
-    number_overlap_masked_px = number_overlap_masked_px[final_slice]
+class MaskedCorrelator:
+    """
+    Masked normalized cross-correlation (MNXC) of arrays against a fixed reference.
 
-    if mode == 'same':
-        _centering = partial(_centered,
-                             newshape=fixed_image.shape, axes=axes)
-        denom = _centering(denom)
-        numerator = _centering(numerator)
-        number_overlap_masked_px = _centering(number_overlap_masked_px)
-
-    # Pixels where `denom` is very small will introduce large
-    # numbers after division To get around this problem,
-    # we zero-out problematic pixels.
-    tol = 1e3 * eps * np.max(np.abs(denom), axis=axes, keepdims=True)
-    nonzero_indices = denom > tol
-
-    out = np.zeros_like(denom)
-    out[nonzero_indices] = numerator[nonzero_indices] / denom[nonzero_indices]
-    np.clip(out, a_min=-1, a_max=1, out=out)
-
-    # Apply overlap ratio threshold
-    number_px_threshold = overlap_ratio * np.max(number_overlap_masked_px,
-                                                 axis=axes, keepdims=True)
-    out[number_overlap_masked_px < number_px_threshold] = 0.0
-
-    return out
+    All quantities that only depend on the reference and on the masks (Fourier transforms, 
+    number of overlapping valid pixels, normalization of the reference) are computed once.
+    Correlating an array then takes two forward and three inverse Fourier transforms, 
+    compared to six and six for :func:`mnxc`. This is well-suited to registration of many images
+    onto the same reference.
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    reference : ndarray
+        Reference array. This is the second array (``arr2``) in :func:`mnxc`.
+    reference_mask : ndarray
+        Mask of `reference`. The mask should evaluate to `True`
+        (or 1) on valid pixels. `reference_mask` should have the same shape as `reference`.
+    mask : ndarray
+        Mask of the arrays to be correlated with `reference`. The mask should evaluate to `True`
+        (or 1) on valid pixels. Arrays to be correlated should have the same shape as `mask`.
+    mode : {'full', 'same'}, optional
+        Correlation mode. See :func:`mnxc` for a detailed description.
+    axes : tuple of ints, optional
+        Axes along which to compute the cross-correlation.
+    overlap_ratio : float, optional
+        Maximum allowed overlap ratio between masks. The correlation at pixels
+        with overlap ratio higher than this threshold will be zeroed.
+    max_shift : int or None, optional
+        If not None, the cross-correlation is only computed for relative shifts of at most 
+        `max_shift` pixels along every transformation axis. See :func:`mnxc` for details.
+    dtype : numpy.dtype or None, optional
+        Floating-point type of the computation, either ``numpy.float32`` or ``numpy.float64``.
+        If None (default), the type set by :func:`set_float_dtype` is used. Single-precision 
+        halves memory usage, and speeds up Fourier transforms with the SciPy and pyFFTW backends.
+
+    Raises
+    ------
+    ValueError : if correlation `mode` is not valid, or array dimensions along
+        non-transformation axes are not equal.
+    ValueError : if `dtype` is not a supported floating-point type.
+    
+    See Also
+    --------
+    mnxc : masked normalized cross-correlation between two arrays.
+    
+    Examples
+    --------
+    Calling a correlator on an array is equivalent to :func:`mnxc`:
+
+    >>> correlator = MaskedCorrelator(reference, reference_mask, mask) # doctest: +SKIP
+    >>> np.allclose(correlator(arr), mnxc(arr, reference, mask, reference_mask)) # doctest: +SKIP
+    True
+    """
+
+    def __init__(self, reference, reference_mask, mask, mode = 'full', axes = (-2, -1), overlap_ratio = 3/10, 
+                 max_shift = None, dtype = None):
+        if mode not in {'full', 'same'}:
+            raise ValueError("Correlation mode {} is not valid.".format(mode))
+
+        fixed_mask = np.array(mask, dtype=np.bool)
+        self.dtype = dtype = _float_dtype(dtype)
+        moving_image = np.array(reference, dtype=dtype)
+        moving_mask = np.array(reference_mask, dtype=np.bool)
+
+        # Axes are counted from the end, so that stacks of arrays 
+        # (i.e. with additional leading dimensions) can be correlated as well
+        ndim = fixed_mask.ndim
+        axes = tuple(ax % ndim - ndim for ax in axes)
+
+        # Array dimensions along non-transformation axes should be equal.
+        all_axes = set(range(-ndim, 0))
+        for axis in (all_axes - set(axes)):
+            if fixed_mask.shape[axis] != moving_image.shape[axis]:
+                raise ValueError(
+                    'Array shapes along non-transformation axes should be \
+                        equal, but dimensions along axis {a} not'.format(a=axis))
+        
+        self.axes = axes
+        self.max_shift = max_shift
+        self._invalid = np.logical_not(fixed_mask)
+        if max_shift is not None:
+            self._init_window(moving_image, moving_mask, overlap_ratio)
+            return
+
+        # Determine final size along transformation axes
+        # Note that it might be faster to conmpute Fourier transform in a slightly
+        # larger shape (`fast_shape`) Then, after all fourier transforms are done,
+        # we slice back to `final_shape`.
+        final_shape = list(fixed_mask.shape)
+        for axis in axes:
+            final_shape[axis] = fixed_mask.shape[axis] + \
+                moving_image.shape[axis] - 1
+        # Extent transform axes to the next fast length (i.e. multiple of 3, 5, or 7)
+        fast_shape = tuple([next_fast_len(final_shape[ax]) for ax in axes])
+
+        # Transforms leave non-transform axes unchanged
+        # E.g. arr shape (2,3,7), transform along axes (0, 1) with shape (4,4)
+        # results in arr_fft shape (4,4, 7)
+        # The implementation of Fourier transforms is determined by `set_fft_backend`.
+        # All arrays are real; real-to-complex transforms only compute half of the
+        # spectrum, which halves the time and memory spent on Fourier transforms.
+        self._fast_shape = fast_shape
+        self._fft = fft = partial(rfftn, s=fast_shape, axes=axes)
+        self._ifft = ifft = partial(irfftn, s=fast_shape, axes=axes)
+
+        # Element-wise operations commute with slicing; therefore, all
+        # arrays can be sliced back to the expected convolution shape
+        # as soon as they are transformed back.
+        # In 'same' mode, the output is centered with respect to the 'full' output.
+        if mode == 'same':
+            self._origin = np.array([(final_shape[ax] - fixed_mask.shape[ax]) // 2 for ax in axes])
+            output_shape = [fixed_mask.shape[ax] for ax in axes]
+        else:
+            self._origin = np.zeros(shape = (len(axes),), dtype = np.int)
+            output_shape = [final_shape[ax] for ax in axes]
+        
+        output_slice = [slice(None, None)] * ndim
+        for axis, start, size in zip(axes, self._origin, output_shape):
+            output_slice[axis] = slice(start, start + size)
+        self._output_slice = (Ellipsis,) + tuple(output_slice)
+
+        moving_image[np.logical_not(moving_mask)] = 0.0
+
+        # N-dimensional analog to rotation by 180deg is flip over all relevant axes
+        # See [1] for discussion.
+        rotated_moving_image = _flip(moving_image, axes=axes)
+        rotated_moving_mask = _flip(moving_mask, axes=axes)
+
+        self._rotated_moving_fft = rotated_moving_fft = fft(rotated_moving_image)
+        self._rotated_moving_mask_fft = fft(rotated_moving_mask.astype(dtype))
+        self._fixed_mask_fft = fixed_mask_fft = fft(fixed_mask.astype(dtype))
+
+        # Calculate overlap of masks at every point in the convolution
+        # Locations with high overlap should not be taken into account.
+        number_overlap_masked_px = ifft(self._rotated_moving_mask_fft * fixed_mask_fft)
+        number_overlap_masked_px[:] = np.round(number_overlap_masked_px)
+        number_overlap_masked_px[:] = np.fmax(number_overlap_masked_px, EPS)
+        self._number_overlap_masked_px = self._crop(number_overlap_masked_px)
+
+        masked_correlated_rotated_moving_fft = ifft(
+            fixed_mask_fft * rotated_moving_fft)
+        
+        self._rotated_moving_squared_fft = rotated_moving_squared_fft = fft(np.square(rotated_moving_image))
+        moving_denom = ifft(fixed_mask_fft * rotated_moving_squared_fft)
+        moving_denom -= np.square(masked_correlated_rotated_moving_fft) / \
+            number_overlap_masked_px
+        moving_denom[:] = np.fmax(moving_denom, 0.0)
+
+        self._masked_correlated_rotated_moving_fft = self._crop(masked_correlated_rotated_moving_fft)
+        self._moving_denom = self._crop(moving_denom)
+
+        # Apply overlap ratio threshold
+        number_px_threshold = overlap_ratio * np.max(self._number_overlap_masked_px,
+                                                     axis=axes, keepdims=True)
+        self._low_overlap = self._number_overlap_masked_px < number_px_threshold
+
+        # Cached ratio used to correct every correlation for the mean of the reference
+        self._moving_mean = self._masked_correlated_rotated_moving_fft / self._number_overlap_masked_px
+
+        # Approximate memory footprint of the correlation of a single array,
+        # dominated by complex intermediate arrays of half the transform size.
+        self._nbytes = 8 * dtype.itemsize * int(np.prod(fast_shape))
+    
+    def __call__(self, arr):
+        """
+        Masked normalized cross-correlation between an array and the reference.
+
+        Parameters
+        ----------
+        arr : ndarray
+            Array to be correlated with the reference. This is the first array (``arr1``) in :func:`mnxc`.
+            Its shape should be the shape of the mask. Stacks of arrays, with additional leading dimensions, 
+            are correlated all at once.
+        
+        Returns
+        -------
+        out : ndarray
+            Masked normalized cross-correlation. For stacks of arrays, the correlation of each array
+            is stacked along the leading dimensions.
+        """
+        if self.max_shift is not None:
+            return self._correlate_window(arr)
+        return self._correlate(*self._spectra(arr))
+    
+    def _init_window(self, moving_image, moving_mask, overlap_ratio):
+        """ 
+        Precompute the reference-side sums for the correlation restricted to small shifts. 
+        
+        For every shift, the correlation is computed directly from sums over the 
+        overlapping regions of the arrays, rather than from Fourier transforms.
+        """
+        fixed_mask = np.logical_not(self._invalid).astype(self.dtype)
+        ndim, max_shift = fixed_mask.ndim, self.max_shift
+        moving_image[np.logical_not(moving_mask)] = 0.0
+        self._moving_mask = moving_mask.astype(self.dtype)
+        self._moving_image = moving_image
+
+        # Sums over the transformation axes only; other axes are preserved.
+        # Leading dimensions of stacks of arrays are also preserved
+        letters = ascii_letters[:ndim]
+        kept = ''.join(letter for axis, letter in zip(range(-ndim, 0), letters) if axis not in self.axes)
+        self._sum = partial(np.einsum, '...{0},{0}->...{1}'.format(letters, kept))
+
+        # For every shift, the overlapping regions of the arrays are determined, as well as
+        # where the result should be stored in the output
+        window = range(-max_shift, max_shift + 1)
+        self._window = list()
+        for shift in product(window, repeat = len(self.axes)):
+            fixed_slice, moving_slice = [slice(None, None)] * ndim, [slice(None, None)] * ndim
+            output_index = [slice(None, None)] * ndim
+            for axis, offset in zip(self.axes, shift):
+                fixed_slice[axis] = slice(max(0, offset), min(fixed_mask.shape[axis], moving_image.shape[axis] + offset))
+                moving_slice[axis] = slice(max(0, -offset), min(fixed_mask.shape[axis] - offset, moving_image.shape[axis]))
+                output_index[axis] = offset + max_shift
+            self._window.append(((Ellipsis,) + tuple(fixed_slice), tuple(moving_slice), (Ellipsis,) + tuple(output_index)))
+        
+        output_shape = list(fixed_mask.shape)
+        for axis in self.axes:
+            output_shape[axis] = 2 * max_shift + 1
+        self._output_shape = tuple(output_shape)
+
+        number_overlap_masked_px = np.empty(shape = self._output_shape, dtype = self.dtype)
+        masked_correlated_moving = np.empty_like(number_overlap_masked_px)
+        moving_squared = np.empty_like(number_overlap_masked_px)
+        for fixed_slice, moving_slice, output_index in self._window:
+            number_overlap_masked_px[output_index] = self._sum(fixed_mask[fixed_slice], self._moving_mask[moving_slice])
+            masked_correlated_moving[output_index] = self._sum(fixed_mask[fixed_slice], moving_image[moving_slice])
+            moving_squared[output_index] = self._sum(fixed_mask[fixed_slice], np.square(moving_image[moving_slice]))
+        
+        number_overlap_masked_px[:] = np.fmax(number_overlap_masked_px, EPS)
+        self._number_overlap_masked_px = number_overlap_masked_px
+        self._masked_correlated_rotated_moving = masked_correlated_moving
+        self._moving_denom = np.fmax(moving_squared - np.square(masked_correlated_moving) / number_overlap_masked_px, 0.0)
+
+        # Apply overlap ratio threshold
+        number_px_threshold = overlap_ratio * np.max(number_overlap_masked_px, axis=self.axes, keepdims=True)
+        self._low_overlap = number_overlap_masked_px < number_px_threshold
+
+        # Approximate memory footprint of the correlation of a single array,
+        # dominated by copies of the array.
+        self._nbytes = 3 * self.dtype.itemsize * fixed_mask.size
+    
+    def _correlate_window(self, arr):
+        """ Masked normalized cross-correlation restricted to small shifts. """
+        fixed_image = np.array(arr, dtype=self.dtype)
+        if fixed_image.shape[fixed_image.ndim - self._invalid.ndim:] != self._invalid.shape:
+            raise ValueError('Array of shape {} cannot be correlated with a mask of shape {}'.format(
+                fixed_image.shape, self._invalid.shape))
+        fixed_image[..., self._invalid] = 0.0
+        fixed_squared = np.square(fixed_image)
+
+        shape = fixed_image.shape[:fixed_image.ndim - self._invalid.ndim] + self._output_shape
+        masked_correlated_fixed = np.empty(shape = shape, dtype = self.dtype)
+        correlated = np.empty_like(masked_correlated_fixed)
+        fixed_squared_sum = np.empty_like(masked_correlated_fixed)
+        for fixed_slice, moving_slice, output_index in self._window:
+            masked_correlated_fixed[output_index] = self._sum(fixed_image[fixed_slice], self._moving_mask[moving_slice])
+            correlated[output_index] = self._sum(fixed_image[fixed_slice], self._moving_image[moving_slice])
+            fixed_squared_sum[output_index] = self._sum(fixed_squared[fixed_slice], self._moving_mask[moving_slice])
+        
+        numerator = correlated - masked_correlated_fixed * \
+            self._masked_correlated_rotated_moving / self._number_overlap_masked_px
+        fixed_denom = fixed_squared_sum - np.square(masked_correlated_fixed) / self._number_overlap_masked_px
+        fixed_denom[:] = np.fmax(fixed_denom, 0.0)
+
+        denom = np.sqrt(fixed_denom * self._moving_denom)
+
+        # Pixels where `denom` is very small will introduce large
+        # numbers after division To get around this problem,
+        # we zero-out problematic pixels.
+        tol = 1e3 * np.finfo(self.dtype).eps * np.max(np.abs(denom), axis=self.axes, keepdims=True)
+        nonzero_indices = denom > tol
+
+        out = np.zeros_like(denom)
+        out[nonzero_indices] = numerator[nonzero_indices] / denom[nonzero_indices]
+        np.clip(out, a_min=-1, a_max=1, out=out)
+
+        out[..., self._low_overlap] = 0.0
+        return out
+    
+    def _crop(self, arr):
+        """ Slice an array back to the expected convolution shape. """
+        return arr[self._output_slice]
+
+    def _spectra(self, arr):
+        """ Fourier transforms of the masked array, and of its square. """
+        fixed_image = np.array(arr, dtype=self.dtype)
+        if fixed_image.shape[fixed_image.ndim - self._invalid.ndim:] != self._invalid.shape:
+            raise ValueError('Array of shape {} cannot be correlated with a mask of shape {}'.format(
+                fixed_image.shape, self._invalid.shape))
+        fixed_image[..., self._invalid] = 0.0
+        return self._fft(fixed_image), self._fft(np.square(fixed_image))
+    
+    def _correlate(self, fixed_fft, fixed_squared_fft):
+        """ Masked normalized cross-correlation from the spectra of an array. """
+        ifft, crop = self._ifft, self._crop
+
+        # Products of spectra are all computed in the same buffer, and
+        # intermediate results are updated in-place, to limit memory usage.
+        product = np.multiply(self._rotated_moving_mask_fft, fixed_fft)
+        masked_correlated_fixed = crop(ifft(product))
+
+        np.multiply(self._rotated_moving_fft, fixed_fft, out = product)
+        numerator = crop(ifft(product))
+        numerator -= masked_correlated_fixed * self._moving_mean
+
+        np.multiply(self._rotated_moving_mask_fft, fixed_squared_fft, out = product)
+        denom = crop(ifft(product))
+        del product
+
+        np.square(masked_correlated_fixed, out = masked_correlated_fixed)
+        masked_correlated_fixed /= self._number_overlap_masked_px
+        denom -= masked_correlated_fixed
+        del masked_correlated_fixed
+
+        np.fmax(denom, 0.0, out = denom)
+        denom *= self._moving_denom
+        np.sqrt(denom, out = denom)
+
+        # Pixels where `denom` is very small will introduce large
+        # numbers after division To get around this problem,
+        # we zero-out problematic pixels.
+        tol = 1e3 * np.finfo(self.dtype).eps * np.max(np.abs(denom), axis=self.axes, keepdims=True)
+        zero_indices = denom <= tol
+
+        denom[zero_indices] = 1.0
+        numerator /= denom
+        numerator[zero_indices] = 0.0
+        np.clip(numerator, a_min=-1, a_max=1, out=numerator)
+
+        numerator[..., self._low_overlap] = 0.0
+        # Some FFT backends always compute in double precision
+        return numerator.astype(self.dtype, copy = False)
+    
+    def _refine(self, fixed_fft, fixed_squared_fft, location, upsample_factor):
+        """ 
+        Refine the location of the correlation maximum of a single array to 1/`upsample_factor` of a pixel. 
+        
+        The correlation is only evaluated in a neighborhood of 1.5 pixels around `location`, 
+        by upsampling every term of the correlation with matrix-multiply discrete Fourier
+        transforms [#]_. For large upsampling factors, the neighborhood is first searched on a coarser grid.
+
+        References
+        ----------
+        .. [#] Manuel Guizar-Sicairos, Samuel T. Thurman, and James R. Fienup, 
+            "Efficient subpixel image registration algorithms," Optics Letters 33, 156-158 (2008).
+        """
+        # Pairs of spectra whose products are the terms of the correlation
+        terms = [(self._rotated_moving_mask_fft, self._fixed_mask_fft),
+                 (self._rotated_moving_mask_fft, fixed_fft),
+                 (self._fixed_mask_fft, self._rotated_moving_fft),
+                 (self._rotated_moving_fft, fixed_fft),
+                 (self._rotated_moving_mask_fft, fixed_squared_fft),
+                 (self._fixed_mask_fft, self._rotated_moving_squared_fft)]
+
+        # The search region is 1.5 pixels wide at the first stage, and 1.5 steps 
+        # of the previous stage afterwards.
+        location = np.asarray(location, dtype = np.float)
+        coarse_factor = int(np.ceil(np.sqrt(upsample_factor)))
+        stages = [(1.5, coarse_factor), (1.5 / coarse_factor, upsample_factor)] if coarse_factor > 2 else [(1.5, upsample_factor)]
+        for width, factor in stages:
+            # Sampling is aligned with the grid of the final precision
+            location = np.round(location * factor) / factor
+            region_size = 2 * int(np.ceil(width * factor / 2)) + 1
+            offsets = (np.arange(region_size) - region_size // 2) / factor
+            coordinates = [loc + origin + offsets for loc, origin in zip(location, self._origin)]
+
+            (number_overlap_masked_px, masked_correlated_fixed, masked_correlated_rotated_moving, 
+                correlated, fixed_squared, rotated_moving_squared) = (_upsampled_irfft(spec1 * spec2, coordinates, self.axes, self._fast_shape) 
+                                                                      for spec1, spec2 in terms)
+            
+            # Contrary to the integer-pixel correlation, the number of overlapping
+            # pixels is not rounded, since it is interpolated between pixels
+            number_overlap_masked_px = np.fmax(number_overlap_masked_px, EPS)
+            numerator = correlated - masked_correlated_fixed * masked_correlated_rotated_moving / number_overlap_masked_px
+            fixed_denom = np.fmax(fixed_squared - np.square(masked_correlated_fixed) / number_overlap_masked_px, 0)
+            moving_denom = np.fmax(rotated_moving_squared - np.square(masked_correlated_rotated_moving) / number_overlap_masked_px, 0)
+            denom = np.fmax(np.sqrt(fixed_denom * moving_denom), EPS)
+            
+            upsampled = numerator / denom
+            maximum = np.unravel_index(np.argmax(upsampled), upsampled.shape)
+            location = location + offsets[np.array(maximum)]
+        
+        return location
+
+def _upsampled_irfft(spectrum, coordinates, axes, shape):
+    """ 
+    Inverse real discrete Fourier transform of `spectrum` evaluated at arbitrary, e.g. 
+    fractional, coordinates along `axes`. `coordinates` is an iterable of 1D arrays, one 
+    per axis, and `shape` is the shape of the real transform along `axes`. The transform is 
+    computed by matrix multiplication, which is efficient when few coordinates are requested. 
+
+    As with ``numpy.fft.rfftn``, `spectrum` only holds the non-negative frequencies
+    along the last axis of `axes`.
+    """
+    out = spectrum
+    for axis, coords, size in zip(axes[:-1], coordinates, shape):
+        kernel = np.exp(2j * np.pi * np.outer(coords, np.fft.fftfreq(size)))
+        out = np.moveaxis(np.tensordot(kernel, out, axes = (1, axis)), 0, axis)
+    
+    # Negative frequencies along the last axis are the complex conjugates of the 
+    # positive frequencies, which are therefore counted twice.
+    axis, coords, size = axes[-1], coordinates[-1], shape[-1]
+    frequencies = np.arange(out.shape[axis])
+    weights = np.full_like(frequencies, fill_value = 2, dtype = np.float)
+    weights[0] = 1
+    if size % 2 == 0:
+        weights[-1] = 1
+    kernel = weights * np.exp(2j * np.pi * np.outer(coords, frequencies / size))
+    out = np.moveaxis(np.tensordot(kernel, out, axes = (1, axis)), 0, axis)
+    return np.real(out) / np.prod(shape)
 
 def _centered(arr, newshape, axes):
     """ Return the center `newshape` portion of `arr`, leaving axes not
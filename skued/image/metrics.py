@@ -3,13 +3,21 @@
 Image mask routines
 ===================
 """
+import warnings
 from collections import Iterable
-from itertools import repeat
+from functools import partial
+from tempfile import TemporaryFile
 
 import numpy as np
 
 # array_stream decorator ensures that input images are cast to ndarrays
-from npstreams import array_stream, imean, iprod, istd, itercopy, last, peek
+from npstreams import array_stream, iprod, last, peek
+
+from ..utils import bounded_pmap
+
+# Memory budgets of chunked computations account for temporary arrays, which take 
+# about four double-precision values per element, no matter the array dtype
+_BYTES_PER_ELEMENT = 32
 
 
 @array_stream
@@ -36,10 +44,13 @@ def isnr(images, fill_value = 0.0):
     first, images = peek(images)
     snr = np.empty_like(first)
 
-    images1, images2 = itercopy(images, 2)
-    for mean, std in zip(imean(images1), istd(images2)):
+    # Mean and standard deviation are computed in a single pass over the images
+    statistics = PixelStatistics()
+    for image in images:
+        statistics.update(image)
+        std = statistics.std
         valid = std != 0
-        snr[valid] = mean[valid] / std[valid]
+        snr[valid] = statistics.mean[valid] / std[valid]
         snr[np.logical_not(valid)] = fill_value
         yield snr
 
@@ -70,8 +81,147 @@ def snr_from_collection(images, fill_value = 0.0):
     See Also
     --------
     isnr : streaming signal-to-noise ratio
+    PixelStatistics : mergeable statistics of collections of images, e.g. split across many files.
+    """
+    return PixelStatistics(images).snr(fill_value = fill_value)
+
+def average_from_collection(images, estimator = 'median', sigma = 3, max_iter = 5, max_memory = 2**28, processes = 1):
+    """
+    Pixelwise robust average of a collection of images, e.g. repeated scans. The collection is processed
+    in tiles of rows, so that the full collection of images never needs to be in memory. 
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    images : iterable of ndarray, or ndarray
+        These images should represent identical measurements. ``images`` can also be a generator, in which case
+        images are first written to a temporary file. Stacks of images along the first axis, including 
+        memory-mapped arrays, are read directly.
+    estimator : {'mean', 'median', 'sigma-clip'}, optional
+        Estimator of the average of every pixel. 'sigma-clip' is the mean of values which are within 
+        ``sigma`` standard deviations of the mean of their pixel, determined iteratively.
+    sigma : float, optional
+        Number of standard deviations beyond which values are rejected, for ``estimator = 'sigma-clip'``.
+    max_iter : int, optional
+        Maximum number of sigma-clipping iterations, for ``estimator = 'sigma-clip'``. 
+    max_memory : int, optional
+        Approximate memory budget, in bytes, for every tile. At least one row of every image is read at a time.
+        With ``processes`` greater than one, up to twice as many tiles as processes are in flight.
+    processes : int or None, optional
+        Number of processes to use. If `None`, all available CPUs are used. Default is one,
+        in which case tiles are processed in the current process.
+    
+    Returns
+    -------
+    average : `~numpy.ndarray`, dtype float
+        Pixelwise average, according to ``estimator``.
+    std : `~numpy.ndarray`, dtype float
+        Pixelwise standard deviation. For ``estimator = 'sigma-clip'``, only values that were 
+        not rejected are taken into account.
+    counts : `~numpy.ndarray`, dtype int
+        Number of values used for every pixel. Non-finite values are ignored.
+    
+    Raises
+    ------
+    ValueError : if the estimator is invalid, or if images do not have the same shape.
+
+    See Also
+    --------
+    PixelStatistics : mergeable statistics of collections of images, e.g. split across many files.
+    """
+    if estimator not in {'mean', 'median', 'sigma-clip'}:
+        raise ValueError('Estimator {} is not valid.'.format(estimator))
+    
+    kernel = partial(_pixel_statistics, estimator = estimator, sigma = sigma, max_iter = max_iter)
+
+    if isinstance(images, np.ndarray):
+        return _tiled(kernel, images, max_memory = max_memory, processes = processes)
+
+    # Streams of images can only be read once; tiles are read from a temporary file
+    with TemporaryFile() as tmp:
+        return _tiled(kernel, _spill(images, tmp), max_memory = max_memory, processes = processes)
+
+def _spill(images, tmp):
+    """ Write a stream of images to a file, and map the file as a stack of images. """
+    first, images = peek(iter(images))
+    first = np.asarray(first)
+
+    count = 0
+    for image in images:
+        image = np.asarray(image)
+        if image.shape != first.shape:
+            raise ValueError('Image of shape {} does not match images of shape {}'.format(image.shape, first.shape))
+        tmp.write(np.ascontiguousarray(image, dtype = first.dtype).tobytes())
+        count += 1
+    tmp.flush()
+
+    return np.memmap(tmp, dtype = first.dtype, mode = 'r', shape = (count,) + first.shape)
+
+def _tiled(kernel, stack, max_memory, processes):
+    """ 
+    Apply a kernel to tiles of rows of a stack of images. The kernel reduces the first axis of
+    a tile, and returns a tuple of arrays. 
     """
-    return last(isnr(images, fill_value = fill_value))
+    if stack.ndim < 2:
+        raise ValueError('Expected a stack of images, but received an array of shape {}'.format(stack.shape))
+    
+    rowsize = _BYTES_PER_ELEMENT * stack.shape[0] * int(np.prod(stack.shape[2:], dtype = np.int))
+    rows = max(1, int(max_memory // max(rowsize, 1)))
+    starts = range(0, stack.shape[1], rows)
+    tiles = (stack[:, start:start + rows] for start in starts)
+
+    if processes == 1:
+        results = map(kernel, tiles)
+    else:
+        results = bounded_pmap(kernel, tiles, processes = processes)
+    
+    outputs = None
+    for start, values in zip(starts, results):
+        if outputs is None:
+            outputs = tuple(np.empty(stack.shape[1:], dtype = value.dtype) for value in values)
+        for output, value in zip(outputs, values):
+            output[start:start + rows] = value
+    return outputs
+
+def _pixel_statistics(tile, estimator, sigma, max_iter):
+    """ Pixelwise average, standard deviation and counts of a tile of a stack of images, along the first axis. """
+    values = np.array(tile, dtype = np.float, copy = True)
+    valid = np.isfinite(values)
+    keep = valid
+    average, std, counts = _pixel_moments(values, keep)
+
+    if estimator == 'median':
+        values[np.logical_not(valid)] = np.nan
+        with warnings.catch_warnings():
+            # Pixels without valid values
+            warnings.simplefilter('ignore', category = RuntimeWarning)
+            average = np.nanmedian(values, axis = 0)
+        average[counts == 0] = 0
+
+    elif estimator == 'sigma-clip':
+        for _ in range(max_iter):
+            clipped = np.abs(values - average, where = valid, out = np.zeros_like(values)) <= sigma * std
+            clipped &= valid
+            if np.array_equal(clipped, keep):
+                break
+            keep = clipped
+            average, std, counts = _pixel_moments(values, keep)
+
+    return average, std, counts
+
+def _pixel_moments(values, keep):
+    """ Mean, standard deviation and number of the values to keep, along the first axis. """
+    counts = np.count_nonzero(keep, axis = 0)
+    norm = 1 / np.maximum(counts, 1)
+    kept = np.where(keep, values, 0)
+    mean = np.sum(kept, axis = 0) * norm
+
+    # Two-pass variance is more accurate than the difference of squares
+    np.subtract(values, mean, out = kept, where = keep)
+    kept *= kept
+    std = np.sqrt(np.sum(kept, axis = 0) * norm)
+    return mean, std, counts
 
 @array_stream
 def mask_from_collection(images, px_thresh = (0, 3e4), std_thresh = None):
@@ -94,44 +244,378 @@ def mask_from_collection(images, px_thresh = (0, 3e4), std_thresh = None):
         are rejected. If ``px_thresh`` is a single float, it is assumed to be the maximal intensity, and no lower
         bound is enforced.
     std_thresh : int or float or None, optional
-        Standard-deviation threshold. If the standard deviation of a pixel exceeds ``std_thresh``, 
-        it is rejected. If None (default), a threshold is not enforced.
+        Standard-deviation threshold. If the cumulative standard deviation of a pixel, i.e. the standard 
+        deviation of the first images, exceeds ``std_thresh`` at any point in ``images``, it is rejected. 
+        If None (default), a threshold is not enforced.
     
     Returns
     -------
     mask : `~numpy.ndarray`, dtype bool
         Pixel mask. Pixels where ``mask`` is True are invalid.
     
+    See Also
+    --------
+    PixelStatistics : mergeable statistics of collections of images, e.g. split across many files.
+
     Notes
     -----
     ``numpy.inf`` can be used to have a lower pixel value bound but no upper bound. For example, to
     reject all negative pixels only, set ``px_thresh = (0, numpy.inf)``.
     """
+    return PixelStatistics(images).mask(px_thresh = px_thresh, std_thresh = std_thresh)
+
+class PixelStatistics:
+    """
+    Pixelwise statistics (number of images, mean, variance, minimum and maximum) of a collection of images, 
+    computed in a single pass with Welford's online algorithm [#]_.
+
+    Statistics of different collections can be merged [#]_, for example to reduce chunks of a large dataset 
+    in parallel, or to add a new scan to the statistics of previous scans without reading them again. 
+    Instances can be pickled, e.g. to be returned from worker processes.
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    images : iterable of ndarray or None, optional
+        Images of the same shape. ``images`` can also be a generator. If None (default),
+        statistics are empty until images are added with :meth:`update` or :meth:`extend`.
+    
+    Attributes
+    ----------
+    count : int
+        Number of images.
+    mean : `~numpy.ndarray`, dtype float, or None
+        Pixelwise mean.
+    m2 : `~numpy.ndarray`, dtype float, or None
+        Pixelwise sum of squared deviations from the mean.
+    minimum, maximum : `~numpy.ndarray` or None
+        Pixelwise extrema. NaNs are ignored.
+    max_variance : `~numpy.ndarray` or None
+        Pixelwise maximum of the cumulative variance, i.e. of the variance of the first images, 
+        over the collection. For merged statistics, this is the maximum of the cumulative variances 
+        of every collection, and of the variance of the merged collection.
+
+    See Also
+    --------
+    snr_from_collection : pixelwise signal-to-noise ratio from a collection of measurements.
+    mask_from_collection : determine binary mask from a collection of measurements.
+
+    Examples
+    --------
+    Statistics of groups of files can be computed in parallel and merged. The function
+    mapped over groups of files should be defined at the top level of a module, so that it can be pickled:
+
+    >>> from functools import reduce
+    >>> from multiprocessing import Pool
+    >>> def file_statistics(filenames):
+    ...     return PixelStatistics(diffread(f) for f in filenames)
+    >>> groups = [files[i::4] for i in range(4)]                        # doctest: +SKIP
+    >>> with Pool(4) as pool:                                           # doctest: +SKIP
+    ...     partials = pool.map(file_statistics, groups)                # doctest: +SKIP
+    >>> statistics = reduce(PixelStatistics.merge, partials)            # doctest: +SKIP
+    >>> mask = statistics.mask(px_thresh = 3e4, std_thresh = 100)       # doctest: +SKIP
+
+    References
+    ----------
+    .. [#] B. P. Welford, Note on a method for calculating corrected sums of squares and products, 
+        Technometrics 4 (3), pp. 419-420 (1962).
+    .. [#] T. F. Chan, G. H. Golub and R. J. LeVeque, Updating Formulae and a Pairwise Algorithm for 
+        Computing Sample Variances, Technical Report STAN-CS-79-773, Stanford University (1979).
+    """
+
+    def __init__(self, images = None):
+        self.count = 0
+        self.mean = self.m2 = self.minimum = self.maximum = self.max_variance = None
+        if images is not None:
+            self.extend(images)
+    
+    def __getstate__(self):
+        # Temporary buffers are not worth transferring between processes
+        state = dict(self.__dict__)
+        state.pop('_buffers', None)
+        return state
+    
+    @property
+    def variance(self):
+        """ Pixelwise variance. """
+        return self.m2 / self.count
+    
+    @property
+    def std(self):
+        """ Pixelwise standard deviation. """
+        return np.sqrt(self.variance)
+
+    def update(self, image):
+        """
+        Add an image to the statistics.
+
+        Parameters
+        ----------
+        image : array_like
+            Image. It should have the same shape as previous images.
+        
+        Returns
+        -------
+        self : PixelStatistics
+        
+        Raises
+        ------
+        ValueError : if the image shape does not match previous images.
+        """
+        image = np.asarray(image)
+        if self.count == 0:
+            self.count = 1
+            self.mean = np.array(image, dtype = np.float)
+            self.m2 = np.zeros_like(self.mean)
+            self.max_variance = np.zeros_like(self.mean)
+            self.minimum, self.maximum = np.array(image, copy = True), np.array(image, copy = True)
+            return self
+        
+        if image.shape != self.mean.shape:
+            raise ValueError('Image of shape {} does not match statistics of shape {}'.format(image.shape, self.mean.shape))
+
+        # Buffers for deviations from the mean, before and after the update
+        if not hasattr(self, '_buffers'):
+            self._buffers = np.empty_like(self.mean), np.empty_like(self.mean)
+        delta, delta2 = self._buffers
+
+        self.count += 1
+        np.subtract(image, self.mean, out = delta)
+        delta /= self.count
+        self.mean += delta
+        
+        # m2 += (image - old mean) * (image - new mean)
+        delta *= self.count
+        np.subtract(image, self.mean, out = delta2)
+        delta *= delta2
+        self.m2 += delta
+
+        np.divide(self.m2, self.count, out = delta)
+        np.fmax(self.max_variance, delta, out = self.max_variance)
+
+        np.fmin(self.minimum, image, out = self.minimum)
+        np.fmax(self.maximum, image, out = self.maximum)
+        return self
+    
+    def extend(self, images):
+        """
+        Add images to the statistics.
+
+        Parameters
+        ----------
+        images : iterable of ndarray
+            Images of the same shape as previous images. ``images`` can also be a generator.
+        
+        Returns
+        -------
+        self : PixelStatistics
+        """
+        for image in images:
+            self.update(image)
+        return self
+    
+    def merge(self, other):
+        """
+        Merge the statistics of another collection of images into these statistics, in-place.
+
+        Parameters
+        ----------
+        other : PixelStatistics
+            Statistics of images of the same shape. `other` is not modified.
+        
+        Returns
+        -------
+        self : PixelStatistics
+
+        Raises
+        ------
+        ValueError : if the image shape does not match.
+        """
+        if other.count == 0:
+            return self
+        
+        if self.count == 0:
+            self.count = other.count
+            self.mean, self.m2 = np.array(other.mean, copy = True), np.array(other.m2, copy = True)
+            self.minimum, self.maximum = np.array(other.minimum, copy = True), np.array(other.maximum, copy = True)
+            self.max_variance = np.array(other.max_variance, copy = True)
+            return self
+        
+        if other.mean.shape != self.mean.shape:
+            raise ValueError('Statistics of shape {} cannot be merged with statistics of shape {}'.format(
+                other.mean.shape, self.mean.shape))
+        
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 
+        self.m2 += np.square(delta, out = delta) * (self.count * other.count / count)
+        self.count = count
+
+        np.fmin(self.minimum, other.minimum, out = self.minimum)
+        np.fmax(self.maximum, other.maximum, out = self.maximum)
+        np.fmax(self.max_variance, other.max_variance, out = self.max_variance)
+        np.fmax(self.max_variance, self.variance, out = self.max_variance)
+        return self
+    
+    def snr(self, fill_value = 0.0):
+        """
+        Pixelwise signal-to-noise ratio. See :func:`snr_from_collection` for details.
+
+        Parameters
+        ----------
+        fill_value : float, optional
+            Division-by-zero results will be filled with this value.
+        
+        Returns
+        -------
+        snr : `~numpy.ndarray`
+            Pixelwise signal-to-noise ratio
+        """
+        std = self.std
+        valid = std != 0
+        snr = np.full_like(self.mean, fill_value = fill_value)
+        snr[valid] = self.mean[valid] / std[valid]
+        return snr
+    
+    def mask(self, px_thresh = (0, 3e4), std_thresh = None):
+        """
+        Binary mask of invalid pixels. See :func:`mask_from_collection` for details.
+
+        Parameters
+        ----------
+        px_thresh : float or iterable, optional
+            Pixels with a value outside of [``min(px_thresh)``, ``max(px_thresh)``] in any image
+            are rejected. If ``px_thresh`` is a single float, it is assumed to be the maximal intensity, and no lower
+            bound is enforced.
+        std_thresh : int or float or None, optional
+            Standard-deviation threshold. If the cumulative standard deviation of a pixel exceeds ``std_thresh`` 
+            at any point, it is rejected (see ``max_variance``). If None (default), a threshold is not enforced.
+        
+        Returns
+        -------
+        mask : `~numpy.ndarray`, dtype bool
+            Pixel mask. Pixels where ``mask`` is True are invalid.
+        """
+        if isinstance(px_thresh, Iterable):
+            min_int, max_int = min(px_thresh), max(px_thresh)
+        else:
+            min_int, max_int = None, px_thresh
+
+        mask = self.maximum > max_int
+        if min_int is not None:
+            mask |= self.minimum < min_int
+        
+        if std_thresh is not None:
+            mask |= np.sqrt(self.max_variance) > std_thresh
+        return mask
+
+@array_stream
+def ireject_outliers(images, window = 9, threshold = 5, hot_fraction = 0.1, px_thresh = (0, 3e4)):
+    """
+    Streaming detection and correction of per-frame outliers (e.g. cosmic rays, or zingers) and 
+    persistent hot pixels in a stream of images. Every image is compared to the pixelwise median 
+    and median absolute deviation (MAD) of the most recent images, in a single pass over ``images``.
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    images : iterable of ndarray
+        These images should represent identical measurements. ``images`` can also be a generator.
+    window : int, optional
+        Number of most recent images (including the current image) from which the pixelwise median and MAD
+        are computed. Memory usage is proportional to ``window``. The first ``window`` images are yielded
+        together, once ``window`` images have been read.
+    threshold : float, optional
+        Pixels that deviate from the running median by more than ``threshold`` standard deviations, above 
+        (e.g. cosmic rays) or below (e.g. dropouts), are outliers. The standard deviation is estimated from 
+        the MAD, and is at least the median standard deviation of all pixels.
+    hot_fraction : float, optional
+        Pixels which are outliers in more than ``hot_fraction`` of images so far are considered hot.
+        This criterion is only applied once ``window`` images have been processed, so that a single
+        outlier at the start of the stream does not make a pixel hot.
+    px_thresh : float or iterable, optional
+        Pixels with a running median outside of [``min(px_thresh)``, ``max(px_thresh)``] are considered hot (or dead). 
+        If ``px_thresh`` is a single float, it is assumed to be the maximal intensity, and no lower bound is enforced.
+
+    Yields
+    ------
+    corrected : `~numpy.ndarray`, dtype float
+        Image in which outliers are replaced by the running median.
+    outliers : `~numpy.ndarray`, dtype bool
+        Outliers of the current image. 
+    hot : `~numpy.ndarray`, dtype bool
+        Hot pixels, determined from all images so far. Pixels where ``hot`` is True are invalid.
+
+    Raises
+    ------
+    ValueError : if ``window`` is smaller than 1.
+
+    See Also
+    --------
+    mask_from_collection : determine binary mask from a set of images.
+
+    Notes
+    -----
+    Pixels which are hot in most images shift the running median itself, and are therefore not outliers; 
+    such pixels are only flagged as hot based on ``px_thresh``.
+    """
+    window = int(window)
+    if window < 1:
+        raise ValueError('Window should contain at least one image, not {}'.format(window))
+    
     if isinstance(px_thresh, Iterable):
         min_int, max_int = min(px_thresh), max(px_thresh)
     else:
-        min_int, max_int = None, px_thresh
+        min_int, max_int = -np.inf, px_thresh
     
     first, images = peek(images)
-    mask = np.zeros_like(first, dtype = np.bool)    # 0 = False
 
-    if std_thresh is not None:
-        images, images_for_std = itercopy(images)
-        std_calc = istd(images_for_std)
-    else:
-        std_calc = repeat(np.inf)
+    # Most recent images are stored in a ring buffer
+    recent = np.empty((window,) + first.shape, dtype = np.float)
+    deviations = np.empty_like(recent)
+    counts = np.zeros(first.shape, dtype = np.int)
+    processed = 0
 
-    for image, std in zip(images, std_calc):
-        
-        mask[image > max_int] = True
-        
-        if std_thresh is not None:
-            mask[std > std_thresh] = True
+    def statistics(filled):
+        median = np.median(recent[:filled], axis = 0)
+        np.subtract(recent[:filled], median, out = deviations[:filled])
+        np.abs(deviations[:filled], out = deviations[:filled])
+        sigma = 1.4826 * np.median(deviations[:filled], axis = 0)
+        return median, np.maximum(sigma, np.median(sigma), out = sigma)
+    
+    def correct(image, median, sigma):
+        nonlocal processed
+        corrected = np.array(image, dtype = np.float, copy = True)
+        outliers = np.abs(corrected - median) > threshold * sigma
+        corrected[outliers] = median[outliers]
+        counts[:] += outliers
+        processed += 1
 
-        if min_int is not None:
-            mask[image < min_int] = True
+        hot = np.logical_or(median > max_int, median < min_int)
+        if processed >= window:
+            hot |= counts > hot_fraction * processed
+        return corrected, outliers, hot
+
+    # The first images are only corrected once the buffer is full, so that
+    # every image is compared to the statistics of ``window`` images. 
+    for index, image in enumerate(images):
+        recent[index % window] = image
+        if index + 1 == window:
+            median, sigma = statistics(window)
+            for buffered in recent:
+                yield correct(buffered, median, sigma)
+        elif index + 1 > window:
+            yield correct(image, *statistics(window))
     
-    return mask
+    # Streams shorter than the window
+    filled = index + 1
+    if filled < window:
+        median, sigma = statistics(filled)
+        for buffered in recent[:filled]:
+            yield correct(buffered, median, sigma)
 
 def combine_masks(*masks):
     """ 
@@ -176,60 +660,250 @@ def mask_image(image, mask, fill_value = 0, copy = True):
     image[mask] = fill_value
     return image
 
-def triml(array, percentile, axis = None, fill_value = 0):
+def triml(array, percentile, axis = None, fill_value = 0, method = 'exact', bins = 1024, max_memory = 2**28, out = None):
     """
     Trim values in an array that fall below (i.e. to the left) a certain percentile.
 
     Parameters
     ----------
     array : `~numpy.ndarray`
-        Array to be trimmed, typically an image.
+        Array to be trimmed, typically an image. Large arrays, including memory-mapped arrays,
+        can be trimmed in chunks with ``method = 'histogram'``.
     percentile : float in range [0, 100]
         Percentile below which array elements are set to ``fill_value``.
     axis : int or None, optional
         Axis along which to trim data. If None (default), compute over the whole array.
     fill_value : float, optional
         Trimmed array elements are replaced with this value.
+    method : str {'exact', 'histogram'}, optional
+        Percentile computation method. With 'exact' (default), the percentile is computed with
+        :func:`numpy.percentile`, which sorts a copy of ``array``. With 'histogram', the percentile 
+        is estimated in two passes over chunks of ``array`` (value range, then histogram), in bounded memory. 
+        The estimated percentile is within ``(max - min) / bins`` of the exact percentile.
+
+        .. versionadded:: 1.0.2
+    bins : int, optional
+        Number of histogram bins if ``method = 'histogram'``. One histogram of ``bins`` counts is 
+        accumulated for every lane along ``axis``.
+
+        .. versionadded:: 1.0.2
+    max_memory : int, optional
+        Approximate memory budget, in bytes, for the chunks of ``array`` read at once, and for
+        the histograms of lanes, if ``method = 'histogram'``. Chunks are taken along the first axis. 
+        If the histograms of all lanes do not fit in this budget, lanes are processed in groups, 
+        with one pass over ``array`` per group.
+
+        .. versionadded:: 1.0.2
+    out : `~numpy.ndarray` or None, optional
+        Array of the same shape as ``array``, in which to store the result. ``out`` can be ``array`` 
+        itself, or a memory-mapped array. If None (default), a new array is allocated.
+
+        .. versionadded:: 1.0.2
     
     Returns
     -------
     trimmed : `~numpy.ndarray`
         Trimmed array of the same shape as ``array``.
+    
+    Raises
+    ------
+    ValueError : if ``method`` is not valid.
 
     See Also
     --------
     trimr : trim values in percentiles above a specific percentile.
     """
-    array = np.array(array)
-    val_percentile = np.percentile(array, q = float(percentile), axis = axis, keepdims = True)
-    array[array < val_percentile] = fill_value
-    return array
+    return _trim(array, percentile, np.less, axis = axis, fill_value = fill_value, 
+                 method = method, bins = bins, max_memory = max_memory, out = out)
 
-def trimr(array, percentile, axis = None, fill_value = 0):
+def trimr(array, percentile, axis = None, fill_value = 0, method = 'exact', bins = 1024, max_memory = 2**28, out = None):
     """
     Trim values in an array that fall above (i.e. to the right) a certain percentile.
 
     Parameters
     ----------
     array : `~numpy.ndarray`
-        Array to be trimmed, typically an image.
+        Array to be trimmed, typically an image. Large arrays, including memory-mapped arrays,
+        can be trimmed in chunks with ``method = 'histogram'``.
     percentile : float in range [0, 100]
         Percentile above which array elements are set to ``fill_value``.
     axis : int or None, optional
         Axis along which to trim data. If None (default), compute over the whole array.
     fill_value : float, optional
         Trimmed array elements are replaced with this value.
+    method : str {'exact', 'histogram'}, optional
+        Percentile computation method. With 'exact' (default), the percentile is computed with
+        :func:`numpy.percentile`, which sorts a copy of ``array``. With 'histogram', the percentile 
+        is estimated in two passes over chunks of ``array`` (value range, then histogram), in bounded memory. 
+        The estimated percentile is within ``(max - min) / bins`` of the exact percentile.
+
+        .. versionadded:: 1.0.2
+    bins : int, optional
+        Number of histogram bins if ``method = 'histogram'``. One histogram of ``bins`` counts is 
+        accumulated for every lane along ``axis``.
+
+        .. versionadded:: 1.0.2
+    max_memory : int, optional
+        Approximate memory budget, in bytes, for the chunks of ``array`` read at once, and for
+        the histograms of lanes, if ``method = 'histogram'``. Chunks are taken along the first axis. 
+        If the histograms of all lanes do not fit in this budget, lanes are processed in groups, 
+        with one pass over ``array`` per group.
+
+        .. versionadded:: 1.0.2
+    out : `~numpy.ndarray` or None, optional
+        Array of the same shape as ``array``, in which to store the result. ``out`` can be ``array`` 
+        itself, or a memory-mapped array. If None (default), a new array is allocated.
+
+        .. versionadded:: 1.0.2
     
     Returns
     -------
     trimmed : `~numpy.ndarray`
         Trimmed array of the same shape as ``array``.
+    
+    Raises
+    ------
+    ValueError : if ``method`` is not valid.
 
     See Also
     --------
     triml : trim values in percentiles below a specific percentile.
     """
-    array = np.array(array)
-    val_percentile = np.percentile(array, q = float(percentile), axis = axis, keepdims = True)
-    array[array > val_percentile] = fill_value
-    return array
\ No newline at end of file
+    return _trim(array, percentile, np.greater, axis = axis, fill_value = fill_value, 
+                 method = method, bins = bins, max_memory = max_memory, out = out)
+
+def _trim(array, percentile, compare, axis, fill_value, method, bins, max_memory, out):
+    """ Set elements of ``array`` to ``fill_value`` where ``compare(array, percentile value)`` is True. """
+    if method not in {'exact', 'histogram'}:
+        raise ValueError('Percentile method {} is not valid.'.format(method))
+    
+    if method == 'exact':
+        array = np.array(array)
+        val_percentile = np.percentile(array, q = float(percentile), axis = axis, keepdims = True)
+        if out is None:
+            out = array
+        else:
+            out[:] = array
+        out[compare(array, val_percentile)] = fill_value
+        return out
+    
+    array = np.asanyarray(array)
+    if array.ndim == 0:
+        array = array.reshape((1,))
+    if out is None:
+        out = np.empty_like(array)
+    
+    # Chunks and lanes must agree on the reduced axis
+    axis = None if axis is None else axis % array.ndim
+    val_percentile = _histogram_percentile(array, float(percentile), axis = axis, bins = bins, max_memory = max_memory)
+    for rows, lanes in _chunks(array, axis, max_memory):
+        chunk = np.array(array[rows], copy = True)
+        chunk[compare(chunk, val_percentile[lanes])] = fill_value
+        out[rows] = chunk
+    return out
+
+def _chunks(array, axis, max_memory):
+    """ 
+    Generate slices of chunks of ``array`` along the first axis, and the matching slices of 
+    arrays reduced along ``axis`` with ``keepdims = True``.
+    """
+    chunksize = max(1, int(max_memory // (_BYTES_PER_ELEMENT * np.prod(array.shape[1:], dtype = np.int))))
+    for start in range(0, array.shape[0], chunksize):
+        rows = slice(start, start + chunksize)
+        # If the first axis is reduced, every chunk covers all lanes
+        lanes = slice(None) if axis in {None, 0} else rows
+        yield rows, lanes
+
+def _histogram_percentile(array, percentile, axis, bins, max_memory):
+    """
+    Estimate the percentile of an array along an axis, with ``keepdims = True``, from
+    a histogram accumulated over chunks of the array.
+    """
+    bins = int(bins)
+    if bins < 1:
+        raise ValueError('Number of bins should be a positive integer, not {}'.format(bins))
+    
+    if axis is not None:
+        lanes_shape = tuple(1 if dim == axis else n for dim, n in enumerate(array.shape))
+    else:
+        lanes_shape = (1,) * array.ndim
+    num_lanes = int(np.prod(lanes_shape))
+
+    # First pass : range of values, ignoring NaNs
+    lo = np.full(lanes_shape, fill_value = np.inf)
+    hi = np.full(lanes_shape, fill_value = -np.inf)
+    for rows, lanes in _chunks(array, axis, max_memory):
+        chunk = np.asarray(array[rows], dtype = np.float)
+        np.fmin(lo[lanes], np.fmin.reduce(chunk, axis = axis, keepdims = True), out = lo[lanes])
+        np.fmax(hi[lanes], np.fmax.reduce(chunk, axis = axis, keepdims = True), out = hi[lanes])
+    
+    width = (hi - lo) / bins
+    width[np.logical_not(width > 0)] = 1  # constant or empty lanes
+
+    # Second pass : histogram of every lane. The histograms of all lanes take memory ``num_lanes * bins``,
+    # which can be much larger than the array itself, so that lanes are processed in groups
+    # within the memory budget. Bin indices of a group are raveled together, so that 
+    # its histograms are accumulated with a single call to bincount per chunk.
+    lane_ids = np.arange(num_lanes).reshape(lanes_shape)
+    group = max(1, int(max_memory // (_BYTES_PER_ELEMENT * bins)))
+    lo, hi, width = lo.ravel(), hi.ravel(), width.ravel()
+    estimate = np.empty((num_lanes,), dtype = np.float)
+    for first in range(0, num_lanes, group):
+        last = min(first + group, num_lanes)
+        counts = np.zeros(((last - first) * bins,), dtype = np.int)
+        for rows, lanes in _chunks(array, axis, max_memory):
+            ids = lane_ids[lanes]
+            # Lane identifiers increase along the first axis
+            if (ids.flat[-1] < first) or (ids.flat[0] >= last):
+                continue
+
+            chunk = np.array(array[rows], dtype = np.float, copy = True)
+            valid = np.isfinite(chunk)
+            if (first > 0) or (last < num_lanes):
+                valid &= (ids >= first) & (ids < last)
+            chunk -= lo.reshape(lanes_shape)[lanes]
+            chunk /= width.reshape(lanes_shape)[lanes]
+            np.clip(chunk, 0, bins - 1, out = chunk)
+            chunk[np.logical_not(valid)] = 0
+            indices = chunk.astype(np.int)
+            indices += (ids - first) * bins
+            counts += np.bincount(indices[valid], minlength = counts.size)
+        
+        group_lanes = slice(first, last)
+        estimate[group_lanes] = _percentile_from_histogram(counts.reshape((last - first, bins)), percentile, 
+                                                           lo[group_lanes], hi[group_lanes], width[group_lanes])
+    return estimate.reshape(lanes_shape)
+
+def _percentile_from_histogram(counts, percentile, lo, hi, width):
+    """
+    Estimate the percentile of every lane from its histogram ``counts`` of shape (lanes, bins),
+    where bins of a lane start at ``lo`` and have width ``width``. Lanes without values are NaN.
+    """
+    num_lanes, bins = counts.shape
+
+    # The percentile is interpolated between the order statistics of neighboring ranks, 
+    # as in numpy.percentile. Every order statistic is known to lie within a bin.
+    total = counts.sum(axis = 1)
+    rank = percentile / 100 * np.maximum(total - 1, 0)
+    cumulative = np.cumsum(counts, axis = 1)
+
+    def order_statistic(k):
+        index = np.minimum(np.sum(cumulative <= k[:, None], axis = 1), bins - 1)
+        lanes = np.arange(num_lanes)
+        below = cumulative[lanes, index] - counts[lanes, index]
+        # Values are assumed to be spread uniformly within a bin
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fraction = np.clip((k - below + 0.5) / counts[lanes, index], 0, 1)
+        fraction[np.logical_not(np.isfinite(fraction))] = 0
+        value = np.clip(lo + width * (index + fraction), lo, hi)
+
+        # Extreme values are known exactly
+        value[k <= 0] = lo[k <= 0]
+        value[k >= total - 1] = hi[k >= total - 1]
+        return value
+    
+    floor = np.floor(rank)
+    lower, upper = order_statistic(floor), order_statistic(np.ceil(rank))
+    estimate = lower + (rank - floor) * (upper - lower)
+    estimate[total == 0] = np.nan
+    return estimate
@@ -6,17 +6,28 @@ Image manipulation of powder diffraction
 from functools import partial
 
 import numpy as np
+from scipy.sparse import csr_matrix, diags
 
-from ..utils import deprecated
-from .alignment import diff_register
+from npstreams import array_stream, peek
+
+from .correlation import mnxc
 
 flip = partial(np.rot90, k = 2)
 
-@deprecated('Unpredictable performance.')
-def powder_center(image, mask = None):
+# With an initial guess, only pixels within this distance (in pixels) of the guess are used
+_GUESS_HALFSIZE = 128
+
+def powder_center(image, mask = None, guess = None, max_iter = 10):
     """
-    Finds the center of a powder diffraction pattern by comparing the
-    correlation between the input and its image.
+    Finds the center of a powder diffraction pattern, i.e. its center of inversion symmetry.
+
+    The center is first estimated from the cross-correlation between a downsampled image and
+    its 180 degrees rotation. This estimate is then refined on successively finer images by 
+    comparing the image with its point reflection about candidate centers in the 
+    neighborhood of the current estimate. The center is determined up to half a pixel. 
+
+    .. versionchanged:: 1.0.2
+        Center-finding is now coarse-to-fine, and an initial guess can be provided.
 
     Parameters  
     ----------
@@ -26,6 +37,15 @@ def powder_center(image, mask = None):
         Mask of `image`. The mask should evaluate to `True`
         (or 1) on invalid pixels. If None (default), no mask
         is used.
+    guess : 2-tuple or None, optional
+        Initial guess of the center, in the same format as the returned center. If provided, 
+        the coarse search is skipped, and the center is refined from the guess using only the 
+        256 x 256 pixels around it. This takes a few milliseconds regardless of the size of the image, 
+        which is useful to track the drift of the center over many images, e.g. by passing the 
+        center found in the previous image. The guess should be within ``max_iter`` pixels of the center.
+    max_iter : int, optional
+        Maximum number of refinement steps at every resolution. Every step moves the estimate 
+        by at most half a pixel along each axis.
 
     Returns
     -------
@@ -34,16 +54,120 @@ def powder_center(image, mask = None):
         relevant for array manipulations (center = [row, column] instead of 
         center = [x,y]).
     """
+    image = np.asarray(image)
     if mask is None:
         mask = np.zeros_like(image, dtype = np.bool)
-    mask = np.asarray(mask, dtype = np.bool)
+    mask = np.asarray(mask)
+
+    # Close to the initial guess, only a neighborhood of the guess is needed
+    origin = np.zeros((2,))
+    if guess is not None:
+        guess = np.asarray(guess, dtype = np.float)
+        origin = np.maximum(np.rint(guess) - _GUESS_HALFSIZE, 0)
+        window = tuple(slice(int(start), int(start) + 2 * _GUESS_HALFSIZE) for start in origin)
+        image, mask = image[window], mask[window]
+        guess = guess - origin
 
-    composite_mask = np.logical_or(mask, flip(mask))
+    image = np.array(image, dtype = np.float)
+    valid = np.logical_not(np.asarray(mask, dtype = np.bool))
+
+    # Resolution pyramid of block sums, from finest to coarsest.
+    # The coarsest images are about 128 x 128
+    pyramid = [(image * valid, valid.astype(np.float))]
+    while min(pyramid[-1][0].shape) // 2 >= 128:
+        pyramid.append(tuple(map(_block_sum, pyramid[-1])))
+    
+    center = guess
+    for level, (sums, weights) in reversed(list(enumerate(pyramid))):
+        factor = 2**level
+        val = weights > 0
+        im = np.zeros_like(sums)
+        np.divide(sums, weights, out = im, where = val)
+
+        if center is None:
+            # Cross-correlation between the image and its 180deg rotation peaks at 
+            # twice the center.
+            xcorr = mnxc(im, flip(im), val, flip(val), mode = 'full', axes = (0, 1))
+            doubled = np.unravel_index(np.argmax(xcorr), xcorr.shape)
+        else:
+            # Pixel (i, j) of the downsampled image is centered on pixel 
+            # (i * factor + (factor - 1)/2, j * factor + (factor - 1)/2) of the original image
+            doubled = np.rint(2 * (center - (factor - 1) / 2) / factor).astype(np.int)
+        
+        doubled = _refine_doubled_center(im, val, doubled, max_iter = max_iter)
+        center = factor * np.asarray(doubled) / 2 + (factor - 1) / 2
+    
+    return tuple(center + origin)
+
+def _block_sum(arr):
+    """ Sum of 2 x 2 blocks of an array. Trailing rows and columns are dropped for odd shapes. """
+    nrows, ncols = 2 * (arr.shape[0] // 2), 2 * (arr.shape[1] // 2)
+    arr = arr[:nrows, :ncols]
+    return arr[0::2, 0::2] + arr[1::2, 0::2] + arr[0::2, 1::2] + arr[1::2, 1::2]
+
+def _refine_doubled_center(image, valid, doubled, max_iter, halfsize = 512):
+    """ 
+    Hill-climbing search for twice the center of inversion symmetry of an image, on the grid
+    of half-pixels. At every step, the estimate moves to the neighboring candidate with the
+    largest correlation between the image and its point reflection. Only pixels within ``halfsize``
+    of the candidate center are considered.
+    """
+    # Quantities which do not depend on the candidate center are computed once
+    weights = valid.astype(np.float)
+    masked = image * weights
+    squared = masked**2
+
+    scores = dict()
+    def score(candidate):
+        if candidate not in scores:
+            scores[candidate] = _reflection_correlation(masked, squared, weights, candidate, halfsize)
+        return scores[candidate]
+    
+    best = tuple(int(i) for i in doubled)
+    for _ in range(max_iter):
+        neighbors = [(best[0] + i, best[1] + j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+        candidate = max(neighbors, key = score)
+        if candidate == best:
+            break
+        best = candidate
+    return best
+
+def _reflection_correlation(masked, squared, weights, doubled, halfsize):
+    """ 
+    Normalized correlation between an image and its point reflection about the point ``doubled/2``. 
+    Only pixels which are valid both in the image and its reflection are taken into account.
+    Invalid pixels of ``masked`` and ``squared`` (the square of ``masked``) must be zero, 
+    and ``weights`` evaluates to 1 on valid pixels and 0 otherwise.
+    """
+    slices, reflected_slices = list(), list()
+    for size, d in zip(masked.shape, doubled):
+        # Pixel i is paired with pixel (d - i). Both must be in the image.
+        start = max(0, d - size + 1, int(np.ceil(d/2 - halfsize)))
+        stop = min(size, d + 1, int(np.floor(d/2 + halfsize)) + 1)
+        if stop - start < 2:
+            return -np.inf
+        slices.append(slice(start, stop))
+        reflected_slices.append(slice(d - stop + 1, d - start + 1))
+    
+    slices, reflected_slices = tuple(slices), tuple(reflected_slices)
+    a, a2, wa = (arr[slices] for arr in (masked, squared, weights))
+    b, b2, wb = (flip(arr[reflected_slices]) for arr in (masked, squared, weights))
 
-    shift = diff_register(image, flip(image), mask = composite_mask)
-    midpoints = np.array([int(axis_size / 2) for axis_size in image.shape])
+    # Sums over pixels which are valid in both the image and its reflection
+    # Note that einsum does not copy the (non-contiguous) reflected views
+    dot = partial(np.einsum, 'ij,ij->')
+    npx = dot(wa, wb)
+    if npx < 2:
+        return -np.inf
+    
+    sa, sb, sab = dot(a, wb), dot(b, wa), dot(a, b)
+    saa, sbb = dot(a2, wb), dot(b2, wa)
 
-    return tuple(shift[::-1]/2 + midpoints)
+    covariance = sab - sa * sb / npx
+    denom = np.sqrt(max(saa - sa**2 / npx, 0) * max(sbb - sb**2 / npx, 0))
+    if denom == 0:
+        return -np.inf
+    return covariance / denom
 
 def _angle_bounds(bounds):
     b1, b2 = bounds
@@ -57,15 +181,402 @@ def _angle_bounds(bounds):
         b2 -= 360
     return tuple(sorted((b1, b2)))
     
-def azimuthal_average(image, center, mask = None, angular_bounds = None, trim = True):
+class AzimuthalIntegrator:
+    """
+    Reusable azimuthal integration plan. The radial bin of every pixel, the number 
+    of valid pixels per bin and the normalization are computed once; integrating 
+    an image is then a single weighted histogram of its valid pixels. This is 
+    much faster than :func:`azimuthal_average` when many images share the same 
+    shape, center, mask and angular bounds, e.g. in a time-resolved experiment.
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    shape : 2-tuple of ints
+        Shape of the images to integrate.
+    center : array_like, shape (2,)
+        coordinates of the center (in pixels).
+    mask : `~numpy.ndarray` or None, optional
+        Evaluates to True on invalid elements of array.
+    angular_bounds : 2-tuple or None, optional
+        If not None, the angles between first and second elements of `angular_bounds`
+        (inclusively) will be used for the average. Angle bounds are specified in degrees.
+        0 degrees is defined as the positive x-axis. Angle bounds outside [0, 360) are mapped back
+        to [0, 360).
+    method : {'nearest', 'split'}, optional
+        'nearest':
+            By default, every pixel contributes to the radial bin nearest to its center.
+        'split':
+            The area of every pixel is distributed over the radial bins it overlaps. This 
+            reduces ring aliasing at small radii. The distribution is stored as a sparse matrix, 
+            so that integrating an image is a single sparse matrix-vector product.
+    bin_width : float, optional
+        Width of the radial bins, in units of ``scale``. 
+    scale : float, optional
+        Radial units per pixel. By default, radial units are pixels. For bins in 
+        scattering vector, ``scale`` is the spacing ``q[1] - q[0]`` of the calibration 
+        returned by :func:`powder_calq`.
+    n_angles : int or None, optional
+        If not None, images are regrouped into ``n_angles`` equal angular sectors spanning 
+        ``angular_bounds`` (or [0, 360] if ``angular_bounds`` is None), and the average is 
+        computed for every sector at once. This is known as "cake" integration.
+    
+    Attributes
+    ----------
+    radius : `~numpy.ndarray`, ndim 1
+        Radius of every bin, in units of ``scale``, before trimming.
+    angles : `~numpy.ndarray`, ndim 1 or None
+        Center of every angular sector [deg]. None if ``n_angles`` is None.
+    counts : `~numpy.ndarray`, shape (R,) or (n_angles, R)
+        Number of valid pixels in every bin. For ``method = 'split'``, pixels 
+        contribute fractionally.
+    
+    Raises
+    ------
+    ValueError : if the integration method is invalid.
+
+    See Also
+    --------
+    azimuthal_average : azimuthally-averaged pattern of a single image
+    """
+
+    def __init__(self, shape, center, mask = None, angular_bounds = None, 
+                 method = 'nearest', bin_width = 1, scale = 1, n_angles = None):
+        if method not in {'nearest', 'split'}:
+            raise ValueError('Integration method {} is not valid.'.format(method))
+
+        self.shape = tuple(shape)
+        self.center = tuple(center)
+        self.method = method
+
+        if mask is None:
+            mask = np.zeros(self.shape, dtype = np.bool)
+        mask = np.asarray(mask, dtype = np.bool)
+
+        if mask.shape != self.shape:
+            raise ValueError('Mask of shape {} does not match the image shape {}'.format(mask.shape, self.shape))
+
+        xc, yc = self.center
+
+        # Create meshgrid and compute radial positions of the data
+        # in units of bin width
+        Y, X = np.indices(self.shape)
+        R = np.hypot(X - xc, Y - yc) * (scale / bin_width)
+
+        mi, ma = _angle_bounds(angular_bounds) if angular_bounds else (0, 360)
+        if angular_bounds or n_angles:
+            angles = np.rad2deg(np.arctan2(Y - yc, X - xc)) + 180  # arctan2 is defined on [-pi, pi] but we want [0, pi]
+        
+        if angular_bounds:
+            in_bounds = np.logical_and(mi <= angles, angles <= ma)
+        else:
+            in_bounds = np.ones(self.shape, dtype = np.bool)
+        
+        # For cake integration, every angular sector has its own set of radial bins.
+        # Pixels on the upper angular bound belong to the last sector.
+        self.angles = None
+        sectors = np.zeros(self.shape, dtype = np.int)
+        if n_angles:
+            n_angles = int(n_angles)
+            width = (ma - mi) / n_angles
+            self.angles = mi + width * (np.arange(0, n_angles) + 0.5)
+            sectors[:] = np.clip(np.floor((angles - mi) / width), 0, n_angles - 1)
+
+        # Only valid pixels are ever looked at when integrating
+        # If all pixels are valid, there is no need to gather them
+        valid = np.logical_and(in_bounds, np.logical_not(mask))
+        self._pixels = None if np.all(valid) else np.flatnonzero(valid)
+        
+        if method == 'nearest':
+            self._matrix = None
+            Rint = np.rint(R).astype(np.int)
+            
+            # Bins are determined by all pixels in bounds, including masked ones,
+            # so that the radial range does not depend on the mask
+            nbins = int(Rint[in_bounds].max()) + 1 if np.any(in_bounds) else 0
+
+            flat_bins = (Rint + nbins * sectors).ravel()
+            self._bins = flat_bins if self._pixels is None else flat_bins[self._pixels]
+            self.counts = np.bincount(self._bins, minlength = nbins * (n_angles or 1))
+            
+            # Bins without any valid pixel have an integrated intensity of zero anyway
+            self._norm = 1 / np.maximum(self.counts, 1)
+        
+        else:
+            # The radial extent of a square pixel depends on its orientation with respect
+            # to the center; it spans between 1 and sqrt(2) pixels.
+            theta = np.arctan2(Y - yc, X - xc)
+            halfwidth = 0.5 * (np.abs(np.cos(theta)) + np.abs(np.sin(theta))) * (scale / bin_width)
+
+            # Negative radii are folded onto the first bin, which spans [-0.5, 0.5)
+            lo = np.maximum(R - halfwidth, -0.5)
+            hi = R + halfwidth
+            nbins = int(np.floor(hi[in_bounds].max() + 0.5)) + 1 if np.any(in_bounds) else 0
+
+            self._matrix = _split_pixel_matrix(lo.ravel(), hi.ravel(), nbins = nbins, 
+                                               pixels = self._pixels, groups = sectors.ravel(), 
+                                               ngroups = n_angles or 1)
+            self.counts = np.asarray(self._matrix.sum(axis = 1)).ravel()
+
+            # Normalization is folded into the matrix, so that a single
+            # matrix-vector product computes the average
+            norm = np.zeros_like(self.counts)
+            np.divide(1, self.counts, out = norm, where = self.counts > 0)
+            self._matrix = (diags(norm) @ self._matrix).tocsr()
+        
+        self.radius = bin_width * np.arange(0, nbins)
+        self._outshape = (n_angles, nbins) if n_angles else (nbins,)
+        self.counts = self.counts.reshape(self._outshape)
+
+    def __call__(self, image, trim = True, max_memory = 2**28):
+        """
+        Azimuthally-average an image, or a stack of images.
+
+        Parameters
+        ----------
+        image : array_like, shape (M, N) or (K, M, N)
+            Array or image. The shape of images must match the shape of the integrator.
+            Stacks of images, including memory-mapped arrays, are integrated in chunks.
+        trim : bool, optional
+            If True, leading and trailing zeros (possible due to the usage of masks) are trimmed.
+            For stacks of images, only radii where all images are zero are trimmed.
+        max_memory : int, optional
+            Approximate memory budget, in bytes, for the chunks of images read at once
+            when integrating a stack of images. At least one image is read at a time.
+        
+        Returns
+        -------
+        radius : `~numpy.ndarray`, ndim 1
+            Radius of the average. ``radius`` might not start at zero, depending on the ``trim`` parameter.
+        average : `~numpy.ndarray`, shape (R,) or (K, R)
+            Angular-average of the array. For stacks of images, each row is the average of an image.
+            For cake integration, the shape is (n_angles, R) or (K, n_angles, R) instead.
+        
+        Raises
+        ------
+        ValueError : if the shape of ``image`` does not match the shape of the integrator.
+        """
+        average, = self._map(lambda frame: (self._integrate(frame),), image, max_memory = max_memory)
+
+        # We ignore the leading and trailing zeroes, which could be due to masks
+        first, last = self._trim_bounds(average) if trim else (0, self.radius.size)
+        return self.radius[first:last], average[..., first:last]
+    
+    def statistics(self, image, estimator = 'mean', sigma = 3, max_iter = 5, trim = True, max_memory = 2**28):
+        """
+        Per-ring statistics of an image, or a stack of images. Robust estimators 
+        are less sensitive to single-crystal spots and hot pixels than the mean. 
+        All rings are treated at once; only the sigma-clipping iterations are not vectorized.
+
+        Parameters
+        ----------
+        image : array_like, shape (M, N) or (K, M, N)
+            Array or image. The shape of images must match the shape of the integrator.
+        estimator : {'mean', 'median', 'sigma-clip'}, optional
+            Estimator of the average intensity of every ring. 'sigma-clip' is the mean 
+            of pixels which are within ``sigma`` standard deviations of the mean of their ring, 
+            determined iteratively.
+        sigma : float, optional
+            Number of standard deviations beyond which pixels are rejected, for ``estimator = 'sigma-clip'``.
+        max_iter : int, optional
+            Maximum number of sigma-clipping iterations, for ``estimator = 'sigma-clip'``. 
+        trim : bool, optional
+            If True, leading and trailing zeros (possible due to the usage of masks) are trimmed.
+        max_memory : int, optional
+            Approximate memory budget, in bytes, for the chunks of images read at once
+            when integrating a stack of images. At least one image is read at a time.
+        
+        Returns
+        -------
+        radius : `~numpy.ndarray`, ndim 1
+            Radius of the average. ``radius`` might not start at zero, depending on the ``trim`` parameter.
+        average : `~numpy.ndarray`
+            Angular-average of the array, according to ``estimator``.
+        std : `~numpy.ndarray`
+            Standard deviation of pixel values of every ring. For ``estimator = 'sigma-clip'``, 
+            only pixels that were not rejected are taken into account.
+        counts : `~numpy.ndarray`
+            Number of pixels used for every ring. 
+        
+        Raises
+        ------
+        ValueError : if the shape of ``image`` does not match the shape of the integrator.
+        ValueError : if the estimator is invalid, or the integrator does not use nearest-bin integration.
+        """
+        if self.method != 'nearest':
+            raise ValueError('Per-ring statistics require nearest-bin integration, not {}'.format(self.method))
+        
+        if estimator not in {'mean', 'median', 'sigma-clip'}:
+            raise ValueError('Estimator {} is not valid.'.format(estimator))
+        
+        kernel = partial(self._statistics, estimator = estimator, sigma = sigma, max_iter = max_iter)
+        average, std, counts = self._map(kernel, image, max_memory = max_memory)
+
+        first, last = self._trim_bounds(average) if trim else (0, self.radius.size)
+        return self.radius[first:last], average[..., first:last], std[..., first:last], counts[..., first:last]
+    
+    def _map(self, kernel, image, max_memory):
+        """ 
+        Apply a kernel to an image or a stack of images. The kernel returns a tuple of 
+        arrays of shape ``self._outshape``; these arrays are stacked for stacks of images. 
+        """
+        # Memory-mapped chunks are read from disk at once, while in-memory stacks are not copied
+        read = partial(np.array, copy = True) if isinstance(image, np.memmap) else np.asarray
+        image = np.asarray(image)
+        if (image.ndim not in {2, 3}) or (image.shape[-2:] != self.shape):
+            raise ValueError('Expected image of shape {}, but received shape {}'.format(self.shape, image.shape))
+        
+        if image.ndim == 2:
+            return kernel(image)
+        
+        results = None
+
+        # Chunks of images are read at once, which is important for memory-mapped
+        # arrays. Within a chunk, the integration of every image is already 
+        # vectorized over all pixels and limited by memory bandwidth.
+        chunksize = max(1, int(max_memory // image[0].nbytes))
+        for start in range(0, image.shape[0], chunksize):
+            chunk = read(image[start:start + chunksize])
+            for index, frame in enumerate(chunk, start = start):
+                values = kernel(frame)
+                if results is None:
+                    results = tuple(np.empty(shape = (image.shape[0],) + self._outshape, dtype = np.float) 
+                                    for _ in values)
+                for result, value in zip(results, values):
+                    result[index] = value
+        
+        return results
+    
+    def _trim_bounds(self, average):
+        """ Trim bounds of radii where every ring, sector and image is zero. """
+        nonzero = np.asarray(average) != 0
+        return _trim_bounds(np.any(nonzero, axis = tuple(range(nonzero.ndim - 1))))
+    
+    def _valid_values(self, image):
+        """ Values of the valid pixels of an image, in the order of ``self._bins``. """
+        values = image.ravel()
+        if self._pixels is not None:
+            values = values[self._pixels]
+        return values
+
+    def _integrate(self, image):
+        """ Azimuthal average of a single image, without trimming. """
+        if self._matrix is not None:
+            average = self._matrix @ image.ravel().astype(np.float)
+            return average.reshape(self._outshape)
+        
+        # Without valid pixels, bincount returns integers
+        average = np.bincount(self._bins, weights = self._valid_values(image), minlength = self._norm.size)
+        average = average * self._norm
+        return average.reshape(self._outshape)
+    
+    def _statistics(self, image, estimator, sigma, max_iter):
+        """ Per-ring average, standard deviation and counts of a single image. """
+        values = self._valid_values(image).astype(np.float)
+        keep = np.ones_like(values, dtype = np.bool)
+        average, std, counts = self._moments(values, keep)
+
+        if estimator == 'median':
+            average = self._median(values)
+
+        elif estimator == 'sigma-clip':
+            for _ in range(max_iter):
+                clipped = np.abs(values - average[self._bins]) <= sigma * std[self._bins]
+                if np.array_equal(clipped, keep):
+                    break
+                keep = clipped
+                average, std, counts = self._moments(values, keep)
+        
+        return tuple(arr.reshape(self._outshape) for arr in (average, std, counts))
+    
+    def _moments(self, values, keep):
+        """ Mean, standard deviation and number of the pixels to keep, for all rings at once. """
+        nbins = self._norm.size
+        weights = keep.astype(np.float)
+
+        counts = np.bincount(self._bins, weights = weights, minlength = nbins)
+        norm = 1 / np.maximum(counts, 1)
+        mean = np.bincount(self._bins, weights = weights * values, minlength = nbins) * norm
+
+        # Two-pass variance is more accurate than the difference of squares
+        deviations = weights * np.square(values - mean[self._bins])
+        std = np.sqrt(np.bincount(self._bins, weights = deviations, minlength = nbins) * norm)
+        return mean, std, counts
+    
+    def _median(self, values):
+        """ Median of every ring, for all rings at once. """
+        # Pixels are grouped by ring once per plan. Then, for every image, 
+        # values are sorted within rings by sorting keys ``ring + value``, 
+        # where values are scaled to [0, 1/2]. 
+        if not hasattr(self, '_ring_order'):
+            self._ring_order = np.argsort(self._bins, kind = 'mergesort')
+            self._ring_bins = self._bins[self._ring_order]
+        
+        values = values[self._ring_order]
+        if np.all(np.isfinite(values)):
+            lo, hi = values.min(initial = 0), values.max(initial = 0)
+            keys = (values - lo) * (0.5 / (hi - lo) if hi > lo else 0)
+            keys += self._ring_bins
+            values = values[np.argsort(keys)]
+        else:
+            values = values[np.lexsort((values, self._ring_bins))]
+
+        counts = self.counts.ravel()
+        starts = np.cumsum(counts) - counts
+        valid = counts > 0
+
+        median = np.zeros(shape = counts.shape, dtype = np.float)
+        lower = values[(starts + (counts - 1) // 2)[valid]]
+        upper = values[(starts + counts // 2)[valid]]
+        median[valid] = (lower + upper) / 2
+        return median
+
+def _split_pixel_matrix(lo, hi, nbins, pixels = None, groups = None, ngroups = 1):
+    """ 
+    Sparse matrix distributing the radial extent [lo, hi) of every pixel 
+    over bins [k - 1/2, k + 1/2). Radial extents are expressed in units of bin width.
+    If ``pixels`` is not None, only those flat pixel indices contribute. If ``groups`` is
+    not None, every pixel contributes to the set of ``nbins`` bins of its group.
+    """
+    npixels = lo.size
+    if pixels is None:
+        pixels = np.arange(0, npixels)
+    if groups is None:
+        groups = np.zeros_like(lo, dtype = np.int)
+    lo, hi, offsets = lo[pixels], hi[pixels], nbins * groups[pixels]
+
+    first = np.floor(lo + 0.5).astype(np.int)
+    span = int(np.max(np.floor(hi + 0.5) - first)) + 1 if pixels.size else 0
+    
+    rows, cols, data = list(), list(), list()
+    for offset in range(span):
+        bins = first + offset
+        overlap = np.minimum(hi, bins + 0.5) - np.maximum(lo, bins - 0.5)
+        contributes = np.logical_and(overlap > 0, bins < nbins)
+        rows.append(bins[contributes] + offsets[contributes])
+        cols.append(pixels[contributes])
+        data.append(overlap[contributes] / (hi - lo)[contributes])
+    
+    if not span:
+        return csr_matrix((ngroups * nbins, npixels), dtype = np.float)
+
+    return csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), 
+                      shape = (ngroups * nbins, npixels))
+
+def azimuthal_average(image, center, mask = None, angular_bounds = None, trim = True, 
+                      method = 'nearest', bin_width = 1, scale = 1, max_memory = 2**28):
     """
     This function returns an azimuthally-averaged pattern computed from an image, 
     e.g. polycrystalline diffraction.
 
     Parameters
     ----------
-    image : array_like, shape (M, N)
-        Array or image.
+    image : array_like, shape (M, N) or (K, M, N)
+        Array or image. Stacks of images, including memory-mapped arrays, are integrated
+        in chunks. 
+
+        .. versionadded:: 1.0.2
     center : array_like, shape (2,)
         coordinates of the center (in pixels).
     mask : `~numpy.ndarray` or None, optional
@@ -77,50 +588,210 @@ def azimuthal_average(image, center, mask = None, angular_bounds = None, trim =
         to [0, 360).
     trim : bool, optional
         If True, leading and trailing zeros (possible due to the usage of masks) are trimmed.
+    method : {'nearest', 'split'}, optional
+        If 'nearest' (default), every pixel contributes to the radial bin nearest to its center. 
+        If 'split', the area of every pixel is distributed over the radial bins it overlaps.
+
+        .. versionadded:: 1.0.2
+    bin_width : float, optional
+        Width of the radial bins, in units of ``scale``.
+
+        .. versionadded:: 1.0.2
+    scale : float, optional
+        Radial units per pixel. By default, radial units are pixels.
+
+        .. versionadded:: 1.0.2
+    max_memory : int, optional
+        Approximate memory budget, in bytes, for the chunks of images read at once
+        when averaging a stack of images.
+
+        .. versionadded:: 1.0.2
 
     Returns
     -------
     radius : `~numpy.ndarray`, ndim 1
         Radius of the average [px]. ``radius`` might not start at zero, depending on the ``trim`` parameter.
-    average : `~numpy.ndarray`, ndim 1
-        Angular-average of the array.
+    average : `~numpy.ndarray`, shape (R,) or (K, R)
+        Angular-average of the array. For stacks of images, each row is the average of an image.
+    
+    Raises
+    ------
+    ValueError : if the integration method is invalid.
+    
+    See Also
+    --------
+    AzimuthalIntegrator : reusable integration plan, for averaging many images with the same geometry.
     """
-    if mask is None:
-        mask = np.zeros_like(image, dtype = np.bool)
+    image = np.asarray(image)
+    integrator = AzimuthalIntegrator(image.shape[-2:], center = center, mask = mask, 
+                                     angular_bounds = angular_bounds, method = method, 
+                                     bin_width = bin_width, scale = scale)
+    return integrator(image, trim = trim, max_memory = max_memory)
 
-    xc, yc = center  
+def azimuthal_statistics(image, center, mask = None, angular_bounds = None, trim = True, 
+                         estimator = 'mean', sigma = 3, max_iter = 5):
+    """
+    Azimuthal average, standard deviation and pixel count of every ring in an image. Robust
+    estimators of the average, i.e. the median or the sigma-clipped mean, are less sensitive 
+    to single-crystal spots and hot pixels than :func:`azimuthal_average`.
 
-    # Create meshgrid and compute radial positions of the data
-    # The radial positions are rounded to the nearest integer
-    # TODO: interpolation? or is that too slow?
-    Y, X = np.indices(image.shape)
-    R = np.hypot(X - xc, Y - yc)
-    Rint = np.rint(R).astype(np.int)
+    .. versionadded:: 1.0.2
 
-    if angular_bounds:
-        mi, ma = _angle_bounds(angular_bounds)
-        angles = np.rad2deg(np.arctan2(Y - yc, X - xc)) + 180  # arctan2 is defined on [-pi, pi] but we want [0, pi]
-        in_bounds = np.logical_and(mi <= angles, angles <= ma)
-    else:
-        in_bounds = np.ones_like(image, dtype = np.bool)
+    Parameters
+    ----------
+    image : array_like, shape (M, N) or (K, M, N)
+        Array or image, or stack thereof.
+    center : array_like, shape (2,)
+        coordinates of the center (in pixels).
+    mask : `~numpy.ndarray` or None, optional
+        Evaluates to True on invalid elements of array.
+    angular_bounds : 2-tuple or None, optional
+        If not None, the angles between first and second elements of `angular_bounds`
+        (inclusively) will be used for the average. Angle bounds are specified in degrees.
+        0 degrees is defined as the positive x-axis. Angle bounds outside [0, 360) are mapped back
+        to [0, 360).
+    trim : bool, optional
+        If True, leading and trailing zeros (possible due to the usage of masks) are trimmed.
+    estimator : {'mean', 'median', 'sigma-clip'}, optional
+        Estimator of the average intensity of every ring. 'sigma-clip' is the mean 
+        of pixels which are within ``sigma`` standard deviations of the mean of their ring, 
+        determined iteratively.
+    sigma : float, optional
+        Number of standard deviations beyond which pixels are rejected, for ``estimator = 'sigma-clip'``.
+    max_iter : int, optional
+        Maximum number of sigma-clipping iterations, for ``estimator = 'sigma-clip'``. 
 
-    valid = np.logical_not(mask)[in_bounds]
-    image = image[in_bounds]
-    Rint = Rint[in_bounds]
+    Returns
+    -------
+    radius : `~numpy.ndarray`, ndim 1
+        Radius of the average [px]. ``radius`` might not start at zero, depending on the ``trim`` parameter.
+    average : `~numpy.ndarray`
+        Angular-average of the array, according to ``estimator``.
+    std : `~numpy.ndarray`
+        Standard deviation of pixel values of every ring. For ``estimator = 'sigma-clip'``, 
+        only pixels that were not rejected are taken into account.
+    counts : `~numpy.ndarray`
+        Number of pixels used for every ring. 
+    
+    Raises
+    ------
+    ValueError : if the estimator is invalid.
 
-    px_bin = np.bincount(Rint, weights = valid*image)
-    r_bin = np.bincount(Rint, weights = valid)
-    radius = np.arange(0, r_bin.size)
+    See Also
+    --------
+    AzimuthalIntegrator.statistics : per-ring statistics with a reusable integration plan.
+    """
+    image = np.asarray(image)
+    integrator = AzimuthalIntegrator(image.shape[-2:], center = center, mask = mask, 
+                                     angular_bounds = angular_bounds)
+    return integrator.statistics(image, estimator = estimator, sigma = sigma, max_iter = max_iter, trim = trim)
 
-    # Make sure r_bin is never 0 since it it used for division anyway
-    np.maximum(r_bin, 1, out = r_bin)
+def azimuthal_cake(image, center, n_angles, mask = None, angular_bounds = None, trim = True, 
+                   method = 'nearest', bin_width = 1, scale = 1):
+    """
+    Regroup an image into angular sectors, and azimuthally-average each sector. All sectors are 
+    computed in a single pass over the image, which is much faster than calling :func:`azimuthal_average` 
+    repeatedly with different angular bounds. This is useful to study anisotropic polycrystalline 
+    diffraction, e.g. textured samples.
 
-    # We ignore the leading and trailing zeroes, which could be due to
-    first, last = 0, -1
-    if trim:
-        first, last = _trim_bounds(px_bin)
+    .. versionadded:: 1.0.2
 
-    return radius[first:last], px_bin[first:last]/r_bin[first:last]
+    Parameters
+    ----------
+    image : array_like, shape (M, N) or (K, M, N)
+        Array or image, or stack thereof.
+    center : array_like, shape (2,)
+        coordinates of the center (in pixels).
+    n_angles : int
+        Number of angular sectors.
+    mask : `~numpy.ndarray` or None, optional
+        Evaluates to True on invalid elements of array.
+    angular_bounds : 2-tuple or None, optional
+        If not None, the angles between first and second elements of `angular_bounds`
+        (inclusively) are divided into sectors. Otherwise, the sectors span [0, 360]. Angle 
+        bounds are specified in degrees. 0 degrees is defined as the positive x-axis. 
+    trim : bool, optional
+        If True, radii where all sectors are zero (possible due to the usage of masks) are trimmed.
+    method : {'nearest', 'split'}, optional
+        If 'nearest' (default), every pixel contributes to the radial bin nearest to its center. 
+        If 'split', the area of every pixel is distributed over the radial bins it overlaps.
+    bin_width : float, optional
+        Width of the radial bins, in units of ``scale``.
+    scale : float, optional
+        Radial units per pixel. By default, radial units are pixels.
+
+    Returns
+    -------
+    angles : `~numpy.ndarray`, shape (n_angles,)
+        Center of every angular sector [deg].
+    radius : `~numpy.ndarray`, ndim 1
+        Radius of the average. ``radius`` might not start at zero, depending on the ``trim`` parameter.
+    cake : `~numpy.ndarray`, shape (n_angles, R) or (K, n_angles, R)
+        Angular-average of every sector. 
+    
+    See Also
+    --------
+    azimuthal_average : azimuthally-averaged pattern of an image.
+    """
+    image = np.asarray(image)
+    integrator = AzimuthalIntegrator(image.shape[-2:], center = center, mask = mask, 
+                                     angular_bounds = angular_bounds, method = method, 
+                                     bin_width = bin_width, scale = scale, n_angles = n_angles)
+    radius, cake = integrator(image, trim = trim)
+    return integrator.angles, radius, cake
+
+@array_stream
+def iazimuthal_average(images, center, mask = None, angular_bounds = None, trim = True, 
+                       method = 'nearest', bin_width = 1, scale = 1):
+    """
+    Generator of azimuthally-averaged patterns from a stream of images. A single integration plan 
+    is shared between all images. This function operates in constant-memory; it is therefore
+    safe to use on a large collection of images (>10GB).
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    images : iterable of ndarrays, shape (M, N)
+        Iterable of images, all of the same shape. ``images`` can also be a generator, e.g. :func:`imibread`.
+    center : array_like, shape (2,)
+        coordinates of the center (in pixels).
+    mask : `~numpy.ndarray` or None, optional
+        Evaluates to True on invalid elements of array.
+    angular_bounds : 2-tuple or None, optional
+        If not None, the angles between first and second elements of `angular_bounds`
+        (inclusively) will be used for the average. Angle bounds are specified in degrees.
+        0 degrees is defined as the positive x-axis. Angle bounds outside [0, 360) are mapped back
+        to [0, 360).
+    trim : bool, optional
+        If True, leading and trailing zeros (possible due to the usage of masks) are trimmed. 
+        Trimming is determined for every image separately.
+    method : {'nearest', 'split'}, optional
+        If 'nearest' (default), every pixel contributes to the radial bin nearest to its center. 
+        If 'split', the area of every pixel is distributed over the radial bins it overlaps.
+    bin_width : float, optional
+        Width of the radial bins, in units of ``scale``.
+    scale : float, optional
+        Radial units per pixel. By default, radial units are pixels.
+
+    Yields
+    ------
+    radius : `~numpy.ndarray`, ndim 1
+        Radius of the average. ``radius`` might not start at zero, depending on the ``trim`` parameter.
+    average : `~numpy.ndarray`, ndim 1
+        Angular-average of an image.
+    
+    See Also
+    --------
+    azimuthal_average : azimuthally-averaged pattern of an image, or a stack of images.
+    """
+    first, images = peek(images)
+    integrator = AzimuthalIntegrator(first.shape, center = center, mask = mask, 
+                                     angular_bounds = angular_bounds, method = method, 
+                                     bin_width = bin_width, scale = scale)
+    
+    for image in images:
+        yield integrator(image, trim = trim)
 
 def _trim_bounds(arr):
     """ Returns the bounds which would be used in numpy.trim_zeros """
@@ -4,19 +4,23 @@ Image manipulation involving symmetry
 =====================================
 """
 import numpy as np
-from skimage.transform import rotate
+from scipy.sparse import csr_matrix
+from skimage.transform import AffineTransform, warp
 
-from npstreams import average, nan_to_num
-
-from ..array_utils import mirror
+from ..array_utils import _float_dtype, mirror
 
 
 # TODO: out parameter?
-def nfold(im, mod, center = None, mask = None, fill_value = 0.0):
-    """ 
+def nfold(im, mod, center = None, mask = None, fill_value = 0.0, dtype = None):
+    """
     Returns an images averaged according to n-fold rotational symmetry. This can be used to
     boost the signal-to-noise ratio on an image with known symmetry, e.g. a diffraction pattern.
 
+    .. versionchanged:: 1.0.2
+        Rotated pixels which straddle the edge of the image or of the mask now contribute 
+        their valid fraction to the average, instead of being ignored (mask) or attenuated (edges). 
+        Elsewhere, results are unchanged.
+
     Parameters
     ----------
     im : array_like, ndim 2
@@ -27,11 +31,14 @@ def nfold(im, mod, center = None, mask = None, fill_value = 0.0):
     mod : int
         Fold symmetry number. Valid numbers must be a divisor of 360.
     mask : `~numpy.ndarray` or None, optional
-        Mask of `image`. The mask should evaluate to `True` (or 1) on invalid pixels. 
+        Mask of `image`. The mask should evaluate to `True` (or 1) on invalid pixels.
         If None (default), no mask is used.
     fill_value : float, optional
         In the case of a mask that overlaps with itself when rotationally averaged,
         the overlapping regions will be filled with this value.
+    dtype : numpy.dtype or None, optional
+        Floating-point type of the computation and of the symmetrized image, either ``numpy.float32``
+        or ``numpy.float64``. If None (default), the type set by :func:`set_float_dtype` is used.
 
     Returns
     -------
@@ -41,32 +48,29 @@ def nfold(im, mod, center = None, mask = None, fill_value = 0.0):
     Raises
     ------
     ValueError : If `mod` is not a divisor of 360 deg.
-    """
-    if (360 % mod):
-        raise ValueError('{}-fold rotational symmetry is not valid (not a divisor of 360).'.format(mod))
-    angles = range(0, 360, int(360/mod))
-
-    # Data-type must be float because of use of NaN
-    im = np.array(im, dtype = np.float, copy = True)
 
-    if mask is not None:
-       im[mask] = np.nan
-    
-    kwargs = {'center': center, 'mode' : 'constant', 'cval' : 0, 'preserve_range': True}
+    See Also
+    --------
+    Symmetrizer : reusable symmetrization operator, for many images with the same center and mask.
 
-    # Use weights because edges of the pictures, which might be cropped by the rotation
-    # should not count in the average
-    wt = np.ones_like(im, dtype = np.uint8)
-    weights = (rotate(wt, angle, **kwargs) for angle in angles)
-    rotated = (rotate(im, angle, **kwargs) for angle in angles)
-
-    avg = average(rotated, weights = weights, ignore_nan = True)
-    return nan_to_num(avg, fill_value, copy = False)
+    Notes
+    -----
+    Every call interpolates the image once per rotation, without setup. To symmetrize many 
+    images with the same shape, center and mask, a :class:`Symmetrizer` is faster per image, 
+    but building it costs a few calls to this function, and memory for about ``4 * mod`` 
+    interpolation weights per pixel.
+    """
+    return _symmetrize(im, mod = mod, angle = None, center = center, mask = mask, 
+                       fill_value = fill_value, dtype = dtype)
 
-def reflection(im, angle, center = None, mask = None, fill_value = 0.0):
+def reflection(im, angle, center = None, mask = None, fill_value = 0.0, dtype = None):
     """
     Symmetrize an image according to a reflection plane.
 
+    .. versionchanged:: 1.0.2
+        The image is interpolated once, and the reflection line passes through ``center``. 
+        Masked pixels are filled from their valid reflection rather than set to ``fill_value``.
+
     Parameters
     ----------
     im : array_like, ndim 2
@@ -80,34 +84,326 @@ def reflection(im, angle, center = None, mask = None, fill_value = 0.0):
         Coordinates of the center (in pixels). If ``center=None``, the image is rotated around
         its center, i.e. ``center=(rows / 2 - 0.5, cols / 2 - 0.5)``.
     mask : `~numpy.ndarray` or None, optional
-        Mask of `image`. The mask should evaluate to `True` (or 1) on invalid pixels. 
+        Mask of `image`. The mask should evaluate to `True` (or 1) on invalid pixels.
         If None (default), no mask is used.
     fill_value : float, optional
         In the case of a mask that overlaps with itself when rotationally averaged,
         the overlapping regions will be filled with this value.
+    dtype : numpy.dtype or None, optional
+        Floating-point type of the computation and of the symmetrized image, either ``numpy.float32``
+        or ``numpy.float64``. If None (default), the type set by :func:`set_float_dtype` is used.
 
     Returns
     -------
     out : `~numpy.ndarray`, dtype float
         Symmetrized image.
+
+    See Also
+    --------
+    Symmetrizer : reusable symmetrization operator, for many images with the same center and mask.
+
+    Notes
+    -----
+    Every call interpolates the image once, without setup. To symmetrize many images 
+    with the same shape, center and mask, a :class:`Symmetrizer` is faster per image, 
+    but building it costs a few calls to this function, and memory for about 8 
+    interpolation weights per pixel.
+    """
+    return _symmetrize(im, mod = 1, angle = angle, center = center, mask = mask, 
+                       fill_value = fill_value, dtype = dtype)
+
+class Symmetrizer:
+    """
+    Reusable symmetrization operator. The bilinear interpolation weights of all symmetry operations
+    are summed into a single sparse matrix once; symmetrizing an image is then a single sparse
+    matrix-vector product. This is much faster than :func:`nfold` and :func:`reflection` when many
+    images share the same shape, center and mask, e.g. in a time-resolved experiment.
+    Building the operator costs a few calls to :func:`nfold`, and memory for about four 
+    interpolation weights per pixel and per symmetry operation.
+
+    .. versionadded:: 1.0.2
+
+    Parameters
+    ----------
+    shape : 2-tuple of ints
+        Shape of the images to symmetrize.
+    mod : int, optional
+        Fold symmetry number. Valid numbers must be a divisor of 360. Default is 1,
+        i.e. no rotational symmetry.
+    angle : float or None, optional
+        Angle (in degrees) of the line that defines a reflection plane. This angle
+        increases counter-clockwise from the positive x-axis. If None (default),
+        no reflection symmetry is used. If both ``mod`` and ``angle`` are specified,
+        images are averaged over all rotations, and all rotations of the reflection.
+    center : array_like, shape (2,) or None, optional
+        Coordinates of the center (in pixels). If ``center=None``, the image is rotated around
+        its center, i.e. ``center=(rows / 2 - 0.5, cols / 2 - 0.5)``.
+    mask : `~numpy.ndarray` or None, optional
+        Mask of images. The mask should evaluate to `True` (or 1) on invalid pixels.
+        If None (default), no mask is used.
+
+    Attributes
+    ----------
+    counts : `~numpy.ndarray`
+        Total interpolation weight of the valid pixels which contribute to every pixel.
+        Pixels where ``counts`` is zero are filled with ``fill_value``.
+
+    Raises
+    ------
+    ValueError : If `mod` is not a divisor of 360 deg.
+
+    See Also
+    --------
+    nfold : average an image according to n-fold rotational symmetry.
+    reflection : symmetrize an image according to a reflection plane.
+
+    Notes
+    -----
+    If the center is the center of the image (default), rotations by multiples of 90 degrees
+    and reflections at multiples of 45 degrees are exact permutations of the pixels. 
+    If all symmetry operations are such permutations, e.g. for 2-fold and 4-fold symmetry, 
+    images are symmetrized exactly with array views (flips and transposes), without interpolation. 
+    Rotations by 90 degrees and diagonal reflections require square images.
     """
-    angle = float(angle) % 360
 
-    # Data-type must be float because of use of NaN
-    im = np.array(im, dtype = np.float, copy = True)
-    reflected = np.array(im, copy = True)      # reflected image
+    def __init__(self, shape, mod = 1, angle = None, center = None, mask = None):
+        self.shape = tuple(shape)
+        operations = _operations(mod, angle)
+        center = _center(center, self.shape)
+        valid = None if mask is None else np.logical_not(np.asarray(mask, dtype = np.bool))
+        self._operator = None
+        self._operators = dict()
+
+        # Rotations by multiples of 90 degrees and reflections at multiples of 45 degrees
+        # about the center of the image are exact permutations of the pixels, 
+        # which are computed with array views rather than interpolation
+        self._views = _views(operations, center.ravel(), self.shape)
+        if self._views is not None:
+            self._valid = valid
+            weights = np.ones(self.shape) if valid is None else valid.astype(np.float)
+            self.counts = sum(_apply_view(weights, view) for view in self._views)
+            return
+
+        # Output pixels are interpolated from the input image at coordinates
+        # center + operation @ (xy - center), for every operation
+        yy, xx = np.indices(self.shape)
+        xy = np.stack([xx.ravel(), yy.ravel()]).astype(np.float) - center
+
+        # Neighbors are computed one operation at a time in contiguous arrays, 
+        # and transposed to a row-major layout afterwards, which is much faster
+        indices = np.empty((4 * len(operations), xx.size), dtype = np.int)
+        weights = np.empty((4 * len(operations), xx.size), dtype = np.float)
+        for row, operation in zip(range(0, indices.shape[0], 4), operations):
+            _bilinear(center + operation @ xy, self.shape, 
+                      indices = indices[row:row + 4], weights = weights[row:row + 4])
+        indices, weights = np.ascontiguousarray(indices.T), np.ascontiguousarray(weights.T)
 
+        # Masked pixels never contribute
+        if valid is not None:
+            weights[np.logical_not(valid).ravel()[indices]] = 0
+
+        # Every output pixel has the same number of neighbors (possibly without weight),
+        # so that the sparse matrix can be assembled row-wise without sorting.
+        # Duplicate entries, e.g. from the identity and a reflection, are allowed.
+        size, per_row = indices.shape
+        self._operator = csr_matrix((weights.ravel(), indices.ravel(), np.arange(0, size * per_row + 1, per_row)),
+                                    shape = (size, size))
+        self._operator.eliminate_zeros()
+
+        self.counts = np.asarray(self._operator.sum(axis = 1)).reshape(self.shape)
+
+    def __call__(self, image, fill_value = 0.0, dtype = None):
+        """
+        Symmetrize an image, or a stack of images.
+
+        Parameters
+        ----------
+        image : array_like, shape (M, N) or (K, M, N)
+            Image or stack of images. The shape of images must match the shape of the symmetrizer.
+        fill_value : float, optional
+            Pixels to which no valid pixel contributes, e.g. because of a mask that
+            overlaps with itself when symmetrized, will be filled with this value.
+        dtype : numpy.dtype or None, optional
+            Floating-point type of the computation and of the symmetrized image, either ``numpy.float32``
+            or ``numpy.float64``. If None (default), the type set by :func:`set_float_dtype` is used.
+
+        Returns
+        -------
+        out : `~numpy.ndarray`
+            Symmetrized image, or stack of images.
+
+        Raises
+        ------
+        ValueError : if the shape of ``image`` does not match the shape of the symmetrizer.
+        """
+        dtype = _float_dtype(dtype)
+        image = np.asarray(image)
+        if (image.ndim not in {2, 3}) or (image.shape[-2:] != self.shape):
+            raise ValueError('Expected image of shape {}, but received shape {}'.format(self.shape, image.shape))
+
+        operator, norm = self._cast(dtype)
+
+        if self._views is not None:
+            values = np.array(image, dtype = dtype, copy = True)
+            if self._valid is not None:
+                values[..., np.logical_not(self._valid)] = 0
+            symmetrized = sum(_apply_view(values, view) for view in self._views)
+            symmetrized *= norm.reshape(self.shape)
+            symmetrized[..., norm.reshape(self.shape) == 0] = fill_value
+            return symmetrized
+
+        # Images of a stack are the columns of a single sparse matrix-matrix product
+        values = image.reshape((-1, norm.size)).T.astype(dtype, copy = False)
+        symmetrized = (operator @ values).T
+        symmetrized *= norm
+        symmetrized[:, norm == 0] = fill_value
+        return symmetrized.reshape(image.shape)
+
+    def _cast(self, dtype):
+        """ Operator and normalization in a floating-point type, cached. """
+        if dtype not in self._operators:
+            counts = self.counts.ravel()
+            norm = np.zeros_like(counts)
+            np.divide(1, counts, out = norm, where = counts > 0)
+            operator = None if self._operator is None else self._operator.astype(dtype)
+            self._operators[dtype] = operator, norm.astype(dtype)
+        return self._operators[dtype]
+
+def _symmetrize(im, mod, angle, center, mask, fill_value, dtype):
+    """
+    Symmetrize a single image by interpolating it once per symmetry operation, which
+    is equivalent to a :class:`Symmetrizer` without the cost of building its operator.
+    """
+    dtype = _float_dtype(dtype)
+    im = np.asarray(im)
+    operations = _operations(mod, angle)
+    center = _center(center, im.shape)
+
+    # Exact permutations of the pixels are cheap to set up
+    if _views(operations, center.ravel(), im.shape) is not None:
+        symmetrizer = Symmetrizer(im.shape, mod = mod, angle = angle, center = center, mask = mask)
+        return symmetrizer(im, fill_value = fill_value, dtype = dtype)
+
+    valid = np.ones(im.shape, dtype = dtype)
     if mask is not None:
-       im[mask] = np.nan
-       reflected[mask] = np.nan
+        valid[np.asarray(mask, dtype = np.bool)] = 0
+    values = np.array(im, dtype = dtype, copy = True)
+    values[valid == 0] = 0
+
+    # Bilinear interpolation with zero weight outside of the image is the same as in _bilinear.
+    # Both the masked image and the valid pixels are interpolated, for normalization.
+    kwargs = {'order': 1, 'mode': 'constant', 'cval': 0, 'preserve_range': True}
+    # The first operation is always the identity
+    symmetrized, counts = values.copy(), valid.copy()
+    for operation in operations[1:]:
+        # Input coordinates are center + operation @ (xy - center)
+        matrix = np.eye(3)
+        matrix[:2, :2], matrix[:2, 2:] = operation, center - operation @ center
+
+        # As in _bilinear, transforms which are integers up to round-off are made exact
+        rounded = np.around(matrix)
+        snap = np.abs(matrix - rounded) < 1e-9
+        matrix[snap] = rounded[snap]
+        transform = AffineTransform(matrix = matrix)
+        symmetrized += warp(values, transform, **kwargs)
+        counts += warp(valid, transform, **kwargs)
     
-    kwargs = {'center': center, 'mode' : 'constant', 'cval' : 0, 'preserve_range': True}
+    np.divide(symmetrized, counts, out = symmetrized, where = counts > 0)
+    symmetrized[counts <= 0] = fill_value
+    return symmetrized
+
+def _operations(mod, angle = None):
+    """ 
+    Symmetry operations acting on (x, y) coordinates: rotations by multiples of 360/mod degrees, 
+    and if ``angle`` is not None, the reflection across a line at ``angle`` combined with every rotation.
+    """
+    if (360 % mod):
+        raise ValueError('{}-fold rotational symmetry is not valid (not a divisor of 360).'.format(mod))
+
+    operations = [_rotation(rotation) for rotation in range(0, 360, int(360/mod))]
+    if angle is not None:
+        operations += [rotation @ _reflection(angle) for rotation in operations]
+    return operations
+
+def _center(center, shape):
+    """ Center of symmetry as an array of (x, y) coordinates of shape (2, 1), following scikit-image. """
+    rows, cols = shape
+    if center is None:
+        center = (cols / 2 - 0.5, rows / 2 - 0.5)
+    return np.asarray(center, dtype = np.float).reshape((2, 1))
+
+def _rotation(angle):
+    """ Rotation matrix, acting on (x, y) coordinates as in scikit-image. """
+    angle = np.deg2rad(angle)
+    return np.array([[np.cos(angle), -np.sin(angle)],
+                     [np.sin(angle),  np.cos(angle)]])
+
+def _reflection(angle):
+    """ Reflection matrix across a line at ``angle``, acting on (x, y) coordinates as in scikit-image. """
+    # Rows increase downwards, therefore counter-clockwise angles are negative in (x, y) coordinates
+    angle = np.deg2rad(-angle)
+    return np.array([[np.cos(2 * angle),  np.sin(2 * angle)],
+                     [np.sin(2 * angle), -np.cos(2 * angle)]])
+
+def _views(operations, center, shape):
+    """ 
+    Array views equivalent to symmetry operations about ``center``, as (transpose, flipped axes) 
+    tuples. If any operation is not an exact permutation of the pixels, None is returned.
+    """
+    rows, cols = shape
+    if not np.allclose(center, (cols / 2 - 0.5, rows / 2 - 0.5), rtol = 0, atol = 1e-9):
+        return None
     
-    # Rotate the 'reflected' image so that the reflection line is the x-axis
-    # Flip the image along the y-axis
-    # Rotate back to original orientation
-    reflected = rotate(reflected, -angle, **kwargs)
-    reflected = mirror(reflected, axes = 0)
-    reflected = rotate(reflected, angle, **kwargs)
-
-    return nan_to_num(average([im, reflected]), fill_value, copy = False)
+    views = list()
+    for operation in operations:
+        rounded = np.around(operation)
+        if not np.allclose(operation, rounded, rtol = 0, atol = 1e-9):
+            return None
+        
+        # Input coordinates center + operation @ (xy - center) are either
+        # flipped along x and y (diagonal operation), or also swapped (anti-diagonal operation).
+        # Axes of arrays are (..., y, x).
+        (a, b), (c, d) = rounded
+        if a == d == 0:
+            if rows != cols:
+                return None
+            views.append((True, tuple(axis for axis, sign in [(-2, b), (-1, c)] if sign < 0)))
+        else:
+            views.append((False, tuple(axis for axis, sign in [(-2, d), (-1, a)] if sign < 0)))
+    return views
+
+def _apply_view(arr, view):
+    """ Apply a view computed by ``_views`` to the last two axes of an array. """
+    transpose, axes = view
+    if transpose:
+        arr = np.swapaxes(arr, -1, -2)
+    return mirror(arr, axes = axes) if axes else arr
+
+def _bilinear(xy, shape, indices, weights):
+    """
+    Flat indices and weights of the four neighbors involved in the bilinear interpolation
+    of an image of ``shape`` at coordinates ``xy``, stored in ``indices`` and ``weights`` 
+    of shape (4, N). Neighbors outside of the image have no weight.
+    """
+    rows, cols = shape
+
+    # Coordinates which are integers up to round-off, e.g. after rotations by multiples of
+    # 90 degrees, are made exact. The interpolation is then an exact permutation.
+    rounded = np.around(xy)
+    snap = np.abs(xy - rounded) < 1e-9
+    xy[snap] = rounded[snap]
+
+    (x, y), (x0, y0) = xy, np.floor(xy)
+    fx, fy = x - x0, y - y0
+    x0, y0 = x0.astype(np.int), y0.astype(np.int)
+
+    # Weights and (clipped) indices along each axis, for the neighbors at offsets 0 and 1.
+    # Neighbors outside of the image along either axis have no weight. 
+    wx = [np.where((x0 >= 0) & (x0 < cols), 1 - fx, 0), np.where((x0 >= -1) & (x0 < cols - 1), fx, 0)]
+    wy = [np.where((y0 >= 0) & (y0 < rows), 1 - fy, 0), np.where((y0 >= -1) & (y0 < rows - 1), fy, 0)]
+    ix = [np.clip(x0, 0, cols - 1), np.clip(x0 + 1, 0, cols - 1)]
+    iy = [cols * np.clip(y0, 0, rows - 1), cols * np.clip(y0 + 1, 0, rows - 1)]
+
+    for neighbor, (dx, dy) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1)]):
+        np.add(iy[dy], ix[dx], out = indices[neighbor])
+        np.multiply(wy[dy], wx[dx], out = weights[neighbor])
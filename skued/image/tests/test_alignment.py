@@ -11,7 +11,7 @@ from skimage.feature import register_translation
 from skimage.transform import rotate
 from scipy.ndimage import fourier_shift
 
-from .. import (align, diff_register, ialign, itrack_peak,
+from .. import (MaskedRegistration, align, diff_register, ialign, itrack_peak,
                 masked_register_translation, shift_image)
 from .test_powder import circle_image
 
@@ -76,6 +76,26 @@ class TestDiffRegister(unittest.TestCase):
 			shift = diff_register(im + noise1, im2 + noise2, edge_mask)
 			self.assertTrue(np.allclose(shift, random_shift, atol = 1))
 	
+	def test_levels(self):
+		""" Test that coarse-to-fine registration is equivalent to full-resolution registration """
+		im = np.asfarray(data.camera())
+		edge_mask = np.ones_like(im, dtype = np.bool)
+		edge_mask[20:-20, 20:-20] = False
+
+		for random_shift in (np.random.randint(low = -10, high = 10, size = (2,)), (17, -3)):
+			im2 = shift_image(im, shift = random_shift, fill_value = 0)
+			with self.subTest(shift = tuple(random_shift)):
+				expected = diff_register(im, im2, edge_mask, crop = False)
+				for levels in (1, 3):
+					shift = diff_register(im, im2, edge_mask, crop = False, levels = levels)
+					self.assertTrue(np.allclose(shift, expected))
+	
+	def test_levels_upsampling(self):
+		""" Test that coarse-to-fine registration cannot be combined with upsampling """
+		im = np.asfarray(data.camera())
+		with self.assertRaises(ValueError):
+			diff_register(im, im, levels = 2, upsample_factor = 4)
+	
 	def test_side_effects(self):
 		""" Test that arrays registered by diff_register are not modified """
 		im1 = np.random.random(size = (32,32))
@@ -91,6 +111,46 @@ class TestDiffRegister(unittest.TestCase):
 		shift = diff_register(im1, im2, mask, crop = True, sigma = None)
 		shift = diff_register(im1, im2, mask, crop = False, sigma = None)
 
+class TestMaskedRegistration(unittest.TestCase):
+
+	def test_against_diff_register(self):
+		""" Test that registration onto a fixed reference is equivalent to diff_register """
+		im = np.asfarray(data.camera())
+		mask = np.zeros_like(im, dtype = np.bool)
+		mask[200:300, 0:100] = True
+
+		for crop in (True, False):
+			register = MaskedRegistration(im, mask = mask, crop = crop)
+			for shift in [(3, -5), (0, 7), (-2, -2)]:
+				shifted = np.roll(im, shift, axis = (0, 1))
+				with self.subTest('crop = {}, shift = {}'.format(crop, shift)):
+					self.assertTrue(np.allclose(register(shifted), 
+								diff_register(shifted, im, mask = mask, crop = crop)))
+	
+	def test_upsampling(self):
+		""" Test that sub-pixel shifts are registered with upsampling """
+		im = np.asfarray(data.camera())
+		shifted = np.real(np.fft.ifft2(fourier_shift(np.fft.fft2(im), (2.4, -1.7))))
+
+		register = MaskedRegistration(im, crop = False, sigma = None, upsample_factor = 10)
+		self.assertTrue(np.allclose(register(shifted), (1.7, -2.4), atol = 1/10))
+
+	def test_masked_region(self):
+		""" Test that masked pixels do not contribute to the registration """
+		im = np.asfarray(data.camera())
+		shifted = np.roll(im, (4, -3), axis = (0, 1))
+
+		# Edges are masked due to shifting, and a bright, 
+		# misleading feature is placed in the masked region
+		mask = np.ones_like(im, dtype = np.bool)
+		mask[10:-10, 10:-10] = False
+		mask[100:200, 100:200] = True
+		shifted[mask] = 10 * im.max()
+
+		# Smoothing would spread the misleading feature outside of the mask
+		register = MaskedRegistration(im, mask = mask, crop = False, sigma = None)
+		self.assertTrue(np.allclose(register(shifted), (3, -4)))
+
 class TestIAlign(unittest.TestCase):
 
 	def test_trivial(self):
@@ -100,6 +160,19 @@ class TestIAlign(unittest.TestCase):
 		self.assertEqual(len(aligned), 5)
 		self.assertSequenceEqual(data.camera().shape, aligned[0].shape)
 		
+	def test_parallel(self):
+		""" Test that alignment in parallel yields the same images, in the same order """
+		original = data.camera()
+		misaligned = [shift_image(original, (randint(-4, 4), randint(-4, 4))) 
+					  for _ in range(5)]
+
+		serial = list(ialign(misaligned, reference = original))
+		parallel = list(ialign((im for im in misaligned), reference = original, processes = 2))
+
+		self.assertEqual(len(serial), len(parallel))
+		for im1, im2 in zip(serial, parallel):
+			self.assertTrue(np.allclose(im1, im2))
+
 	def test_misaligned_canned_images_fast(self):
 		""" shift images from skimage.data by entire pixels.
 	   We don't expect perfect alignment."""
@@ -176,6 +249,35 @@ class TestShiftImage(unittest.TestCase):
 		arr = np.random.random( size = (64, 64) )
 		shifted = shift_image(arr, shift = (0, 10), fill_value = np.nan)
 		self.assertTrue(np.all(np.isnan(shifted[:10, :])))
+	
+	def test_stack(self):
+		""" Test that shifting a stack of images is equivalent to shifting every image """
+		stack = np.random.random( size = (5, 32, 32) )
+		shifts = np.array([(0, 0), (3, -2), (-1.5, 0.5), (40, 0), (0.3, 7)])
+		shifted = shift_image(stack, shifts, fill_value = np.nan)
+		for image, shift, expected in zip(stack, shifts, shifted):
+			self.assertTrue(np.allclose(shift_image(image, shift, fill_value = np.nan), expected, equal_nan = True))
+	
+	def test_out(self):
+		""" Test that shifted arrays can be stored in a preallocated array, including the array itself """
+		stack = np.random.random( size = (5, 32, 32) )
+		shifts = np.array([(0, 0), (3, -2), (-1.5, 0.5), (40, 0), (0.3, 7)])
+		expected = shift_image(stack, shifts)
+
+		with self.subTest('Preallocated array'):
+			out = np.empty_like(stack)
+			shifted = shift_image(stack, shifts, out = out)
+			self.assertIs(shifted, out)
+			self.assertTrue(np.allclose(out, expected))
+		
+		with self.subTest('In-place'):
+			shift_image(stack, shifts, out = stack)
+			self.assertTrue(np.allclose(stack, expected))
+	
+	def test_stack_mismatched_shifts(self):
+		""" Test that the number of shifts must match the number of images """
+		with self.assertRaises(ValueError):
+			shift_image(np.random.random( size = (5, 32, 32) ), np.zeros((4, 2)))
 
 class TestAlign(unittest.TestCase):
 	
@@ -237,6 +339,50 @@ class TestItrackPeak(unittest.TestCase):
 
         self.assertEqual(len(shifts), len(images))
 
+    def test_parallel(self):
+        """ Test that tracking in parallel yields the same shifts, in the same order """
+        prototype = np.zeros(shape = (32, 32))
+        prototype[15:18, 15:18] = 10
+        images = [np.roll(prototype, (randint(-4, 4), randint(-4, 4)), axis = (0, 1)) for _ in range(10)]
+
+        serial = list(itrack_peak(images, row_slice = np.s_[4:28], col_slice = np.s_[4:28]))
+        parallel = list(itrack_peak((im for im in images), row_slice = np.s_[4:28], 
+                                    col_slice = np.s_[4:28], processes = 2))
+
+        self.assertEqual(len(serial), len(parallel))
+        for shift1, shift2 in zip(serial, parallel):
+            self.assertTrue(np.allclose(shift1, shift2))
+    
+    def test_rois(self):
+        """ Test that tracking many peaks at once is equivalent to tracking every peak separately """
+        prototype = np.zeros(shape = (64, 64))
+        prototype[15:18, 15:18] = 10
+        prototype[40:43, 45:48] = 10
+        images = [np.roll(prototype, (randint(-4, 4), randint(-4, 4)), axis = (0, 1)) for _ in range(10)]
+        rois = [np.s_[4:28, 4:28], np.s_[30:54, 34:58], np.s_[8:24, 6:26]]
+
+        shifts = list(itrack_peak(images, rois = rois))
+        for index, (row_slice, col_slice) in enumerate(rois):
+            single = itrack_peak(images, row_slice = row_slice, col_slice = col_slice)
+            for shift, expected in zip(shifts, single):
+                self.assertTupleEqual(shift.shape, (len(rois), 2))
+                self.assertTrue(np.allclose(shift[index], expected))
+    
+    def test_rois_parallel(self):
+        """ Test that tracking many peaks in parallel yields the same shifts, in the same order """
+        prototype = np.zeros(shape = (64, 64))
+        prototype[15:18, 15:18] = 10
+        prototype[40:43, 45:48] = 10
+        images = [np.roll(prototype, (randint(-4, 4), randint(-4, 4)), axis = (0, 1)) for _ in range(10)]
+        rois = [np.s_[4:28, 4:28], np.s_[30:54, 34:58]]
+
+        serial = list(itrack_peak(images, rois = rois))
+        parallel = list(itrack_peak((im for im in images), rois = rois, processes = 2))
+
+        self.assertEqual(len(serial), len(parallel))
+        for shift1, shift2 in zip(serial, parallel):
+            self.assertTrue(np.allclose(shift1, shift2))
+
 class TestMaskedRegisterTranslation(unittest.TestCase):
 
 	def test_padfield_data_full_mode(self):
@@ -299,7 +445,67 @@ class TestMaskedRegisterTranslation(unittest.TestCase):
 													mode = 'full', overlap_ratio = 1/10)
 
 		self.assertTrue(np.allclose(skimage_result, masked_result))
-
+	
+	def test_upsampling(self):
+		""" Test that sub-pixel shifts are registered with upsampling """
+		reference_image = np.asfarray(data.camera())
+		mask = np.ones_like(reference_image, dtype = np.bool)
+		for shift in [(-7.3, 12.6), (2.2, -0.5), (3.4, -1.6)]:
+			shifted = np.real(np.fft.ifft2(fourier_shift(np.fft.fft2(reference_image), shift)))
+			for upsample_factor in (10, 20):
+				with self.subTest('shift = {}, upsample_factor = {}'.format(shift, upsample_factor)):
+					result = masked_register_translation(reference_image, shifted, mask, mode = 'full', 
+														 upsample_factor = upsample_factor)
+					self.assertTrue(np.allclose(result, -np.array(shift), atol = 1/upsample_factor))
+	
+	def test_max_shift(self):
+		""" Test that registration restricted to small shifts is equivalent to the full registration """
+		reference = np.asfarray(data.camera())[100:356, 100:356]
+		mask = np.ones_like(reference, dtype = np.bool)
+		mask[0:8, :] = False
+
+		for shift in [(3, -5), (0, 4), (-2, -2)]:
+			shifted = np.roll(reference, shift, axis = (0, 1))
+			with self.subTest('shift = {}'.format(shift)):
+				expected = masked_register_translation(reference, shifted, mask, mode = 'full')
+				result = masked_register_translation(reference, shifted, mask, max_shift = 6)
+				self.assertTrue(np.allclose(result, expected))
+		
+		with self.subTest('Upsampling'):
+			with self.assertRaises(ValueError):
+				masked_register_translation(reference, shifted, mask, max_shift = 6, upsample_factor = 10)
+
+	def test_upsampling_stack(self):
+		""" Test that sub-pixel registration of a stack of images is equivalent to registering images one at a time """
+		reference_image = np.asfarray(data.camera())[100:356, 100:356]
+		mask = np.ones_like(reference_image, dtype = np.bool)
+		stack = np.stack([np.real(np.fft.ifft2(fourier_shift(np.fft.fft2(reference_image), shift))) 
+						  for shift in [(-3.3, 2.6), (0.2, -0.5)]])
+		
+		expected = np.stack([masked_register_translation(reference_image, image, mask, upsample_factor = 10) 
+							 for image in stack])
+		shifts = masked_register_translation(reference_image, stack, mask, upsample_factor = 10)
+		self.assertTrue(np.allclose(shifts, expected))
+
+	def test_stack(self):
+		""" Test that registering a stack of images is equivalent to registering images one at a time,
+		regardless of the memory budget """
+		reference = np.asfarray(data.camera())[100:356, 100:356]
+		mask = np.ones_like(reference, dtype = np.bool)
+		mask[0:8, :] = False
+
+		stack = np.stack([np.roll(reference, shift, axis = (0, 1)) 
+						  for shift in [(3, -5), (0, 7), (-2, -2), (0, 0)]])
+
+		for mode in ('full', 'same'):
+			expected = np.stack([masked_register_translation(reference, image, mask, mode = mode) 
+								 for image in stack])
+			for max_memory in (1, 2**28):
+				with self.subTest('mode = {}, max_memory = {}'.format(mode, max_memory)):
+					shifts = masked_register_translation(reference, stack, mask, mode = mode, 
+														 max_memory = max_memory)
+					self.assertTupleEqual(shifts.shape, (len(stack), 2))
+					self.assertTrue(np.allclose(shifts, expected))
 
 
 if __name__ == '__main__':
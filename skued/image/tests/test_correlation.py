@@ -7,7 +7,7 @@ from scipy.signal import correlate
 from skimage.io import imread
 from skimage.data import camera
 
-from .. import mnxc2, mnxc, xcorr
+from .. import MaskedCorrelator, mnxc2, mnxc, xcorr
 
 np.random.seed(23)
 
@@ -53,6 +53,17 @@ class TestXcorr(unittest.TestCase):
 			from_scipy = correlate(im1, im2, mode = 'same')
 			
 			self.assertTrue(np.allclose(from_scipy, from_skued))
+	
+	def test_over_axes(self):
+		""" Test that the cross-correlation over some axes is a loop over the other axes """
+		im1 = np.random.random(size = (32,32,5))
+		im2 = np.random.random(size = (32,32,5))
+
+		from_skued = xcorr(im1, im2, mode = 'full', axes = (0,1))
+		self.assertFalse(np.iscomplexobj(from_skued))
+		for index in range(im1.shape[2]):
+			from_scipy = correlate(im1[:,:,index], im2[:,:,index], mode = 'full')
+			self.assertTrue(np.allclose(from_scipy, from_skued[:,:,index]))
 
 @unittest.skip('Deprecated')
 class TestMNXC2(unittest.TestCase):
@@ -233,5 +244,101 @@ class TestMNXC(unittest.TestCase):
 		same_xcorr = mnxc(arr1, arr2, m1, m2, axes=(0, 1, 2), mode='same')
 		self.assertTupleEqual(same_xcorr.shape, expected_same_shape)
 
+	def test_max_shift(self):
+		"""Masked normalized cross-correlation restricted to small shifts should be 
+		equal to the relevant part of the full cross-correlation."""
+		np.random.seed(23)
+		max_shift = 4
+
+		for shape1, shape2 in [((40, 50), (40, 50)), ((40, 50), (33, 47))]:
+			arr1 = np.random.random(shape1)
+			arr2 = np.random.random(shape2)
+			m1 = np.random.choice([True, False], arr1.shape, p=[3 / 4, 1 / 4])
+			m2 = np.random.choice([True, False], arr2.shape, p=[3 / 4, 1 / 4])
+
+			# In 'full' mode, the correlation without shift is located at index (shape2 - 1)
+			row, col = np.array(shape2) - 1
+			full = mnxc(arr1, arr2, m1, m2, mode='full', overlap_ratio=0).real
+			expected = full[row - max_shift:row + max_shift + 1, col - max_shift:col + max_shift + 1]
+
+			with self.subTest('{} and {}'.format(shape1, shape2)):
+				window = mnxc(arr1, arr2, m1, m2, overlap_ratio=0, max_shift=max_shift)
+				self.assertTupleEqual(window.shape, (2 * max_shift + 1, 2 * max_shift + 1))
+				self.assertTrue(np.allclose(window, expected))
+
+class TestMaskedCorrelator(unittest.TestCase):
+
+	def test_against_mnxc(self):
+		"""Correlating arrays against a fixed reference should be equivalent to mnxc,
+		for every array."""
+		np.random.seed(23)
+
+		reference = np.random.random((32, 28))
+		reference_mask = np.random.choice([True, False], reference.shape, p=[3 / 4, 1 / 4])
+		mask = np.random.choice([True, False], (30, 34), p=[3 / 4, 1 / 4])
+
+		for mode in ('full', 'same'):
+			correlator = MaskedCorrelator(reference, reference_mask, mask, mode=mode, axes=(0, 1))
+			for _ in range(3):
+				arr = np.random.random(mask.shape)
+				with self.subTest(mode):
+					self.assertTrue(np.allclose(correlator(arr),
+								mnxc(arr, reference, mask, reference_mask, axes=(0, 1), mode=mode)))
+	
+	def test_stack(self):
+		"""Correlating a stack of arrays at once should be equivalent to a loop over the stack."""
+		np.random.seed(23)
+
+		reference = np.random.random((16, 16))
+		mask = np.random.choice([True, False], reference.shape, p=[3 / 4, 1 / 4])
+		stack = np.random.random((5, 16, 16))
+
+		correlator = MaskedCorrelator(reference, mask, mask, axes=(0, 1))
+		with_loop = np.stack([correlator(arr) for arr in stack])
+		self.assertTrue(np.allclose(with_loop, correlator(stack)))
+
+	def test_real_output(self):
+		"""The correlation of real arrays should be real."""
+		reference = np.random.random((16, 16))
+		mask = np.ones_like(reference, dtype=np.bool)
+
+		correlator = MaskedCorrelator(reference, mask, mask)
+		self.assertFalse(np.iscomplexobj(correlator(np.random.random((16, 16)))))
+
+	def test_single_precision(self):
+		"""Correlating arrays in single precision should be close to double precision."""
+		reference = np.random.random((16, 16))
+		mask = np.random.choice([True, False], reference.shape, p=[3 / 4, 1 / 4])
+		arr = np.random.random((16, 16))
+
+		for max_shift in (None, 3):
+			with self.subTest(max_shift = max_shift):
+				single = MaskedCorrelator(reference, mask, mask, max_shift=max_shift, dtype=np.float32)(arr)
+				double = MaskedCorrelator(reference, mask, mask, max_shift=max_shift, dtype=np.float64)(arr)
+				self.assertEqual(single.dtype, np.float32)
+				self.assertTrue(np.allclose(single, double, atol=1e-4))
+
+	def test_side_effects(self):
+		"""Correlating arrays against a fixed reference should not modify the inputs."""
+		reference = np.random.random((8, 8))
+		arr = np.random.random((8, 8))
+		mask = np.ones_like(arr, dtype=np.bool)
+
+		for a in (reference, arr, mask):
+			a.setflags(write=False)
+
+		# If arrays are written to, an exception will be raised.
+		correlator = MaskedCorrelator(reference, mask, mask)
+		correlator(arr)
+	
+	def test_mismatched_shape(self):
+		"""Correlating arrays of a different shape than the mask should raise an error."""
+		reference = np.random.random((8, 8))
+		mask = np.ones_like(reference, dtype=np.bool)
+
+		correlator = MaskedCorrelator(reference, mask, mask)
+		with self.assertRaises(ValueError):
+			correlator(np.random.random((8, 9)))
+
 if __name__ == '__main__':
 	unittest.main()
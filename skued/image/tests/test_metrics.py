@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 from npstreams import last
-from .. import snr_from_collection, isnr, mask_from_collection, mask_image, combine_masks, trimr, triml
+import pickle
+import tracemalloc
+from .. import PixelStatistics, average_from_collection, ireject_outliers, snr_from_collection, isnr, mask_from_collection, mask_image, combine_masks, trimr, triml
 import unittest
 
 class TestSNRFromCollection(unittest.TestCase):
@@ -41,6 +43,22 @@ class TestISNR(unittest.TestCase):
         from_skued = last(isnr(images))
 
         self.assertTrue(np.allclose(from_numpy, from_skued))
+    
+    def test_single_pass(self):
+        """ Test that images are only iterated over once, e.g. for generators that cannot be copied """
+        images = [np.random.random((64,64)) for _ in range(10)]
+        stack = np.dstack(images)
+        consumed = list()
+
+        def generator():
+            for image in images:
+                consumed.append(image)
+                yield image
+
+        from_numpy = np.mean(stack, axis = 2)/np.std(stack, axis = 2)
+        for count, snr in enumerate(isnr(generator()), start = 1):
+            self.assertEqual(len(consumed), count)
+        self.assertTrue(np.allclose(from_numpy, snr))
 
 class TestMaskFromCollection(unittest.TestCase):
 
@@ -79,6 +97,27 @@ class TestMaskFromCollection(unittest.TestCase):
         self.assertEqual(np.sum(mask), 1)   # only one pixels is masked
         self.assertEqual(mask[5, 12], True)
     
+    def test_cumulative_std_threshold(self):
+        """ Test that pixels are rejected if their cumulative standard deviation exceeds the threshold at any point """
+        images = [np.zeros((64,64)) for _ in range(10)]
+        images[1][5, 12] = 10
+        for image in images[2:]:
+            image[5, 12] = 5
+        
+        # The standard deviation of the first two images is 5, but only 2.2 for the whole collection
+        mask = mask_from_collection(images, px_thresh = 10000, std_thresh = 4)
+        self.assertEqual(np.sum(mask), 1)
+        self.assertEqual(mask[5, 12], True)
+    
+    def test_generator(self):
+        """ Test that mask_from_collection is the same for a generator or a list of images """
+        images = [np.random.normal(loc = 100, scale = 5, size = (64,64)) for _ in range(20)]
+        from_list = mask_from_collection(images, px_thresh = (85, 115), std_thresh = 5.5)
+        from_generator = mask_from_collection((image for image in images), px_thresh = (85, 115), std_thresh = 5.5)
+
+        self.assertTrue(np.any(from_list))
+        self.assertTrue(np.all(from_list == from_generator))
+    
     def test_single_image(self):
         """ Test that mask_from_collection works even if input
         is a single array """
@@ -87,6 +126,174 @@ class TestMaskFromCollection(unittest.TestCase):
 
         self.assertFalse(np.any(mask))
 
+class TestAverageFromCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.stack = np.random.normal(loc = 100, scale = 5, size = (15, 64, 32))
+        self.stack[3, 10, 10] = 1e4
+        self.stack[4, 2, 2] = np.nan
+    
+    def test_estimators(self):
+        """ Test that estimators are equivalent to NumPy where all values are valid """
+        for estimator, func in [('mean', np.mean), ('median', np.median)]:
+            with self.subTest(estimator):
+                average, std, counts = average_from_collection(self.stack, estimator = estimator)
+                self.assertTrue(np.allclose(average[16:], func(self.stack, axis = 0)[16:]))
+                self.assertTrue(np.allclose(std[16:], np.std(self.stack, axis = 0)[16:]))
+                self.assertTrue(np.all(counts[16:] == 15))
+    
+    def test_invalid_values(self):
+        """ Test that non-finite values are ignored """
+        _, _, counts = average_from_collection(self.stack, estimator = 'median')
+        self.assertEqual(counts[2, 2], 14)
+    
+    def test_sigma_clip(self):
+        """ Test that outliers are rejected by sigma-clipping """
+        average, _, counts = average_from_collection(self.stack, estimator = 'sigma-clip')
+        self.assertLess(abs(average[10, 10] - 100), 10)
+        self.assertEqual(counts[10, 10], 14)
+    
+    def test_tiles(self):
+        """ Test that the result does not depend on the tiling, source or parallelism """
+        expected = average_from_collection(self.stack, estimator = 'sigma-clip')
+        for kwargs in [dict(max_memory = 2**12), dict(max_memory = 2**15, processes = 2)]:
+            for images in [self.stack, iter(list(self.stack))]:
+                with self.subTest(**kwargs):
+                    results = average_from_collection(images, estimator = 'sigma-clip', **kwargs)
+                    for result, expect in zip(results, expected):
+                        self.assertTrue(np.array_equal(result, expect))
+    
+    def test_invalid_estimator(self):
+        """ Test that an invalid estimator raises an error """
+        with self.assertRaises(ValueError):
+            average_from_collection(self.stack, estimator = 'mode')
+
+class TestIRejectOutliers(unittest.TestCase):
+
+    def setUp(self):
+        self.images = [np.random.normal(loc = 100, scale = 5, size = (64,64)) for _ in range(20)]
+        self.images[4][12, 7] = 1000    # cosmic ray
+        for image in self.images[::4]:
+            image[30, 30] = 500         # intermittent hot pixel
+    
+    def test_outliers(self):
+        """ Test that cosmic rays are detected and corrected """
+        results = list(ireject_outliers(self.images, window = 5, threshold = 10))
+        self.assertEqual(len(results), len(self.images))
+
+        corrected, outliers, _ = results[4]
+        self.assertTrue(outliers[12, 7])
+        self.assertLess(corrected[12, 7], 200)
+
+        # Apart from the hot pixel, the cosmic ray is the only outlier
+        total = sum(outliers.astype(np.int) for _, outliers, _ in results)
+        total[30, 30] = 0
+        self.assertEqual(np.sum(total), 1)
+    
+    def test_hot_pixels(self):
+        """ Test that pixels which are often outliers are flagged as hot """
+        *_, (_, _, hot) = ireject_outliers(self.images, window = 5, threshold = 10, hot_fraction = 0.2)
+        self.assertTrue(hot[30, 30])
+        self.assertEqual(np.sum(hot), 1)
+    
+    def test_negative_outliers(self):
+        """ Test that outliers below the running median, e.g. dropouts, are detected and corrected """
+        images = [np.array(image, copy = True) for image in self.images]
+        images[6][20, 20] = -800
+        corrected, outliers, _ = list(ireject_outliers(images, window = 5, threshold = 10))[6]
+        self.assertTrue(outliers[20, 20])
+        self.assertGreater(corrected[20, 20], 0)
+    
+    def test_early_outlier(self):
+        """ Test that a single outlier at the start of the stream does not make a pixel hot """
+        images = [np.array(image, copy = True) for image in self.images]
+        images[0][40, 40] = 1000
+        results = list(ireject_outliers(images, window = 5, threshold = 10, hot_fraction = 0.25))
+        self.assertTrue(results[0][1][40, 40])
+        for _, _, hot in results:
+            self.assertFalse(hot[40, 40])
+    
+    def test_px_thresh(self):
+        """ Test that pixels with a running median above the intensity threshold are flagged as hot """
+        images = [np.zeros((16,16)) for _ in range(5)]
+        for image in images:
+            image[3, 4] = 10
+        *_, (_, _, hot) = ireject_outliers(images, px_thresh = 9)
+        self.assertTrue(hot[3, 4])
+        self.assertEqual(np.sum(hot), 1)
+    
+    def test_short_stream(self):
+        """ Test that streams shorter than the window are processed """
+        results = list(ireject_outliers(self.images[:3], window = 9))
+        self.assertEqual(len(results), 3)
+        for (corrected, *_), image in zip(results, self.images):
+            self.assertEqual(corrected.shape, image.shape)
+    
+    def test_invalid_window(self):
+        """ Test that an empty window raises an error """
+        with self.assertRaises(ValueError):
+            list(ireject_outliers(self.images, window = 0))
+
+class TestPixelStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.images = [np.random.normal(loc = 100, scale = 5, size = (32,32)) for _ in range(20)]
+    
+    def test_single_pass(self):
+        """ Test that statistics are equivalent to NumPy """
+        statistics = PixelStatistics(self.images)
+        stack = np.stack(self.images, axis = -1)
+
+        self.assertEqual(statistics.count, 20)
+        self.assertTrue(np.allclose(statistics.mean, np.mean(stack, axis = -1)))
+        self.assertTrue(np.allclose(statistics.std, np.std(stack, axis = -1)))
+        self.assertTrue(np.allclose(statistics.minimum, np.min(stack, axis = -1)))
+        self.assertTrue(np.allclose(statistics.maximum, np.max(stack, axis = -1)))
+    
+    def test_max_variance(self):
+        """ Test that the maximum cumulative variance is equivalent to NumPy """
+        statistics = PixelStatistics(self.images)
+        stack = np.stack(self.images, axis = -1)
+        expected = np.max([np.var(stack[..., :count], axis = -1) for count in range(1, 21)], axis = 0)
+        self.assertTrue(np.allclose(statistics.max_variance, expected))
+    
+    def test_merge(self):
+        """ Test that merging statistics of chunks is equivalent to a single pass """
+        statistics = PixelStatistics(self.images)
+        merged = PixelStatistics(self.images[:3]).merge(PixelStatistics(self.images[3:]))
+
+        self.assertEqual(merged.count, statistics.count)
+        for attr in ('mean', 'm2', 'minimum', 'maximum'):
+            with self.subTest(attr):
+                self.assertTrue(np.allclose(getattr(merged, attr), getattr(statistics, attr)))
+    
+    def test_merge_empty(self):
+        """ Test that merging empty statistics is a no-op """
+        statistics = PixelStatistics(self.images)
+        merged = PixelStatistics().merge(statistics).merge(PixelStatistics())
+
+        self.assertEqual(merged.count, statistics.count)
+        self.assertTrue(np.allclose(merged.m2, statistics.m2))
+        self.assertIsNot(merged.mean, statistics.mean)
+    
+    def test_mismatched_shapes(self):
+        """ Test that images of different shapes raise an error """
+        statistics = PixelStatistics(self.images)
+        with self.assertRaises(ValueError):
+            statistics.update(np.zeros((16,16)))
+        with self.assertRaises(ValueError):
+            statistics.merge(PixelStatistics([np.zeros((16,16))]))
+    
+    def test_pickle(self):
+        """ Test that statistics can be pickled, e.g. to be returned from worker processes """
+        statistics = PixelStatistics(self.images)
+        unpickled = pickle.loads(pickle.dumps(statistics))
+
+        self.assertEqual(unpickled.count, statistics.count)
+        self.assertTrue(np.allclose(unpickled.std, statistics.std))
+        self.assertTrue(np.all(unpickled.snr() == snr_from_collection(self.images)))
+        self.assertTrue(np.all(unpickled.mask(std_thresh = 5.5) == mask_from_collection(self.images, std_thresh = 5.5)))
+
 class TestCombineMasks(unittest.TestCase):
 
     def test_trivial(self):
@@ -139,6 +346,75 @@ class TestTrimLeft(unittest.TestCase):
         array = np.arange(0, 101, dtype = np.float) # [0, 1, 2, ..., 100]
         trimmed = triml(array, percentile = 20, fill_value = np.nan)
         self.assertTrue(np.any(np.isnan(trimmed)))
+    
+    def test_histogram(self):
+        """ Test that the histogram percentile is within one bin of the exact percentile """
+        array = np.random.normal(size = (64, 32, 16))
+        for axis in (None, 0, 1, -1):
+            with self.subTest(axis = axis):
+                exact = np.percentile(array, 20, axis = axis, keepdims = True)
+                width = np.ptp(array, axis = axis, keepdims = True) / 256
+                trimmed = triml(array, percentile = 20, axis = axis, fill_value = np.nan,
+                                method = 'histogram', bins = 256, max_memory = 2**14)
+                self.assertTrue(np.all(np.isnan(trimmed[array < exact - width])))
+                self.assertFalse(np.any(np.isnan(trimmed[array > exact + width])))
+    
+    def test_histogram_negative_axis(self):
+        """ Test that negative axes are equivalent to positive axes, when arrays are trimmed in many chunks """
+        for shape, axis in [((64, 32), -2), ((64, 32), -1), ((101,), -1)]:
+            with self.subTest(shape = shape, axis = axis):
+                array = np.random.random(size = shape)
+                kwargs = dict(percentile = 50, fill_value = np.nan, method = 'histogram', bins = 1024, max_memory = 2000)
+                estimated = triml(array, axis = axis, **kwargs)
+                self.assertTrue(np.array_equal(np.isnan(estimated), np.isnan(triml(array, axis = axis % array.ndim, **kwargs))))
+
+                # Elements further than one bin from the exact percentile are trimmed as with the exact method
+                exact = np.percentile(array, 50, axis = axis, keepdims = True)
+                width = np.ptp(array, axis = axis, keepdims = True) / 1024
+                far = np.abs(array - exact) > width
+                self.assertTrue(np.array_equal(np.isnan(estimated)[far], (array < exact)[far]))
+    
+    def test_histogram_memory(self):
+        """ Test that the histograms of many lanes are accumulated within the memory budget """
+        # Histograms of all lanes would take 4096 * 1024 * 8 bytes = 32 MB
+        stack = np.random.random(size = (20, 64, 64)).astype(np.float32)
+        out = np.empty_like(stack)
+        max_memory = 2**20
+
+        tracemalloc.start()
+        try:
+            triml(stack, percentile = 20, axis = 0, method = 'histogram', bins = 1024, max_memory = max_memory, out = out)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 2 * max_memory)
+
+        # Elements further than one bin from the exact percentile are trimmed as with the exact method
+        exact = np.percentile(stack, 20, axis = 0, keepdims = True)
+        width = np.ptp(stack, axis = 0, keepdims = True) / 1024
+        far = np.abs(stack - exact) > width
+        self.assertTrue(np.array_equal((out == 0)[far], (stack < exact)[far]))
+    
+    def test_histogram_trivial(self):
+        """ Test that nothing is trimmed when percentile is zero, with the histogram method """
+        array = np.arange(0, 101)
+        trimmed = triml(array, percentile = 0, method = 'histogram')
+        self.assertTrue(np.allclose(array, trimmed))
+    
+    def test_out(self):
+        """ Test that arrays can be trimmed in-place """
+        array = np.arange(0, 101, dtype = np.float)
+        for method in ('exact', 'histogram'):
+            with self.subTest(method = method):
+                out = np.array(array, copy = True)
+                trimmed = triml(out, percentile = 20, fill_value = np.nan, method = method, out = out)
+                self.assertIs(trimmed, out)
+                self.assertTrue(np.any(np.isnan(out)))
+    
+    def test_invalid_method(self):
+        """ Test that an invalid method raises an error """
+        with self.assertRaises(ValueError):
+            triml(np.arange(0, 101), percentile = 20, method = 'tdigest')
 
 class TestTrimRight(unittest.TestCase):
 
@@ -160,5 +436,17 @@ class TestTrimRight(unittest.TestCase):
         trimmed = trimr(array, percentile = 20, fill_value = np.nan)
         self.assertTrue(np.any(np.isnan(trimmed)))
 
+    def test_histogram_trivial(self):
+        """ Test that nothing is trimmed when percentile is 100, with the histogram method """
+        array = np.arange(0, 101)
+        trimmed = trimr(array, percentile = 100, method = 'histogram')
+        self.assertTrue(np.allclose(array, trimmed))
+
+    def test_histogram(self):
+        """ Test that trimming is working with the histogram method """
+        array = np.arange(0, 101) # [0, 1, 2, ..., 100]
+        trimmed = trimr(array, percentile = 20, fill_value = 0, method = 'histogram')
+        self.assertTrue(np.all(trimmed <= 20))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from .. import azimuthal_average, powder_center
+from .. import (AzimuthalIntegrator, azimuthal_average, azimuthal_cake,
+                 azimuthal_statistics, iazimuthal_average, powder_center)
 from ... import Crystal, powdersim
+import tracemalloc
 import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
 from skimage.filters import gaussian
 
@@ -21,7 +25,6 @@ def circle_image(shape, center, radii, intensities):
     im[:] = gaussian(im, 5)
     return im
 
-@unittest.skip('deprecated')
 class TestPowderCenter(unittest.TestCase):
     
     def test_trivial(self):
@@ -39,6 +42,45 @@ class TestPowderCenter(unittest.TestCase):
         im += (im.max() / 5) * np.random.random(size = im.shape)
         self.assertTrue(np.allclose(center, powder_center(im), atol = 1))
 
+    def test_with_mask(self):
+        """ Test center-finding with a masked region, e.g. a beam block """
+        center = (130, 121)
+        im = circle_image(shape = (256, 256), center = center, 
+                          radii = [20, 45, 80], intensities = [4, 3, 2])
+        mask = np.zeros_like(im, dtype = np.bool)
+        mask[120:140, :130] = True
+        im[mask] = 100   # Masked region should not matter
+        self.assertSequenceEqual(center, powder_center(im, mask = mask))
+    
+    def test_guess(self):
+        """ Test that an initial guess close to the center is refined """
+        center = (130, 121)
+        im = circle_image(shape = (256, 256), center = center, 
+                          radii = [20, 45, 80], intensities = [4, 3, 2])
+        self.assertSequenceEqual(center, powder_center(im, guess = (127, 124)))
+    
+    def test_guess_neighborhood(self):
+        """ Test that only the neighborhood of an initial guess is used, so that tracking does not depend on the image size """
+        center = (1030, 1011)
+        im = circle_image(shape = (2048, 2048), center = center, 
+                          radii = [20, 45, 80], intensities = [4, 3, 2])
+        
+        # Pixels far from the guess, which would bias the full search, are ignored
+        guess = (1024, 1016)
+        far = np.ones_like(im, dtype = np.bool)
+        far[guess[0] - 128:guess[0] + 128, guess[1] - 128:guess[1] + 128] = False
+        im[far] = 10 * np.random.random(size = np.count_nonzero(far))
+        self.assertSequenceEqual(center, powder_center(im, guess = guess))
+    
+    def test_half_pixel(self):
+        """ Test that centers between pixels are found """
+        center = (100.5, 90)
+        extent = np.arange(0, 200)
+        xx, yy = np.meshgrid(extent, extent)
+        rr = np.sqrt((yy - center[0])**2 + (xx - center[1])**2)
+        im = np.exp(-(rr - 30)**2 / 4) + np.exp(-(rr - 60)**2 / 4)
+        self.assertSequenceEqual(center, powder_center(im))
+
 class TestAzimuthalAverage(unittest.TestCase):
     
     def test_trivial_array(self):
@@ -152,6 +194,332 @@ class TestAzimuthalAverage(unittest.TestCase):
 
         self.assertFalse(np.any(np.isnan(av)))
 
+class TestAzimuthalIntegrator(unittest.TestCase):
+
+    def test_brute_force(self):
+        """ Test AzimuthalIntegrator and azimuthal_average against a pixel-by-pixel average of every ring """
+        image = np.random.random(size = (64, 64))
+        center = (30.3, 35.6)
+        mask = np.zeros_like(image, dtype = np.bool)
+        mask[25:40, 25:40] = True
+
+        # Every valid pixel within the angular bounds contributes to the ring nearest to its center, 
+        # or its radial extent is split between the rings it overlaps.
+        sums, weights = {'nearest': dict(), 'split': dict()}, {'nearest': dict(), 'split': dict()}
+        for (row, col), value in np.ndenumerate(image):
+            dx, dy = col - center[0], row - center[1]
+            angle = np.rad2deg(np.arctan2(dy, dx)) + 180
+            if mask[row, col] or not (15 <= angle <= 75):
+                continue
+            
+            contributions = {'nearest': [(int(np.rint(np.hypot(dx, dy))), 1)], 'split': list()}
+            halfwidth = 0.5 * (abs(dx) + abs(dy)) / np.hypot(dx, dy)
+            lo, hi = max(np.hypot(dx, dy) - halfwidth, -0.5), np.hypot(dx, dy) + halfwidth
+            for ring in range(int(np.floor(lo + 0.5)), int(np.floor(hi + 0.5)) + 1):
+                overlap = min(hi, ring + 0.5) - max(lo, ring - 0.5)
+                if overlap > 0:
+                    contributions['split'].append((ring, overlap / (hi - lo)))
+
+            for method, rings in contributions.items():
+                for ring, weight in rings:
+                    sums[method][ring] = sums[method].get(ring, 0) + weight * value
+                    weights[method][ring] = weights[method].get(ring, 0) + weight
+        
+        for method in ('nearest', 'split'):
+            with self.subTest(method = method):
+                integrator = AzimuthalIntegrator(image.shape, center, mask = mask, angular_bounds = (15, 75), method = method)
+                radius, intensity = integrator(image, trim = False)
+                expected = np.zeros_like(intensity)
+                for ring in sums[method]:
+                    expected[ring] = sums[method][ring] / weights[method][ring]
+                self.assertTrue(np.allclose(intensity, expected))
+
+                # Trimmed averages are the same
+                r, i = azimuthal_average(image, center, mask = mask, angular_bounds = (15, 75), method = method)
+                self.assertTrue(np.allclose(i, expected[int(r[0]):int(r[-1]) + 1]))
+    
+    def test_counts(self):
+        """ Test that the number of valid pixels per bin is consistent with the mask """
+        image = np.ones(shape = (128, 128), dtype = np.float)
+        mask = np.zeros_like(image, dtype = np.bool)
+        mask[0:64, :] = True
+
+        integrator = AzimuthalIntegrator(image.shape, center = (64, 64), mask = mask)
+        self.assertEqual(integrator.counts.sum(), np.sum(np.logical_not(mask)))
+        self.assertSequenceEqual(integrator.radius.shape, integrator.counts.shape)
+    
+    def test_no_trim(self):
+        """ Test that the full radial range is returned if trim = False """
+        image = np.ones(shape = (128, 128), dtype = np.float)
+        integrator = AzimuthalIntegrator(image.shape, center = (64, 64))
+        radius, intensity = integrator(image, trim = False)
+
+        self.assertEqual(radius.size, integrator.radius.size)
+        self.assertTrue(np.allclose(intensity, 1))
+    
+    def test_masked_nan(self):
+        """ Test that NaNs in masked pixels do not propagate """
+        image = np.ones(shape = (128, 128), dtype = np.float)
+        image[0:10, :] = np.nan
+        mask = np.isnan(image)
+
+        radius, intensity = AzimuthalIntegrator(image.shape, center = (64, 64), mask = mask)(image)
+        self.assertFalse(np.any(np.isnan(intensity)))
+
+    def test_split_pixel_trivial(self):
+        """ Test that split-pixel integration of a constant image is constant """
+        image = np.ones(shape = (128, 128), dtype = np.float)
+        mask = np.zeros_like(image, dtype = np.bool)
+        mask[60:70, 0:64] = True
+        integrator = AzimuthalIntegrator(image.shape, center = (63.3, 64.8), mask = mask, method = 'split')
+        radius, intensity = integrator(image)
+
+        self.assertTrue(np.allclose(intensity, 1))
+        self.assertSequenceEqual(radius.shape, intensity.shape)
+    
+    def test_split_pixel_counts(self):
+        """ Test that split-pixel integration distributes the whole area of every valid pixel """
+        mask = np.zeros(shape = (128, 128), dtype = np.bool)
+        mask[0:20, :] = True
+        integrator = AzimuthalIntegrator(mask.shape, center = (64, 64), mask = mask, method = 'split')
+        self.assertTrue(np.allclose(integrator.counts.sum(), np.sum(np.logical_not(mask))))
+    
+    def test_split_pixel_ring(self):
+        """ Test that split-pixel and nearest-bin integration find the same ring """
+        image = np.zeros(shape = (256, 256), dtype = np.float)
+        xx, yy = np.meshgrid(np.arange(256), np.arange(256))
+        rr = np.hypot(xx - 128, yy - 128)
+        image[np.logical_and(39.5 < rr, rr < 40.5)] = 1
+
+        for method in ('nearest', 'split'):
+            with self.subTest(method):
+                radius, intensity = azimuthal_average(image, center = (128, 128), method = method)
+                self.assertEqual(radius[np.argmax(intensity)], 40)
+    
+    def test_bin_width(self):
+        """ Test that radial bins can be specified in arbitrary units """
+        image = np.ones(shape = (128, 128), dtype = np.float)
+        for method in ('nearest', 'split'):
+            with self.subTest(method):
+                radius, intensity = azimuthal_average(image, center = (64, 64), trim = False, 
+                                                      method = method, bin_width = 0.05, scale = 0.025)
+                self.assertTrue(np.allclose(np.diff(radius), 0.05))
+                self.assertAlmostEqual(radius.max(), 0.025 * 64 * np.sqrt(2), delta = 0.05)
+                self.assertTrue(np.allclose(intensity, 1))
+    
+    def test_stack(self):
+        """ Test that stacks of images are integrated like individual images """
+        stack = np.random.random(size = (5, 128, 128))
+        mask = np.zeros(shape = (128, 128), dtype = np.bool)
+        mask[60:70, 0:64] = True
+
+        for method in ('nearest', 'split'):
+            with self.subTest(method):
+                integrator = AzimuthalIntegrator((128, 128), center = (63, 66), mask = mask, method = method)
+                
+                # A small memory budget forces integration in chunks
+                radius, averages = integrator(stack, max_memory = 1)
+                self.assertSequenceEqual(averages.shape, (5, radius.size))
+
+                for image, average in zip(stack, averages):
+                    _, expected = integrator(image)
+                    self.assertTrue(np.allclose(average, expected))
+    
+    def test_stack_no_copy(self):
+        """ Test that in-memory stacks of images are integrated without copies """
+        stack = np.ones(shape = (16, 128, 128), dtype = np.float)
+        integrator = AzimuthalIntegrator((128, 128), center = (64, 64))
+
+        tracemalloc.start()
+        try:
+            integrator(stack)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, stack.nbytes / 4)
+    
+    def test_memmap_stack(self):
+        """ Test that memory-mapped stacks of images can be integrated """
+        with TemporaryDirectory() as tmpdir:
+            stack = np.memmap(str(Path(tmpdir) / 'stack.npy'), dtype = np.float32, mode = 'w+', shape = (4, 64, 64))
+            stack[:] = 1
+            radius, averages = azimuthal_average(stack, center = (32, 32), max_memory = 3 * stack[0].nbytes)
+            
+            self.assertSequenceEqual(averages.shape, (4, radius.size))
+            self.assertTrue(np.allclose(averages, 1))
+            del stack
+
+    def test_invalid_method(self):
+        """ Test that a ValueError is raised for invalid integration methods """
+        with self.assertRaises(ValueError):
+            AzimuthalIntegrator((128, 128), center = (64, 64), method = 'bilinear')
+
+    def test_shape_mismatch(self):
+        """ Test that a ValueError is raised for images of the wrong shape """
+        integrator = AzimuthalIntegrator((128, 128), center = (64, 64))
+        with self.assertRaises(ValueError):
+            integrator(np.zeros((64, 64)))
+    
+    def test_fully_masked(self):
+        """ Test that integrating an image without valid pixels returns empty arrays """
+        image = np.random.random(size = (128, 128))
+        mask = np.ones_like(image, dtype = np.bool)
+        for method in ('nearest', 'split'):
+            with self.subTest(method = method):
+                radius, intensity = AzimuthalIntegrator(image.shape, center = (64, 64), mask = mask, method = method)(image)
+                self.assertEqual(radius.size, 0)
+                self.assertEqual(intensity.size, 0)
+    
+    def test_empty_angular_bounds(self):
+        """ Test that integrating over an angular wedge without pixels returns empty arrays """
+        image = np.random.random(size = (128, 128))
+        for method in ('nearest', 'split'):
+            with self.subTest(method = method):
+                integrator = AzimuthalIntegrator(image.shape, center = (64, 64), angular_bounds = (0.1, 0.2), method = method)
+                radius, intensity = integrator(image)
+                self.assertEqual(radius.size, 0)
+                self.assertEqual(intensity.size, 0)
+                
+                radius, intensity = azimuthal_average(image, center = (64, 64), angular_bounds = (0.1, 0.2))
+                self.assertEqual(intensity.size, 0)
+
+class TestAzimuthalCake(unittest.TestCase):
+
+    def test_against_azimuthal_average(self):
+        """ Test that every sector of the cake is equivalent to azimuthal_average with angular bounds """
+        image = np.random.random(size = (128, 128))
+        mask = np.zeros_like(image, dtype = np.bool)
+        mask[60:70, 0:64] = True
+
+        angles, radius, cake = azimuthal_cake(image, center = (63, 66), n_angles = 4, mask = mask, trim = False)
+        self.assertTrue(np.allclose(angles, [45, 135, 225, 315]))
+        self.assertSequenceEqual(cake.shape, (4, radius.size))
+
+        for (mi, ma), sector in zip([(0, 90), (90, 180), (180, 270), (270, 360)], cake):
+            r, expected = azimuthal_average(image, center = (63, 66), mask = mask, 
+                                            angular_bounds = (mi + 1, ma - 1), trim = False)
+            # Sectors are slightly larger than the angular bounds above
+            # hence the comparison is done with a tolerance
+            self.assertTrue(np.allclose(sector[10:r.size], expected[10:], atol = 0.1))
+    
+    def test_sector_selection(self):
+        """ Test that intensity in a single quadrant is attributed to the right sector """
+        image = np.zeros(shape = (128, 128), dtype = np.float)
+        xx, yy = np.meshgrid(np.arange(128), np.arange(128))
+        angles = np.rad2deg(np.arctan2(yy - 64, xx - 64)) + 180
+        image[np.logical_and(100 < angles, angles < 170)] = 1
+
+        for method in ('nearest', 'split'):
+            with self.subTest(method):
+                angles, radius, cake = azimuthal_cake(image, center = (64, 64), n_angles = 4, method = method)
+                self.assertTrue(np.allclose(cake[(0, 2, 3), 5:], 0))
+                self.assertTrue(np.all(cake[1, 5:] > 0))
+    
+    def test_angular_bounds(self):
+        """ Test that sectors span the angular bounds """
+        image = np.ones(shape = (128, 128), dtype = np.float)
+        angles, radius, cake = azimuthal_cake(image, center = (64, 64), n_angles = 3, angular_bounds = (30, 60))
+        self.assertTrue(np.allclose(angles, [35, 45, 55]))
+        self.assertTrue(np.allclose(cake[:, 20:60], 1))
+    
+    def test_stack(self):
+        """ Test cake integration of a stack of images """
+        stack = np.random.random(size = (3, 64, 64))
+        angles, radius, cake = azimuthal_cake(stack, center = (32, 32), n_angles = 6)
+        self.assertSequenceEqual(cake.shape, (3, 6, radius.size))
+        
+        for image, expected in zip(stack, cake):
+            _, _, c = azimuthal_cake(image, center = (32, 32), n_angles = 6, trim = False)
+            self.assertTrue(np.allclose(c[:, radius], expected))
+
+class TestAzimuthalStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.image = np.random.random(size = (128, 128))
+        self.mask = np.zeros_like(self.image, dtype = np.bool)
+        self.mask[60:70, 0:64] = True
+        self.center = (63, 66)
+
+        # Brute-force, ring-by-ring reference
+        xx, yy = np.meshgrid(np.arange(128), np.arange(128))
+        self.rings = np.rint(np.hypot(xx - self.center[0], yy - self.center[1])).astype(np.int)
+    
+    def test_mean(self):
+        """ Test that the mean estimator is equivalent to azimuthal_average """
+        radius, average, std, counts = azimuthal_statistics(self.image, self.center, mask = self.mask)
+        r, expected = azimuthal_average(self.image, self.center, mask = self.mask)
+
+        self.assertTrue(np.allclose(radius, r))
+        self.assertTrue(np.allclose(average, expected))
+
+        for r, s, c in zip(radius, std, counts):
+            values = self.image[np.logical_and(self.rings == r, np.logical_not(self.mask))]
+            self.assertAlmostEqual(s, np.std(values))
+            self.assertEqual(c, values.size)
+    
+    def test_median(self):
+        """ Test the median estimator against numpy.median on every ring """
+        radius, median, _, _ = azimuthal_statistics(self.image, self.center, mask = self.mask, estimator = 'median')
+        for r, m in zip(radius, median):
+            values = self.image[np.logical_and(self.rings == r, np.logical_not(self.mask))]
+            self.assertAlmostEqual(m, np.median(values))
+    
+    def test_sigma_clip(self):
+        """ Test that sigma-clipping rejects hot pixels """
+        image = np.ones(shape = (128, 128), dtype = np.float) + 0.01 * np.random.random(size = (128, 128))
+        image[self.rings == 40] = 1
+        image[64, 103] = 1e4    # hot pixel on the ring of radius 40
+
+        _, mean, _, counts = azimuthal_statistics(image, self.center, estimator = 'mean', trim = False)
+        _, clipped, _, clipped_counts = azimuthal_statistics(image, self.center, estimator = 'sigma-clip', trim = False)
+        
+        self.assertGreater(mean[40], 10)
+        self.assertAlmostEqual(clipped[40], 1)
+        self.assertEqual(counts[40] - clipped_counts[40], 1)
+    
+    def test_stack(self):
+        """ Test that statistics of stacks of images are computed for every image """
+        stack = np.random.random(size = (3, 128, 128))
+        integrator = AzimuthalIntegrator((128, 128), self.center, mask = self.mask)
+        radius, median, std, counts = integrator.statistics(stack, estimator = 'median')
+        
+        self.assertSequenceEqual(median.shape, (3, radius.size))
+        for image, m in zip(stack, median):
+            _, expected, *_ = integrator.statistics(image, estimator = 'median')
+            self.assertTrue(np.allclose(m, expected))
+    
+    def test_invalid(self):
+        """ Test that invalid estimators and integration methods raise an error """
+        with self.subTest('Invalid estimator'):
+            with self.assertRaises(ValueError):
+                azimuthal_statistics(self.image, self.center, estimator = 'mode')
+        
+        with self.subTest('Split-pixel integration'):
+            with self.assertRaises(ValueError):
+                AzimuthalIntegrator((128, 128), self.center, method = 'split').statistics(self.image)
+
+class TestIAzimuthalAverage(unittest.TestCase):
+
+    def test_against_azimuthal_average(self):
+        """ Test that iazimuthal_average is equivalent to azimuthal_average on every image """
+        images = [np.random.random(size = (128, 128)) for _ in range(5)]
+        mask = np.zeros(shape = (128, 128), dtype = np.bool)
+        mask[60:70, 0:64] = True
+
+        averages = iazimuthal_average(images, center = (63, 66), mask = mask)
+        for image, (radius, average) in zip(images, averages):
+            r, expected = azimuthal_average(image, center = (63, 66), mask = mask)
+            self.assertTrue(np.allclose(radius, r))
+            self.assertTrue(np.allclose(average, expected))
+    
+    def test_generator(self):
+        """ Test that iazimuthal_average works on generators of images """
+        images = (np.ones(shape = (64, 64)) for _ in range(5))
+        averages = list(iazimuthal_average(images, center = (32, 32), method = 'split'))
+
+        self.assertEqual(len(averages), 5)
+        for _, average in averages:
+            self.assertTrue(np.allclose(average, 1))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
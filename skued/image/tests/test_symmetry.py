@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from .. import nfold, reflection
+from skimage.transform import rotate
+from .. import Symmetrizer, nfold, reflection
 import unittest
 from warnings import catch_warnings, simplefilter
 
@@ -33,6 +34,33 @@ class TestNFoldSymmetry(unittest.TestCase):
             rot = nfold(im, mod = 2, mask = mask)
             self.assertTrue(np.allclose(rot, np.zeros_like(rot)))
     
+    def test_mask_rotate(self):
+        """ Test that nfold() with a mask averages the valid rotated images, as with the previous rotate-based nfold() """
+        im = 2 + np.add.outer(np.sin(np.arange(128) / 3), np.cos(np.arange(128) / 5))
+        mask = np.zeros_like(im, dtype = np.bool)
+        mask[20:40, 50:70] = True
+        center = (64, 61)
+
+        # Masked pixels are NaNs, which are ignored in the average of rotated images
+        kwargs = {'center': center, 'mode' : 'constant', 'cval' : 0, 'preserve_range': True}
+        masked = np.where(mask, np.nan, im)
+        rotated = [rotate(masked, angle, **kwargs) for angle in (0, 120, 240)]
+        rotated_mask = [rotate(mask.astype(np.float), angle, **kwargs) for angle in (0, 120, 240)]
+        weights = [np.isfinite(r).astype(np.float) for r in rotated]
+        expected = sum(np.nan_to_num(r) for r in rotated) / sum(weights)
+
+        # Both agree away from the edges of the image and of the mask, where rotated pixels
+        # are either fully masked or fully valid. 
+        compared = np.zeros_like(mask)
+        compared[24:104, 24:104] = True
+        for r, m in zip(rotated, rotated_mask):
+            compared &= np.isnan(r) == (m > 0.5)
+            compared &= np.isclose(m, 0) | np.isclose(m, 1)
+
+        symmetrized = nfold(im, mod = 3, center = center, mask = mask)
+        self.assertGreater(np.count_nonzero(compared), 0.9 * 80**2)
+        self.assertTrue(np.allclose(symmetrized[compared], expected[compared]))
+    
     def test_no_side_effects(self):
         """ Test that nfold() does not modify the input image and mask """
         im = np.empty((128, 128), dtype = np.float)
@@ -82,6 +110,13 @@ class TestNFoldSymmetry(unittest.TestCase):
         im = 1000*np.random.random(size = (256, 256))
         rot = nfold(im, mod = 1)
         self.assertTrue(np.allclose(im, rot))
+    
+    def test_dtype(self):
+        """ Test that nfold() can symmetrize in single precision """
+        im = 1000*np.random.random(size = (64, 64))
+        rot = nfold(im, mod = 4, dtype = np.float32)
+        self.assertEqual(rot.dtype, np.float32)
+        self.assertTrue(np.allclose(rot, nfold(im, mod = 4), rtol = 1e-5))
 
 class TestReflectionSymmetry(unittest.TestCase):
 
@@ -151,5 +186,119 @@ class TestReflectionSymmetry(unittest.TestCase):
 
         self.assertTrue(np.allclose(expected, reflected))
 
+class TestSymmetrizer(unittest.TestCase):
+
+    def setUp(self):
+        self.images = 1000*np.random.random(size = (3, 128, 128))
+        self.mask = np.zeros((128, 128), dtype = np.bool)
+        self.mask[0:20, 40:60] = True
+    
+    def test_nfold(self):
+        """ Test that Symmetrizer and nfold() average rotated images in the interior """
+        symmetrizer = Symmetrizer((128, 128), mod = 3, center = (67, 63))
+        for image in self.images:
+            rotated = [rotate(image, angle, center = (67, 63), mode = 'constant', preserve_range = True) 
+                       for angle in (0, 120, 240)]
+            expected = sum(rotated)[32:96, 32:96] / 3
+            self.assertTrue(np.allclose(symmetrizer(image)[32:96, 32:96], expected))
+            self.assertTrue(np.allclose(nfold(image, mod = 3, center = (67, 63))[32:96, 32:96], expected))
+        
+        # Both agree on masked images
+        symmetrizer = Symmetrizer((128, 128), mod = 3, center = (67, 63), mask = self.mask)
+        for image in self.images:
+            expected = nfold(image, mod = 3, center = (67, 63), mask = self.mask, fill_value = -1)
+            self.assertTrue(np.allclose(symmetrizer(image, fill_value = -1), expected))
+    
+    def test_reflection(self):
+        """ Test that Symmetrizer and reflection() are exact flips about a line through pixels """
+        # Vertical line x = 60, away from the center of the image
+        symmetrizer = Symmetrizer((128, 128), angle = 90, center = (60, 40))
+        for image in self.images:
+            expected = (image[:, 0:121] + image[:, 120::-1]) / 2
+            self.assertTrue(np.allclose(symmetrizer(image)[:, 0:121], expected))
+            self.assertTrue(np.allclose(reflection(image, angle = 90, center = (60, 40))[:, 0:121], expected))
+        
+        # Both agree on masked images
+        symmetrizer = Symmetrizer((128, 128), angle = 35, mask = self.mask)
+        for image in self.images:
+            expected = reflection(image, angle = 35, mask = self.mask, fill_value = -1)
+            self.assertTrue(np.allclose(symmetrizer(image, fill_value = -1), expected))
+    
+    def test_stack(self):
+        """ Test that stacks of images are symmetrized like individual images """
+        symmetrizer = Symmetrizer((128, 128), mod = 6, angle = 15)
+        stacked = symmetrizer(self.images)
+        self.assertEqual(stacked.shape, self.images.shape)
+        for image, symmetrized in zip(self.images, stacked):
+            self.assertTrue(np.allclose(symmetrizer(image), symmetrized))
+    
+    def test_dihedral(self):
+        """ Test that rotations and reflections are combined """
+        im = np.zeros((128, 128))
+        im[30:34, 80:84] = 1
+        symmetrized = Symmetrizer(im.shape, mod = 4, angle = 0)(im)
+        
+        # All 8 images of the square are distinct
+        self.assertTrue(np.allclose(symmetrized[30:34, 80:84], 1/8))
+        self.assertTrue(np.allclose(symmetrized.sum(), im.sum()))
+    
+    def test_mask(self):
+        """ Test that masked pixels do not contribute, and that the fill_value is used """
+        im = np.ones((128, 128))
+        im[self.mask] = 1e6
+        symmetrizer = Symmetrizer(im.shape, mod = 1, mask = self.mask)
+        symmetrized = symmetrizer(im, fill_value = np.nan)
+
+        self.assertTrue(np.all(np.isnan(symmetrized[self.mask])))
+        self.assertTrue(np.allclose(symmetrized[np.logical_not(self.mask)], 1))
+    
+    def test_dtype(self):
+        """ Test that Symmetrizer can symmetrize in single precision """
+        symmetrizer = Symmetrizer((128, 128), mod = 4)
+        symmetrized = symmetrizer(self.images[0], dtype = np.float32)
+        self.assertEqual(symmetrized.dtype, np.float32)
+        self.assertTrue(np.allclose(symmetrized, symmetrizer(self.images[0]), rtol = 1e-5))
+    
+    def test_exact(self):
+        """ Test that 2-fold, 4-fold and mirror symmetries about the center are exact """
+        # Sums of integers are exact in any order
+        im = np.around(self.images[0])
+        cases = [(dict(mod = 2), [im[::-1, ::-1]]),
+                 (dict(mod = 4), [np.rot90(im, 1), np.rot90(im, 2), np.rot90(im, 3)]),
+                 (dict(angle = 0), [im[::-1, :]]),
+                 (dict(angle = 90), [im[:, ::-1]]),
+                 (dict(angle = 45), [im[::-1, ::-1].T]),
+                 (dict(angle = 135), [im.T])]
+        
+        for kwargs, views in cases:
+            with self.subTest(**kwargs):
+                expected = (im + sum(views)) / (len(views) + 1)
+                self.assertTrue(np.array_equal(Symmetrizer(im.shape, **kwargs)(im), expected))
+    
+    def test_exact_rectangular(self):
+        """ Test that exact symmetries of rectangular images are equivalent to interpolation """
+        im = self.images[0, :, :100]
+        for kwargs in [dict(mod = 2), dict(angle = 0), dict(angle = 90)]:
+            with self.subTest(**kwargs):
+                # A center slightly off the center of the image requires interpolation
+                center = (49.5 + 1e-7, 63.5)
+                symmetrized = Symmetrizer(im.shape, **kwargs)(im)
+                interpolated = Symmetrizer(im.shape, center = center, **kwargs)(im)
+
+                # Interpolation differs by at most the offset times the largest difference between neighbors
+                self.assertTrue(np.allclose(symmetrized, interpolated, rtol = 0, atol = 1e-3))
+    
+    def test_exact_stack(self):
+        """ Test that stacks of images are symmetrized exactly like individual images """
+        symmetrizer = Symmetrizer((128, 128), mod = 4, angle = 45, mask = self.mask)
+        stacked = symmetrizer(self.images, fill_value = np.nan)
+        for image, symmetrized in zip(self.images, stacked):
+            self.assertTrue(np.array_equal(symmetrizer(image, fill_value = np.nan), symmetrized, equal_nan = True))
+    
+    def test_wrong_shape(self):
+        """ Test that images of the wrong shape raise an error """
+        with self.assertRaises(ValueError):
+            Symmetrizer((128, 128), mod = 2)(np.zeros((64, 64)))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -2,7 +2,8 @@
 import unittest
 import numpy as np
 from .. import (repeated_array, mirror, cart2polar, polar2cart, plane_mesh,
-                spherical2cart, cart2spherical, complex_array)
+                spherical2cart, cart2spherical, complex_array, get_float_dtype,
+                set_float_dtype)
 
 np.random.seed(23)
 
@@ -77,6 +78,28 @@ class TestMirror(unittest.TestCase):
 		self.assertTrue(np.allclose(arr[:, ::-1], mirror(arr, axes = 1)))
 		self.assertTrue(np.allclose(arr[::-1, :], mirror(arr, axes = 0)))
 
+class TestFloatDtype(unittest.TestCase):
+
+	def setUp(self):
+		self.dtype = get_float_dtype()
+	
+	def tearDown(self):
+		set_float_dtype(self.dtype)
+
+	def test_set_dtype(self):
+		""" Test that the default floating-point type can be set to single and double precision """
+		for dtype in (np.float32, np.float64, 'float32'):
+			with self.subTest(dtype):
+				set_float_dtype(dtype)
+				self.assertEqual(get_float_dtype(), np.dtype(dtype))
+	
+	def test_invalid_dtype(self):
+		""" Test that non-floating point types raise an error """
+		for dtype in (np.int, np.float16, np.complex):
+			with self.subTest(dtype):
+				with self.assertRaises(ValueError):
+					set_float_dtype(dtype)
+
 class TestCart2Polar(unittest.TestCase):
 
     def test_back_and_forth(self):
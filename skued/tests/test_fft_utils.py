@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+
+from ..fft_utils import _available, get_fft_backend, irfftn, rfftn, fftn, set_fft_backend
+
+np.random.seed(23)
+
+class TestFFTBackend(unittest.TestCase):
+
+	def setUp(self):
+		self.backend, self.workers = get_fft_backend()
+	
+	def tearDown(self):
+		set_fft_backend(self.backend, workers = self.workers)
+
+	def test_set_backend(self):
+		""" Test that the backend can be set to every available implementation """
+		for backend in _available():
+			with self.subTest(backend):
+				set_fft_backend(backend, workers = 2)
+				self.assertTupleEqual(get_fft_backend(), (backend, 2))
+	
+	def test_invalid_backend(self):
+		""" Test that an invalid backend or number of workers raises an error """
+		with self.subTest('Invalid backend'):
+			with self.assertRaises(ValueError):
+				set_fft_backend('not a backend')
+		
+		with self.subTest('Invalid workers'):
+			with self.assertRaises(ValueError):
+				set_fft_backend('numpy', workers = 0)
+	
+	def test_against_numpy(self):
+		""" Test that all backends compute the same transforms as numpy """
+		arr = np.random.random(size = (16, 17, 3))
+		for backend in _available():
+			set_fft_backend(backend)
+			with self.subTest(backend):
+				self.assertTrue(np.allclose(fftn(arr, (20, 20), (0, 1)), np.fft.fftn(arr, (20, 20), (0, 1))))
+
+				spectrum = rfftn(arr, (20, 20), (0, 1))
+				self.assertTrue(np.allclose(spectrum, np.fft.rfftn(arr, (20, 20), (0, 1))))
+				self.assertTrue(np.allclose(irfftn(spectrum, (20, 20), (0, 1))[:16, :17], arr))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import unittest
+from itertools import count
+
+from ..utils import bounded_pmap
+
+def square(x):
+	return x**2
+
+class TestBoundedPmap(unittest.TestCase):
+
+	def test_order(self):
+		""" Test that results are yielded in the order of the input """
+		results = list(bounded_pmap(square, range(20), processes = 2))
+		self.assertListEqual(results, [x**2 for x in range(20)])
+	
+	def test_bounded(self):
+		""" Test that items are consumed from the input only as results are yielded """
+		consumed = list()
+		def items():
+			for x in count():
+				consumed.append(x)
+				yield x
+		
+		results = bounded_pmap(square, items(), processes = 2, max_pending = 3)
+		for _ in range(5):
+			next(results)
+		results.close()
+
+		self.assertLessEqual(len(consumed), 5 + 3 + 1)
+
+if __name__ == '__main__':
+	unittest.main()
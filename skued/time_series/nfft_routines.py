@@ -5,9 +5,10 @@ Non-uniform Fast Fourier Transform.
 
 from functools import lru_cache
 import numpy as np
-from scipy.fftpack import fft, ifft
 from math import sqrt, log, pi
 
+from ..fft_utils import fft
+
 def nfftfreq(M, df = 1):
     """
     Compute the frequency range used in nfft for `M` frequency bins.
@@ -56,6 +57,7 @@ def nfft(x, y, M, df = 1.0, eps = 1E-15):
     See Also
     --------
     nfftfreq : compute the frequencies of the nfft results
+    set_fft_backend : choose the implementation of Fourier transforms.
 
     References
     ----------
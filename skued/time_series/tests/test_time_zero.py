@@ -43,6 +43,19 @@ class TestTimeShift(unittest.TestCase):
         shift = register_time_shift(trace1, trace2)
         self.assertEqual(shift, -5)
     
+    def test_methods(self):
+        """ Test that the time-shift does not depend on the correlation method """
+        trace1 = np.sin(2*np.pi*np.linspace(0, 10, 64)) + 0.05*np.random.random(size = (64,))
+        trace2 = np.roll(trace1, 5) + 0.05*np.random.random(size = (64,))
+        for method in ('auto', 'fft', 'direct'):
+            with self.subTest(method):
+                self.assertEqual(register_time_shift(trace1, trace2, method = method), -5)
+    
+    def test_invalid_method(self):
+        """ Test that register_time_shift() raises an exception for invalid correlation methods """
+        with self.assertRaises(ValueError):
+            register_time_shift(np.ones((16,)), np.ones((16,)), method = 'not a method')
+    
     def test_shift_different_lengths(self):
         """ Test that register_time_shift() raises an exception if the reference and trace do not have the same shape """
         with self.assertRaises(ValueError):
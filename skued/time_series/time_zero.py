@@ -3,10 +3,13 @@
 from functools import lru_cache, partial
 
 import numpy as np
-from scipy.signal import correlate
+from scipy.fftpack import next_fast_len
+from scipy.signal import choose_conv_method, correlate
 
 from npstreams import array_stream, peek
 
+from ..fft_utils import fft, ifft, irfft, rfft
+
 
 # Save the normalization of correlations so that identical
 # autocorrelations are saved.
@@ -29,7 +32,8 @@ def register_time_shift(trace, reference, method = 'auto'):
     reference : array-like
         Reference trace.
     method : str {'auto', 'fft', 'direct'}, optional
-        A string indicating which method to use to calculate the correlation.
+        A string indicating which method to use to calculate the correlation. Fourier transforms
+        are computed with the backend set by :func:`set_fft_backend`.
     
     Returns
     -------
@@ -41,6 +45,7 @@ def register_time_shift(trace, reference, method = 'auto'):
     ------
     ValueError : if ``trace`` and ``reference`` do not have the same shape.
     ValueError : if ``trace`` is not a 1D array
+    ValueError : if ``method`` is not valid.
 
     See Also
     --------
@@ -54,6 +59,9 @@ def register_time_shift(trace, reference, method = 'auto'):
     
     if trace.ndim > 1:
         raise ValueError('Expected 1D time traces, but received traces of shape {}'.format(trace.shape))
+    
+    if method not in {'auto', 'fft', 'direct'}:
+        raise ValueError('Correlation method {} is not valid.'.format(method))
 
     trace = trace - trace.mean()
     reference = reference - reference.mean()
@@ -61,12 +69,29 @@ def register_time_shift(trace, reference, method = 'auto'):
     # Normalized cross-correlation
     # Note : we use an external function to calculate normalization
     #        so that it can be efficiently cached
-    xcorr = correlate(trace, reference, mode = 'full', method = 'auto') / __xcorr_normalization(trace.size, trace.dtype)
+    if method == 'auto':
+        method = choose_conv_method(trace, reference, mode = 'full')
+    
+    if method == 'fft':
+        xcorr = _xcorr_fft(trace, reference)
+    else:
+        xcorr = correlate(trace, reference, mode = 'full', method = 'direct')
+    xcorr /= __xcorr_normalization(trace.size, trace.dtype)
 
     # Generalize to the average of multiple maxima
     maxima = np.transpose(np.nonzero(xcorr == xcorr.max())) 
     return np.mean(maxima) - int(xcorr.shape[0]/2)
 
+def _xcorr_fft(trace, reference):
+    """ Full cross-correlation between two 1D traces of equal length, computed with the current FFT backend. """
+    size = 2 * trace.size - 1
+    fast_size = next_fast_len(size)
+    if np.iscomplexobj(trace) or np.iscomplexobj(reference):
+        spectrum = fft(trace, fast_size) * fft(np.conj(reference[::-1]), fast_size)
+        return ifft(spectrum, fast_size)[:size]
+    spectrum = rfft(trace, fast_size) * rfft(reference[::-1], fast_size)
+    return irfft(spectrum, fast_size)[:size]
+
 @array_stream
 def register_time_shifts(traces, reference = None, method = 'auto'):
     """
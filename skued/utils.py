@@ -4,8 +4,10 @@ Utility functions
 =================
 """
 
+from collections import deque
 from contextlib import contextmanager
 from functools import wraps
+from multiprocessing import Pool, cpu_count
 from warnings import resetwarnings, simplefilter, warn
 
 
@@ -43,3 +45,50 @@ def deprecated(message):
         return newfunc
     
     return decorator
+
+def bounded_pmap(func, iterable, processes = None, initializer = None, initargs = tuple(), max_pending = None):
+    """
+    Parallel, order-preserving application of a function to every item of an iterable.
+
+    Contrary to :meth:`multiprocessing.pool.Pool.imap`, items are only consumed from `iterable` 
+    as results are yielded. The number of items in flight is bounded, and so is memory usage, 
+    even for arbitrarily long generators.
+
+    Parameters
+    ----------
+    func : callable
+        Function to be applied to every element of `iterable`. `func` must be
+        picklable, e.g. defined at the top level of a module.
+    iterable : iterable
+        Iterable of items to be mapped.
+    processes : int or None, optional
+        Number of processes to use. If `None` (default), all available CPUs are used.
+    initializer : callable or None, optional
+        If not None, each worker process calls ``initializer(*initargs)`` when it starts.
+        This is useful to share large objects between all items, which are then 
+        transferred once per process rather than once per item.
+    initargs : tuple, optional
+        Arguments passed to `initializer`.
+    max_pending : int or None, optional
+        Maximum number of items that have been dispatched but not yet yielded. If `None` (default),
+        twice the number of processes is used.
+    
+    Yields
+    ------
+    Mapped values, in the order of `iterable`.
+    """
+    if processes is None:
+        processes = cpu_count()
+    
+    if max_pending is None:
+        max_pending = 2 * processes
+
+    with Pool(processes, initializer = initializer, initargs = initargs) as pool:
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(func, (item,)))
+        
+        while pending:
+            yield pending.popleft().get()